@@ -3,24 +3,35 @@ import datetime
 import hashlib
 import json
 import logging
+import multiprocessing
 import os
+import re
+import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 
+import cheroot.wsgi
 import cherrypy
 import flask_babel
-import psutil
-from flask import (Flask, flash, make_response, redirect, render_template,
-                   request, send_file, url_for)
+from flask import (Flask, flash, g, has_request_context, make_response,
+                   redirect, render_template, request, send_file, url_for)
 from flask_babel import Babel
 from flask_paginate import Pagination, get_page_parameter
+from werkzeug.local import LocalProxy
 
 import karaoke
 from constants import LANGUAGES, VERSION
 from lib.get_platform import get_platform
+from lib.instrumentation import TimedTemplate, capture_profile
+from lib.library import parse_root
+from lib.logs import log_levels, setup_logging
+from lib.metrics import MetricsCollector
+from lib.random_fill import fill_modes
+from lib.rooms import RoomDispatcher, room_environ_key
 
 try:
     from urllib.parse import quote, unquote
@@ -33,10 +44,17 @@ _ = flask_babel.gettext
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 app.jinja_env.add_extension('jinja2.ext.i18n')
+app.jinja_env.template_class = TimedTemplate
 app.config['BABEL_TRANSLATION_DIRECTORIES'] = 'translations'
 babel = Babel(app)
 site_name = "PiKaraoke"
 admin_password = None
+async_server = None
+metrics = None
+slow_request_threshold = None  # in seconds
+is_web_worker = False
+rooms = {}  # room name -> Karaoke instance, when hosting several rooms (see --rooms)
+thumbnail_dir = None  # see --thumbnails
 is_raspberry_pi = get_platform() == "raspberry_pi"
 
 def filename_from_path(file_path, remove_youtube_id=True):
@@ -62,6 +80,22 @@ def url_escape(filename):
 def hash_dict(d):
     return hashlib.md5(json.dumps(d, sort_keys=True, ensure_ascii=True).encode('utf-8', "ignore")).hexdigest()
 
+# the room of the current request, or the first room outside of requests and for unprefixed urls
+def get_room():
+    name = request.environ.get(room_environ_key) if has_request_context() else None
+    return rooms[name] if name else next(iter(rooms.values()))
+
+def all_rooms():
+    return list(rooms.values()) if rooms else [k]
+
+def run_rooms():
+    room_list = all_rooms()
+    for room in room_list[1:]:
+        th = threading.Thread(target=room.run, name="room-" + room.room)
+        th.daemon = True
+        th.start()
+    room_list[0].run()
+
 def is_admin():
     if (admin_password == None):
         return True
@@ -71,6 +105,35 @@ def is_admin():
             return True
     return False
 
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.perf_counter()
+    g.render_time = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_start_time" not in g:
+        return response
+    seconds = time.perf_counter() - g.request_start_time
+    # streamed responses don't know their size up front
+    size = None if response.is_streamed and not response.direct_passthrough else response.content_length
+    # label by route pattern rather than path, so song names don't each become a metric
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if metrics:
+        metrics.observe_request(route, response.status_code, seconds, g.render_time, size)
+    if slow_request_threshold and seconds >= slow_request_threshold:
+        logging.warning(
+            "Slow request: %s %s took %.0fms (handler: %.0fms, render: %.0fms, size: %s bytes, threads: %d)",
+            request.method,
+            request.full_path if request.query_string else request.path,
+            seconds * 1000,
+            (seconds - g.render_time) * 1000,
+            g.render_time * 1000,
+            size if size is not None else "unknown",
+            threading.active_count(),
+        )
+    return response
+
 @babel.localeselector
 def get_locale():
     """Select the language to display the webpage in based on the Accept-Language header"""
@@ -91,7 +154,7 @@ def auth():
     d = request.form.to_dict()
     p = d["admin-password"]
     if (p == admin_password):
-        resp = make_response(redirect('/'))
+        resp = make_response(redirect(url_for('home')))
         expire_date = datetime.datetime.now()
         expire_date = expire_date + datetime.timedelta(days=90)
         resp.set_cookie('admin', admin_password, expires=expire_date)
@@ -109,33 +172,43 @@ def login():
 
 @app.route("/logout")
 def logout():
-    resp = make_response(redirect('/'))
+    resp = make_response(redirect(url_for('home')))
     resp.set_cookie('admin', '')
     flash("Logged out of admin mode!", "is-success")
     return resp
 
+def get_now_playing(args=None):
+    # the splash screen reports its playback position along with polling, see Karaoke.get_position
+    if args and args.get("position"):
+        try:
+            k.report_position(float(args["position"]), args.get("url"))
+        except ValueError:
+            pass
+    if len(k.queue) >= 1:
+            next_song = k.queue[0]["title"]
+            next_user = k.queue[0]["user"]
+    else:
+        next_song = None
+        next_user = None
+    rc = {
+        "now_playing": k.now_playing,
+        "now_playing_user": k.now_playing_user,
+        "now_playing_command": k.now_playing_command,
+        "up_next": next_song,
+        "next_user": next_user,
+        "now_playing_url": k.now_playing_url,
+        "is_paused": k.is_paused,
+        "transpose_value": k.now_playing_transpose,
+        "volume": k.volume,
+        "gain": k.now_playing_gain,
+    }
+    rc["hash"] = hash_dict(rc) # used to detect changes in the now playing data
+    return rc
+
 @app.route("/nowplaying")
 def nowplaying():
     try: 
-        if len(k.queue) >= 1:
-            next_song = k.queue[0]["title"]
-            next_user = k.queue[0]["user"]
-        else:
-            next_song = None
-            next_user = None
-        rc = {
-            "now_playing": k.now_playing,
-            "now_playing_user": k.now_playing_user,
-            "now_playing_command": k.now_playing_command,
-            "up_next": next_song,
-            "next_user": next_user,
-            "now_playing_url": k.now_playing_url,
-            "is_paused": k.is_paused,
-            "transpose_value": k.now_playing_transpose,
-            "volume": k.volume,
-        }
-        rc["hash"] = hash_dict(rc) # used to detect changes in the now playing data
-        return json.dumps(rc)
+        return json.dumps(get_now_playing(request.args))
     except (Exception) as e:
         logging.error("Problem loading /nowplaying, pikaraoke may still be starting up: " + str(e))
         return ""
@@ -143,7 +216,7 @@ def nowplaying():
 # Call this after receiving a command in the front end
 @app.route("/clear_command")
 def clear_command():
-    k.now_playing_command = None
+    k.clear_command()
     return ""
 
 @app.route("/queue")
@@ -259,9 +332,15 @@ def vol_down():
 
 @app.route("/search", methods=["GET"])
 def search():
+    local_results = None
     if "search_string" in request.args:
         search_string = request.args["search_string"]
-        if ("non_karaoke" in request.args and request.args["non_karaoke"] == "true"):
+        # songs already in the library answer the search without asking YouTube, unless asked to
+        if request.args.get("youtube") != "true":
+            local_results = k.search_library(search_string, limit=20)
+        if local_results:
+            search_results = None
+        elif ("non_karaoke" in request.args and request.args["non_karaoke"] == "true"):
             search_results = k.get_search_results(search_string)
         else:
             search_results = k.get_karaoke_search_results(search_string)
@@ -274,16 +353,21 @@ def search():
         title="Search",
         songs=k.available_songs,
         search_results=search_results,
+        local_results=local_results,
         search_string=search_string,
+        non_karaoke=request.args.get("non_karaoke"),
     )
 
 @app.route("/autocomplete")
 def autocomplete():
-    q = request.args.get('q').lower()
-    result = []
-    for each in k.available_songs:
-        if q in each.lower():
-            result.append({"path": each, "fileName": k.filename_from_path(each), "type": "autocomplete"})
+    result = k.search_library(request.args.get('q'))
+    for each in result:
+        each["type"] = "autocomplete"
+    if thumbnail_dir is not None:
+        thumbnails = k.get_thumbnails([each["path"] for each in result])
+        for each in result:
+            if each["path"] in thumbnails:
+                each["thumbnail"] = url_for("thumbnail", key=thumbnails[each["path"]])
     response = app.response_class(
         response=json.dumps(result),
         mimetype='application/json'
@@ -336,6 +420,8 @@ def browse():
         # MSG: Title of the files page.
         title=_("Browse"),
         songs=songs[start_index:start_index + results_per_page],
+        show_thumbnails=thumbnail_dir is not None,
+        thumbnails=k.get_thumbnails(songs[start_index:start_index + results_per_page]) if thumbnail_dir else {},
         admin=is_admin()
     )
 
@@ -371,8 +457,79 @@ def download():
 
 @app.route("/qrcode")
 def qrcode():
+    if k.qr_code_path is None:
+        # still being generated in the background during startup
+        return "", 503
     return send_file(k.qr_code_path, mimetype="image/png")
 
+@app.route("/thumbnail/<key>.jpg")
+def thumbnail(key):
+    if thumbnail_dir is None or not re.match(r"^[0-9a-f]{40}$", key):
+        return "", 404
+    path = os.path.join(thumbnail_dir, key + ".jpg")
+    if not os.path.isfile(path):
+        return "", 404
+    # the key is a hash of the song's path, size and mtime, so a thumbnail's content never changes
+    response = send_file(path, mimetype="image/jpeg", etag=key, max_age=365 * 24 * 3600)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/startup_status")
+def startup_status():
+    return json.dumps({"ready": k.is_ready(), "phases": k.get_startup_status(), "url": k.url})
+
+@app.route("/ffmpeg_stats")
+def ffmpeg_stats():
+    return json.dumps(k.get_ffmpeg_stats())
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if metrics is None:
+        return "", 503
+    return metrics.format_prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/profile")
+def profile():
+    if (is_admin()):
+        seconds = request.args.get("seconds", 10, type=float)
+        folded = capture_profile(seconds)
+        filename = "pikaraoke-profile-%s.folded" % datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        return folded, 200, {
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Disposition": "attachment; filename=" + filename,
+        }
+    else:
+        flash("You don't have permission to profile pikaraoke", "is-danger")
+        return redirect(url_for("info"))
+
+@app.route("/processes")
+def processes():
+    return json.dumps(k.get_process_stats())
+
+@app.route("/storage")
+def storage():
+    report = k.get_storage_report()
+    if report is None:
+        return "", 404
+    return json.dumps(report)
+
+@app.route("/logs")
+def logs():
+    if (is_admin()):
+        level = request.args.get("level", "INFO")
+        if level not in log_levels:
+            level = "INFO"
+        records = k.get_logs(logging.getLevelName(level), 500)
+        for record in records:
+            record["time"] = datetime.datetime.fromtimestamp(record["time"]).strftime("%Y-%m-%d %H:%M:%S")
+        return render_template(
+            "logs.html", site_title=site_name, title="Logs", records=records, level=level, levels=log_levels
+        )
+    else:
+        flash("You don't have permission to view the logs", "is-danger")
+        return redirect(url_for("info"))
+
 @app.route("/logo")
 def logo():
     return send_file(k.logo_path, mimetype="image/png")
@@ -387,31 +544,107 @@ def start_song():
     k.start_song()
     return "ok"
 
+@app.route("/video_loaded", methods=["GET"])
+def video_loaded():
+    k.video_loaded()
+    return "ok"
+
+@app.route("/transition_stats")
+def transition_stats():
+    return json.dumps(k.get_transition_stats())
+
 @app.route("/files/delete", methods=["GET"])
 def delete_file():
     if "song" in request.args:
         song_path = request.args["song"]
-        if song_path in k.queue:
-            flash(
-                "Error: Can't delete this song because it is in the current queue: "
-                + song_path,
-                "is-danger",
-            )
+        result = k.delete(song_path)
+        if result["errors"]:
+            flash("Error: Can't delete this song: %s: %s" % (song_path, result["errors"][0][1]), "is-danger")
         else:
-            k.delete(song_path)
             flash("Song deleted: " + song_path, "is-warning")
     else:
         flash("Error: No song parameter specified!", "is-danger")
     return redirect(url_for("browse"))
 
 
+# Deletes and renames many songs at once, see Karaoke.update_files. Takes a json body:
+#   {"delete": [song path], "rename": [{"file": song path, "name": new name without the extension}]}
+@app.route("/files/batch", methods=["POST"])
+def batch_files():
+    if not is_admin():
+        return json.dumps({"error": "You don't have permission to edit songs"}), 403
+    d = request.get_json(silent=True)
+    try:
+        deletes = [str(song_path) for song_path in d.get("delete", [])]
+        renames = [(str(each["file"]), str(each["name"])) for each in d.get("rename", [])]
+    except (AttributeError, KeyError, TypeError):
+        return json.dumps({"error": "Expected {\"delete\": [...], \"rename\": [{\"file\", \"name\"}]}"}), 400
+    return json.dumps(k.update_files(deletes, renames))
+
+@app.route("/files/pin", methods=["GET"])
+def pin_file():
+    if "song" in request.args:
+        song_path = request.args["song"]
+        if is_admin():
+            pinned = request.args.get("pinned") == "1"
+            k.set_song_pinned(song_path, pinned)
+            if pinned:
+                flash("Song will be kept: " + song_path, "is-info")
+            else:
+                flash("Song may be removed when storage runs low: " + song_path, "is-warning")
+        else:
+            flash("You don't have permission to pin songs", "is-danger")
+        return redirect(url_for("edit_file", song=song_path))
+    flash("Error: No song parameter specified!", "is-danger")
+    return redirect(url_for("browse"))
+
+
+@app.route("/files/duplicates", methods=["GET", "POST"])
+def duplicates():
+    if not is_admin():
+        flash("You don't have permission to manage duplicates", "is-danger")
+        return redirect(url_for("browse"))
+    if request.method == "POST":
+        # every cluster has a kept song, the others are merged into it or deleted if checked
+        action = request.form.get("action")
+        merges = []
+        for i in range(int(request.form.get("clusters", 0))):
+            kept_path = request.form.get("keep-%d" % i)
+            for song_path in request.form.getlist("song-%d" % i):
+                if kept_path is None or song_path == kept_path:
+                    continue
+                if action == "merge":
+                    merges.append((song_path, kept_path))
+                elif action == "delete" and song_path in request.form.getlist("delete"):
+                    merges.append((song_path, None))
+        removed = k.merge_duplicates(merges)
+        flash("Removed %d duplicate songs" % len(removed), "is-warning" if removed else "is-info")
+        if len(removed) < len(merges):
+            flash("Songs in the queue were not removed", "is-danger")
+        return redirect(url_for("duplicates"))
+    if request.args.get("scan") == "1":
+        k.scan_duplicates()
+        return redirect(url_for("duplicates"))
+    d = k.get_duplicates()
+    return render_template(
+        "duplicates.html",
+        site_title=site_name,
+        title="Duplicates",
+        clusters=d["clusters"],
+        scanning=d["scanning"],
+        progress=d["progress"],
+        scanned_at=(
+            datetime.datetime.fromtimestamp(d["scanned_at"]).strftime("%Y-%m-%d %H:%M") if d["scanned_at"] else None
+        ),
+    )
+
 @app.route("/files/edit", methods=["GET", "POST"])
 def edit_file():
     queue_error_msg = "Error: Can't edit this song because it is in the current queue: "
     if "song" in request.args:
         song_path = request.args["song"]
         # print "SONG_PATH" + song_path
-        if song_path in k.queue:
+        if k.is_song_in_queue(song_path):
             flash(queue_error_msg + song_path, "is-danger")
             return redirect(url_for("browse"))
         else:
@@ -420,32 +653,26 @@ def edit_file():
                 site_title=site_name,
                 title="Song File Edit",
                 song=song_path.encode("utf-8", "ignore"),
+                disk_quota=k.has_disk_quota(),
+                pinned=k.is_song_pinned(song_path),
             )
     else:
         d = request.form.to_dict()
         if "new_file_name" in d and "old_file_name" in d:
             new_name = d["new_file_name"]
             old_name = d["old_file_name"]
-            if k.is_song_in_queue(old_name):
-                # check one more time just in case someone added it during editing
-                flash(queue_error_msg + song_path, "is-danger")
+            # checks one more time just in case someone queued the song during editing
+            result = k.rename(old_name, new_name)
+            if result["errors"]:
+                flash(
+                    "Error Renaming file: '%s' to '%s'. %s." % (old_name, new_name, result["errors"][0][1]),
+                    "is-danger",
+                )
             else:
-                # check if new_name already exist
-                file_extension = os.path.splitext(old_name)[1]
-                if os.path.isfile(
-                    os.path.join(k.download_path, new_name + file_extension)
-                ):
-                    flash(
-                        "Error Renaming file: '%s' to '%s'. Filename already exists."
-                        % (old_name, new_name + file_extension),
-                        "is-danger",
-                    )
-                else:
-                    k.rename(old_name, new_name)
-                    flash(
-                        "Renamed file: '%s' to '%s'." % (old_name, new_name),
-                        "is-warning",
-                    )
+                flash(
+                    "Renamed file: '%s' to '%s'." % (old_name, new_name),
+                    "is-warning",
+                )
         else:
             flash("Error: No filename parameters were specified!", "is-danger")
         return redirect(url_for("browse"))
@@ -465,35 +692,35 @@ def splash():
 def info():
     url=k.url
 
-    # cpu
-    cpu = str(psutil.cpu_percent()) + "%"
-
-    # mem
-    memory = psutil.virtual_memory()
-    available = round(memory.available / 1024.0 / 1024.0, 1)
-    total = round(memory.total / 1024.0 / 1024.0, 1)
-    memory = (
-        str(available)
-        + "MB free / "
-        + str(total)
-        + "MB total ( "
-        + str(memory.percent)
-        + "% )"
-    )
-
-    # disk
-    disk = psutil.disk_usage("/")
-    # Divide from Bytes -> KB -> MB -> GB
-    free = round(disk.free / 1024.0 / 1024.0 / 1024.0, 1)
-    total = round(disk.total / 1024.0 / 1024.0 / 1024.0, 1)
-    disk = (
-        str(free)
-        + "GB free / "
-        + str(total)
-        + "GB total ( "
-        + str(disk.percent)
-        + "% )"
-    )
+    # system stats come from the metrics sampler, so rendering this page doesn't wait on psutil
+    sample = metrics.get_latest() if metrics else None
+    cpu = memory = disk = "-"
+    if sample:
+        cpu_cores = sample["cpu_percent"]
+        cpu = str(round(sum(cpu_cores) / len(cpu_cores), 1)) + "% ( 1 min average: " + str(metrics.get_cpu_average()) + "% )"
+
+        # mem
+        available = round(sample["memory_available_bytes"] / 1024.0 / 1024.0, 1)
+        total = round(sample["memory_total_bytes"] / 1024.0 / 1024.0, 1)
+        percent = round(100 - 100.0 * sample["memory_available_bytes"] / sample["memory_total_bytes"], 1)
+        memory = str(available) + "MB free / " + str(total) + "MB total ( " + str(percent) + "% )"
+
+        # disk
+        # Divide from Bytes -> KB -> MB -> GB
+        free = round(sample["disk_free_bytes"] / 1024.0 / 1024.0 / 1024.0, 1)
+        total = round(sample["disk_total_bytes"] / 1024.0 / 1024.0 / 1024.0, 1)
+        percent = round(100 - 100.0 * sample["disk_free_bytes"] / sample["disk_total_bytes"], 1)
+        disk = str(free) + "GB free / " + str(total) + "GB total ( " + str(percent) + "% )"
+
+    # downloads, against the storage budget
+    storage = None
+    report = k.get_storage_report()
+    if report:
+        storage = "%d songs, %.1fGB" % (report["downloads"], report["used"] / 1024.0 / 1024.0 / 1024.0)
+        if report["budget"] is not None:
+            storage += " of %.1fGB budget" % (report["budget"] / 1024.0 / 1024.0 / 1024.0)
+        if report["pinned"]:
+            storage += ", %d pinned" % report["pinned"]
 
     # youtube-dl
     youtubedl_version = k.youtubedl_version
@@ -506,7 +733,9 @@ def info():
         memory=memory,
         cpu=cpu,
         disk=disk,
+        storage=storage,
         youtubedl_version=youtubedl_version,
+        ffmpeg_stats=k.get_ffmpeg_stats()[:10],
         is_pi=is_raspberry_pi,
         pikaraoke_version=VERSION,
         admin=is_admin(),
@@ -517,10 +746,16 @@ def info():
 # Delay system commands to allow redirect to render first
 def delayed_halt(cmd):
     time.sleep(1.5)
-    k.queue_clear()  
-    cherrypy.engine.stop()
-    cherrypy.engine.exit()
-    k.stop()
+    for room in all_rooms():
+        room.queue_clear()
+    if async_server:
+        async_server.stop()
+    elif not is_web_worker:
+        cherrypy.engine.stop()
+        cherrypy.engine.exit()
+    # in multi-process mode this stops the engine, which takes the web workers down with it
+    for room in all_rooms():
+        room.stop()
     if cmd == 0:
         sys.exit()
     if cmd == 1:
@@ -603,7 +838,7 @@ def expand_fs():
 
 
 # Handle sigterm, apparently cherrypy won't shut down without explicit handling
-signal.signal(signal.SIGTERM, lambda signum, stack_frame: k.stop())
+signal.signal(signal.SIGTERM, lambda signum, stack_frame: [room.stop() for room in all_rooms()])
 
 def get_default_youtube_dl_path(platform):
     if platform == "windows":
@@ -628,6 +863,44 @@ def get_default_dl_dir(platform):
             return "~/pikaraoke-songs"
 
 
+# Entry point of a web worker process in multi-process mode (see --web-workers). Workers share the
+# web port through SO_REUSEPORT and reach the playback engine through lib.engine_ipc.
+def run_web_worker(options):
+    global k, metrics, admin_password, slow_request_threshold, is_web_worker, thumbnail_dir
+    from lib.engine_ipc import RemoteKaraoke
+
+    setup_logging(int(options["log_level"]))
+    is_web_worker = True
+    # sessions and flash messages have to be readable by whichever worker gets the next request
+    app.secret_key = options["secret_key"]
+    admin_password = options["admin_password"]
+    thumbnail_dir = options["thumbnail_dir"]
+    slow_request_threshold = options["slow_request_threshold"]
+    app.jinja_env.globals.update(filename_from_path=filename_from_path)
+    app.jinja_env.globals.update(url_escape=quote)
+
+    k = RemoteKaraoke(options["address"], options["authkey"], options["snapshot_dir"])
+    metrics = MetricsCollector(k, interval=options["metrics_interval"], shared_dir=options["snapshot_dir"])
+    metrics.start()
+
+    server = cheroot.wsgi.Server(
+        ("0.0.0.0", options["port"]), app, numthreads=options["threads"], reuse_port=True
+    )
+    # the workers share the port, so one left behind by an engine that was killed would keep answering
+    # requests it can't serve
+    def watch_engine(engine_pid):
+        while os.getppid() == engine_pid:
+            time.sleep(1)
+        logging.warning("Engine process %d went away, stopping web worker %d" % (engine_pid, os.getpid()))
+        os._exit(1)
+
+    th = threading.Thread(target=watch_engine, args=[os.getppid()], daemon=True)
+    th.start()
+    # the engine terminates the workers when it quits, safe_start stops the server on SystemExit
+    signal.signal(signal.SIGTERM, lambda signum, stack_frame: sys.exit())
+    logging.info("Web worker %d listening on port %d" % (os.getpid(), options["port"]))
+    server.safe_start()
+
 if __name__ == "__main__":
 
     platform = get_platform()
@@ -638,8 +911,11 @@ if __name__ == "__main__":
     default_screensaver_delay = 300
     default_log_level = logging.INFO
     default_prefer_hostname = False
+    default_async_workers = 8
+    default_web_threads = 30
 
     default_dl_dir = get_default_dl_dir(platform)
+    default_data_dir = "~/.pikaraoke"
     default_youtubedl_path = get_default_youtube_dl_path(platform)
 
     # parse CLI args
@@ -673,6 +949,13 @@ if __name__ == "__main__":
         default=default_dl_dir,
         required=False,
     )
+    parser.add_argument(
+        "--library-root",
+        action="append",
+        help="Another directory with songs, e.g. a CDG archive on a USB disk or NFS share. Can be given several times. Append =POLICY to choose when it's rescanned: 'watched' when its files change (default), 'periodic' every hour or 'periodic:SECONDS', or 'manual' only from the admin's refresh, which keeps slow disks from being scanned on every startup. The download path is always watched.",
+        default=[],
+        required=False,
+    )
     parser.add_argument(
         "-y",
         "--youtubedl-path",
@@ -736,6 +1019,130 @@ if __name__ == "__main__":
         help="Download higher quality video. Note: requires ffmpeg and may cause CPU, download speed, and other performance issues",
         required=False,
     )
+    parser.add_argument(
+        "--normalize-downloads",
+        action="store_true",
+        help="Remux (or transcode once, if needed) downloaded songs into faststart H.264/AAC mp4 files in the background, so they can be played without live transcoding",
+        required=False,
+    )
+    parser.add_argument(
+        "--normalize-volume",
+        action="store_true",
+        help="Analyze the loudness of songs in the background and even out the volume between songs during playback",
+        required=False,
+    )
+    parser.add_argument(
+        "--adaptive-encoding",
+        action="store_true",
+        help="Measure the video encoders' speed on this machine and pick the encoder preset, resolution and bitrate of each transcoded song so playback keeps up with realtime",
+        required=False,
+    )
+    parser.add_argument(
+        "--thumbnails",
+        action="store_true",
+        help="Show a thumbnail of every video and CDG song when browsing. The thumbnails are extracted once per song by a background ffmpeg process and kept in the data path.",
+        required=False,
+    )
+    parser.add_argument(
+        "--thumbnail-cache-size",
+        help="Maximum size of the thumbnail cache in MB, the least recently shown thumbnails are removed beyond that and extracted again when shown (default: 200)",
+        default=200,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--download-budget",
+        help="Maximum size of the downloaded songs in GB. The least recently played downloads are removed to stay within it, songs played often are kept longer. Pinned songs, CDG songs and the songs of other library roots are never removed. (default: no limit)",
+        default=None,
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--min-free-space",
+        help="Free space in GB to keep on the disk of the download path, by removing downloads like --download-budget (default: no minimum)",
+        default=None,
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--storage-dry-run",
+        action="store_true",
+        help="Only log which downloads --download-budget and --min-free-space would remove, without removing them",
+        required=False,
+    )
+    parser.add_argument(
+        "--random-fill",
+        choices=fill_modes,
+        help="How 'add random songs' picks songs: 'uniform' picks every song alike, 'popular' prefers songs that were sung often, 'recent' prefers songs sung in the last weeks (default: popular)",
+        default="popular",
+        required=False,
+    )
+    parser.add_argument(
+        "--random-fill-exclude-hours",
+        help="Random songs are never picked if they were played within this many hours (default: 4)",
+        default=4,
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--duplicate-scan-workers",
+        help="Number of processes hashing songs when looking for duplicates from the Info page (default: 2)",
+        default=2,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--transcode-worker",
+        help="URL of a transcode worker (see transcode_worker.py) on a faster machine, e.g. http://192.168.1.20:5580. Songs that need transcoding (CDG, transposed, non-mp4) are streamed from the worker while it's reachable, and transcoded locally otherwise.",
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "--transcode-worker-token",
+        help="Shared secret of the transcode worker, the --token it was started with (default: $PIKARAOKE_WORKER_TOKEN)",
+        default=os.environ.get("PIKARAOKE_WORKER_TOKEN"),
+        required=False,
+    )
+    parser.add_argument(
+        "--playback-nice",
+        help="Nice level of the ffmpeg process that streams the current song (default: 5)",
+        default=5,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--background-nice",
+        help="Nice level of downloads and other background media processing (default: 15)",
+        default=15,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--cpu-affinity",
+        help="Comma separated list of CPU cores that ffmpeg and yt-dlp may use, e.g. '1,2,3' to keep core 0 free for the web server. Linux only",
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        help="Seconds between samples of the system stats served at /metrics and shown on the info page (default: 5)",
+        default=5,
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--slow-request-threshold",
+        help="Log requests that take longer than this many milliseconds, with a breakdown of where the time went. 0 disables it (default: 1000)",
+        default=1000,
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--data-path",
+        help="Path for pikaraoke's own data, such as caches. (default: %s)" % default_data_dir,
+        default=default_data_dir,
+        required=False,
+    )
     parser.add_argument(
         "--logo-path",
         nargs='+',
@@ -763,6 +1170,39 @@ if __name__ == "__main__":
         help="Hide overlay that shows on top of video with pikaraoke QR code and IP",
         required=False,
     ),
+    parser.add_argument(
+        "--server",
+        choices=["cherrypy", "async"],
+        help="Web server to use. 'async' serves connections from an event loop (requires uvicorn), which handles many idle phone connections with far fewer threads than the default CherryPy thread pool. (default: cherrypy)",
+        default="cherrypy",
+        required=False,
+    ),
+    parser.add_argument(
+        "--async-workers",
+        help="Number of threads running web requests when using --server async (default: %d)" % default_async_workers,
+        default=default_async_workers,
+        required=False,
+    ),
+    parser.add_argument(
+        "--web-workers",
+        help="Run the web server in this many separate processes, next to the process that plays the songs, so page loads don't compete with playback for python's GIL. Linux only. 0 serves everything from one process (default: 0)",
+        default=0,
+        type=int,
+        required=False,
+    ),
+    parser.add_argument(
+        "--web-threads",
+        help="Threads per web worker process when using --web-workers (default: %d)" % default_web_threads,
+        default=default_web_threads,
+        type=int,
+        required=False,
+    ),
+    parser.add_argument(
+        "--rooms",
+        help="Host several rooms from this server, as a comma separated list of room names, e.g. 'bar,lounge'. Every room has its own queue, splash screen and QR code under http://<address>:<port>/<room>/, and streams on its own ffmpeg port, counting up from --ffmpeg-port. The song library, searches and downloads are shared. (default: a single room)",
+        default=None,
+        required=False,
+    ),
     parser.add_argument(
         "--admin-password",
         help="Administrator password, for locking down certain features of the web UI such as queue editing, player controls, song editing, and system shutdown. If unspecified, everyone is an admin.",
@@ -772,16 +1212,39 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    if args.web_workers and args.server == "async":
+        print("--web-workers can't be combined with --server async")
+        sys.exit(1)
+
+    room_names = args.rooms.split(",") if args.rooms else []
+    if room_names:
+        if args.web_workers:
+            print("--rooms can't be combined with --web-workers")
+            sys.exit(1)
+        if args.ffmpeg_url:
+            print("--rooms can't be combined with --ffmpeg-url, every room streams on its own port")
+            sys.exit(1)
+        # room names become the first part of the room's urls, so they can't clash with the app's own
+        reserved = set(rule.rule.split("/")[1] for rule in app.url_map.iter_rules())
+        for name in room_names:
+            if not re.match(r"^[A-Za-z0-9_-]+$", name) or name in reserved or room_names.count(name) > 1:
+                print("Invalid room name: '%s'. Room names must be unique, only use letters, digits, '-' and '_', and can't be any of: %s" % (name, ", ".join(sorted(r for r in reserved if r))))
+                sys.exit(1)
+
     if (args.admin_password):
         admin_password = args.admin_password
 
+    if args.thumbnails:
+        thumbnail_dir = os.path.join(os.path.expanduser(args.data_path), "thumbnails")
+
     app.jinja_env.globals.update(filename_from_path=filename_from_path)
     app.jinja_env.globals.update(url_escape=quote)
 
 
     # check if required binaries exist
-    if not os.path.isfile(args.youtubedl_path):
-        print("Youtube-dl path not found! " + args.youtubedl_path)
+    youtubedl_path = arg_path_parse(args.youtubedl_path)
+    if not os.path.isfile(youtubedl_path):
+        print("Youtube-dl path not found! " + youtubedl_path)
         sys.exit(1)
 
     # setup/create download directory if necessary
@@ -792,6 +1255,21 @@ if __name__ == "__main__":
         print("Creating download path: " + dl_path)
         os.makedirs(dl_path)
 
+    library_roots = []
+    for spec in args.library_root:
+        try:
+            path, policy, interval = parse_root(spec)
+        except ValueError as e:
+            print("Invalid library root '%s': %s" % (spec, e))
+            sys.exit(1)
+        path = os.path.expanduser(path)
+        if not path.endswith("/"):
+            path += "/"
+        if not os.path.isdir(path):
+            print("Library root not found: " + path)
+            sys.exit(1)
+        library_roots.append((path, policy, interval))
+
     parsed_volume = float(args.volume)
     if parsed_volume > 1 or parsed_volume < 0:
         # logging.warning("Volume must be between 0 and 1. Setting to default: %s" % default_volume)
@@ -799,25 +1277,117 @@ if __name__ == "__main__":
         parsed_volume = default_volume
 
     # Configure karaoke process
+    def create_karaoke(ffmpeg_port, room=None, primary=None):
+        return karaoke.Karaoke(
+            port=args.port,
+            ffmpeg_port=ffmpeg_port,
+            download_path=dl_path,
+            library_roots=library_roots,
+            youtubedl_path=youtubedl_path,
+            splash_delay=args.splash_delay,
+            log_level=args.log_level,
+            volume=parsed_volume,
+            hide_url=args.hide_url,
+            hide_raspiwifi_instructions=args.hide_raspiwifi_instructions,
+            high_quality=args.high_quality,
+            logo_path=arg_path_parse(args.logo_path),
+            hide_overlay=args.hide_overlay,
+            screensaver_timeout=args.screensaver_timeout,
+            url=args.url,
+            ffmpeg_url=args.ffmpeg_url,
+            prefer_hostname=args.prefer_hostname,
+            normalize_downloads=args.normalize_downloads,
+            normalize_volume=args.normalize_volume,
+            adaptive_encoding=args.adaptive_encoding,
+            thumbnails=args.thumbnails,
+            thumbnail_cache_size=args.thumbnail_cache_size,
+            transcode_worker=args.transcode_worker,
+            transcode_worker_token=args.transcode_worker_token,
+            download_budget=int(args.download_budget * 1024 ** 3) if args.download_budget is not None else None,
+            min_free_space=int(args.min_free_space * 1024 ** 3) if args.min_free_space is not None else None,
+            storage_dry_run=args.storage_dry_run,
+            random_fill=args.random_fill,
+            random_fill_exclude_hours=args.random_fill_exclude_hours,
+            duplicate_scan_workers=args.duplicate_scan_workers,
+            playback_nice=args.playback_nice,
+            background_nice=args.background_nice,
+            cpu_affinity=[int(c) for c in args.cpu_affinity.split(",")] if args.cpu_affinity else None,
+            data_path=os.path.expanduser(args.data_path),
+            room=room,
+            primary=primary,
+        )
+
     global k
-    k = karaoke.Karaoke(
-        port=args.port,
-        ffmpeg_port=args.ffmpeg_port,
-        download_path=dl_path,
-        youtubedl_path=arg_path_parse(args.youtubedl_path),
-        splash_delay=args.splash_delay,
-        log_level=args.log_level,
-        volume=parsed_volume,
-        hide_url=args.hide_url,
-        hide_raspiwifi_instructions=args.hide_raspiwifi_instructions,
-        high_quality=args.high_quality,
-        logo_path=arg_path_parse(args.logo_path),
-        hide_overlay=args.hide_overlay,
-        screensaver_timeout=args.screensaver_timeout,
-        url=args.url,
-        ffmpeg_url=args.ffmpeg_url,
-        prefer_hostname=args.prefer_hostname
-    )
+    if room_names:
+        # the first room creates the library, download manager and process supervisor the others share
+        for i, name in enumerate(room_names):
+            rooms[name] = create_karaoke(int(args.ffmpeg_port) + i, name, rooms.get(room_names[0]))
+        k = LocalProxy(get_room)
+        app.wsgi_app = RoomDispatcher(app.wsgi_app, room_names)
+    else:
+        k = create_karaoke(args.ffmpeg_port)
+
+    slow_request_threshold = args.slow_request_threshold / 1000.0
+
+    if args.web_workers > 0:
+        from lib.engine_ipc import EngineHost
+
+        # keep the frequently rewritten snapshots in memory where possible, rather than on the SD card
+        run_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        snapshot_dir = tempfile.mkdtemp(prefix="pikaraoke-", dir=run_dir)
+        engine = EngineHost(k, snapshot_dir)
+        engine.start()
+        options = {
+            "address": engine.address,
+            "authkey": engine.authkey,
+            "snapshot_dir": snapshot_dir,
+            "port": int(args.port),
+            "threads": args.web_threads,
+            "secret_key": os.urandom(24),
+            "admin_password": admin_password,
+            "thumbnail_dir": thumbnail_dir,
+            "slow_request_threshold": slow_request_threshold,
+            "metrics_interval": args.metrics_interval,
+            "log_level": args.log_level,
+        }
+        # spawn rather than fork, the engine already runs threads
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=run_web_worker, args=(options,), daemon=True) for i in range(args.web_workers)]
+        for worker in workers:
+            worker.start()
+        k.run()
+
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        engine.stop()
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        sys.exit()
+
+    metrics = MetricsCollector(k, interval=args.metrics_interval)
+    metrics.start()
+
+    if args.server == "async":
+        try:
+            import uvicorn
+        except ImportError:
+            print("--server async requires uvicorn. Install it with: pip install uvicorn")
+            sys.exit(1)
+        from lib.async_server import AsyncServer
+
+        # Start the event loop web server. /nowplaying is polled by every client, so it's answered
+        # directly from the event loop and supports long polling.
+        async_server = AsyncServer(
+            app,
+            port=int(args.port),
+            workers=int(args.async_workers),
+            state_routes={"/nowplaying": get_now_playing},
+        )
+        async_server.start()
+        run_rooms()
+
+        async_server.stop()
+        sys.exit()
 
     # Start the CherryPy WSGI web server
     cherrypy.tree.graft(app, "/")
@@ -832,7 +1402,7 @@ if __name__ == "__main__":
         }
     )
     cherrypy.engine.start()
-    k.run()
+    run_rooms()
 
     cherrypy.engine.exit()
     sys.exit()
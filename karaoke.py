@@ -1,43 +1,39 @@
 import contextlib
-import json
 import logging
 import os
-import random
 import socket
-import subprocess
 import time
-from pathlib import Path
-from queue import Empty, Queue
-from subprocess import CalledProcessError, check_output
-from threading import Thread
+from subprocess import check_output
+from threading import Event, Thread
 from urllib.parse import urlparse
 
-import ffmpeg
 import qrcode
-from unidecode import unidecode
 
-from lib.file_resolver import FileResolver
+from lib.disk_quota import DiskQuota
+from lib.downloads import DownloadManager
+from lib.duplicates import DuplicateFinder
+from lib.encode_profiles import EncodeProfiles
+from lib.ffmpeg_stats import FfmpegStatsLog
 from lib.get_platform import get_platform
+from lib.library import Library
+from lib.logs import get_recent_logs, setup_logging
+from lib.loudness import LoudnessAnalyzer, get_player_gain
+from lib.media_normalizer import MediaNormalizer
+from lib.metadata import MetadataIndex
+from lib.play_history import PlayHistory
+from lib.process_supervisor import ProcessSupervisor
+from lib.random_fill import RandomFill
+from lib.thumbnails import ThumbnailGenerator
+from lib.transcoder import LocalTranscoder, RemoteTranscoder, get_song_files
+from lib.transition_trace import TransitionTracer
 
 
-# Support function for reading  lines from ffmpeg stderr without blocking
-def enqueue_output(out, queue):
-    for line in iter(out.readline, b''):
-        queue.put(line)
-    out.close()
-
-def decode_ignore(input):
-    return input.decode("utf-8", "ignore").strip()
-
 class Karaoke:
 
     raspi_wifi_config_ip = "10.0.0.1"
     raspi_wifi_conf_file = "/etc/raspiwifi/raspiwifi.conf"
     raspi_wifi_config_installed = os.path.exists(raspi_wifi_conf_file)
 
-    queue = []
-    available_songs = []
-
     # These all get sent to the /nowplaying endpoint for client-side polling
     now_playing = None
     now_playing_filename = None
@@ -45,6 +41,12 @@ class Karaoke:
     now_playing_transpose = 0
     now_playing_url = None
     now_playing_command = None
+    now_playing_gain = 1.0  # loudness normalization gain applied by the splash screen player
+    now_playing_offset = 0  # in seconds into the song, where the current stream starts
+    now_playing_position = None  # in seconds into the stream, as last reported by the splash screen
+    position_reported_at = 0
+    resume_request = None  # (semitones, offset) to restart the current song's stream with, see resume
+    resuming_until = 0  # the previous stream ending is ignored until then, while the player switches over
 
     is_playing = False
     is_paused = True
@@ -53,16 +55,18 @@ class Karaoke:
     base_path = os.path.dirname(__file__)
     volume = None
     loop_interval = 500  # in milliseconds
+    resume_timeout = 10  # in seconds, for the splash screen to switch over to a resumed stream
     default_logo_path = os.path.join(base_path, "logo.png")
     screensaver_timeout = 300 # in seconds
 
-    ffmpeg_process = None
+    transcode = None  # the song being streamed, see lib.transcoder
 
     def __init__(
         self,
         port=5555,
         ffmpeg_port=5556,
         download_path="/usr/lib/pikaraoke/songs",
+        library_roots=None,
         hide_url=False,
         hide_raspiwifi_instructions=False,
         high_quality=False,
@@ -75,7 +79,26 @@ class Karaoke:
         screensaver_timeout = 300,
         url=None,
         ffmpeg_url=None,
-        prefer_hostname=True
+        prefer_hostname=True,
+        normalize_downloads=False,
+        normalize_volume=False,
+        adaptive_encoding=False,
+        thumbnails=False,
+        thumbnail_cache_size=200,
+        transcode_worker=None,
+        transcode_worker_token=None,
+        download_budget=None,
+        min_free_space=None,
+        storage_dry_run=False,
+        random_fill="popular",
+        random_fill_exclude_hours=4,
+        duplicate_scan_workers=2,
+        playback_nice=5,
+        background_nice=15,
+        cpu_affinity=None,
+        data_path=os.path.expanduser("~/.pikaraoke"),
+        room=None,
+        primary=None,
     ):
 
         # override with supplied constructor args if provided
@@ -84,6 +107,7 @@ class Karaoke:
         self.hide_url = hide_url
         self.hide_raspiwifi_instructions = hide_raspiwifi_instructions
         self.download_path = download_path
+        self.library_roots = library_roots or []
         self.high_quality = high_quality
         self.splash_delay = int(splash_delay)
         self.volume = volume
@@ -93,19 +117,124 @@ class Karaoke:
         self.screensaver_timeout = screensaver_timeout
         self.url_override = url
         self.prefer_hostname = prefer_hostname
+        self.normalize_downloads = normalize_downloads
+        self.normalize_volume = normalize_volume
+        self.adaptive_encoding = adaptive_encoding
+        self.thumbnails_enabled = thumbnails
+        self.thumbnail_cache_size = thumbnail_cache_size
+        self.transcode_worker = transcode_worker
+        self.transcode_worker_token = transcode_worker_token
+        self.download_budget = download_budget
+        self.min_free_space = min_free_space
+        self.data_path = data_path
+        self.ffmpeg_url_override = ffmpeg_url
+        self.room = room
+
+        setup_logging(int(log_level))
 
         # other initializations
         self.platform = get_platform()
         self.screen = None
-
-        logging.basicConfig(
-            format="[%(asctime)s] %(levelname)s: %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-            level=int(log_level),
+        self.queue = []
+        if primary:
+            # another room hosted by the same server, which only needs its own queue and playback
+            self.supervisor = primary.supervisor
+            self.media_normalizer = primary.media_normalizer
+            self.loudness_analyzer = primary.loudness_analyzer
+            self.thumbnails = primary.thumbnails
+            self.encode_profiles = primary.encode_profiles
+            self.library = primary.library
+            self.play_history = primary.play_history
+            self.disk_quota = primary.disk_quota
+            self.duplicates = primary.duplicates
+            self.metadata = primary.metadata
+            self.rooms = primary.rooms
+            self.downloads = primary.downloads
+        else:
+            # all ffmpeg, ffprobe and yt-dlp processes are started through the supervisor
+            self.supervisor = ProcessSupervisor(
+                nice={"playback": playback_nice, "background": background_nice}, cpu_affinity=cpu_affinity
+            )
+            self.loudness_analyzer = (
+                LoudnessAnalyzer(os.path.join(self.data_path, "loudness.json"), supervisor=self.supervisor)
+                if self.normalize_volume
+                else None
+            )
+            self.thumbnails = (
+                ThumbnailGenerator(
+                    os.path.join(self.data_path, "thumbnails"),
+                    max_size=self.thumbnail_cache_size,
+                    supervisor=self.supervisor,
+                )
+                if self.thumbnails_enabled
+                else None
+            )
+            # shows the last known song list until the rescan finishes. Downloads go to the first root.
+            self.library = Library(
+                [(self.download_path, "watched", None)] + self.library_roots,
+                os.path.join(self.data_path, "library"),
+                self.loudness_analyzer,
+                self.thumbnails,
+            )
+            self.play_history = PlayHistory(os.path.join(self.data_path, "play_history.jsonl"))
+            self.library.add_listener(self.play_history.move)
+            self.disk_quota = None
+            if self.download_budget is not None or self.min_free_space is not None:
+                self.disk_quota = DiskQuota(
+                    self.library,
+                    self.play_history,
+                    os.path.join(self.data_path, "pinned.json"),
+                    budget=self.download_budget,
+                    min_free=self.min_free_space,
+                    dry_run=storage_dry_run,
+                )
+                self.library.add_listener(self.disk_quota.move)
+            self.rooms = []  # all rooms sharing the library, see get_songs_in_use
+            self.duplicates = DuplicateFinder(
+                self.library,
+                os.path.join(self.data_path, "content_hashes.json"),
+                workers=duplicate_scan_workers,
+                nice=background_nice,
+            )
+            self.metadata = MetadataIndex(os.path.join(self.data_path, "metadata"))
+            self.media_normalizer = (
+                MediaNormalizer(on_normalized=self.library.replace_song, supervisor=self.supervisor)
+                if self.normalize_downloads
+                else None
+            )
+            self.encode_profiles = (
+                EncodeProfiles(os.path.join(self.data_path, "encoders.json"), self.platform, supervisor=self.supervisor)
+                if self.adaptive_encoding
+                else None
+            )
+            self.downloads = DownloadManager(
+                self.youtubedl_path,
+                self.library,
+                self.supervisor,
+                high_quality=self.high_quality,
+                media_normalizer=self.media_normalizer,
+                disk_quota=self.disk_quota,
+                metadata=self.metadata,
+            )
+        self.library.add_listener(self.handle_normalized_song)
+        self.rooms.append(self)
+        if self.disk_quota:
+            self.disk_quota.add_in_use_check(self.is_song_in_use)
+        self.ffmpeg_stats = FfmpegStatsLog()
+        self.transition_tracer = TransitionTracer()
+        self.random_fill = RandomFill(self.play_history, random_fill, random_fill_exclude_hours * 3600)
+        self.transcoder = LocalTranscoder(
+            self.supervisor, self.platform, self.ffmpeg_stats, self.encode_profiles, scope=self.room
         )
+        if self.transcode_worker:
+            # songs that need transcoding go to the worker while it's reachable
+            self.transcoder = RemoteTranscoder(
+                self.transcode_worker, self.transcoder, self.ffmpeg_stats, token=self.transcode_worker_token
+            )
 
         logging.debug(
             f"""
+    room: {self.room}
     http port: {self.port}
     ffmpeg port {self.ffmpeg_port}
     hide URL: {self.hide_url}
@@ -115,13 +244,92 @@ class Karaoke:
     splash_delay: {self.splash_delay}
     screensaver_timeout: {self.screensaver_timeout}
     high quality video: {self.high_quality}
+    normalize downloads: {self.normalize_downloads}
+    normalize volume: {self.normalize_volume}
+    adaptive encoding: {self.adaptive_encoding}
+    thumbnails: {self.thumbnails_enabled}
+    transcode worker: {self.transcode_worker}
+    download budget: {self.download_budget}
+    min free space: {self.min_free_space}
+    storage dry run: {storage_dry_run}
+    random fill: {random_fill}, excluding songs played in the last {random_fill_exclude_hours}h
+    playback nice: {playback_nice}
+    background nice: {background_nice}
+    cpu affinity: {cpu_affinity}
+    data path: {self.data_path}
     download path: {self.download_path}
+    library roots: {self.library_roots}
     default volume: {self.volume}
     youtube-dl path: {self.youtubedl_path}
     logo path: {self.logo_path}
     log_level: {log_level}
     hide overlay: {self.hide_overlay}
 """)
+        # Slow startup work runs in the background so the web server and splash screen can come up
+        # right away. Each phase reports its readiness through startup_events.
+        self.startup_events = {"network": Event()}
+
+        # provisional connection URL, replaced once the network task resolves the final one
+        self.ip = self.get_ip()
+        self.set_url(self.ip)
+
+        self.run_startup_task("network", self.init_network)
+        if primary:
+            self.startup_events["library"] = primary.startup_events["library"]
+            self.startup_events["youtubedl"] = primary.startup_events["youtubedl"]
+        else:
+            self.startup_events["library"] = Event()
+            self.startup_events["youtubedl"] = Event()
+            self.run_startup_task("library", self.library.start)
+            self.run_startup_task("youtubedl", self.get_youtubedl_version)
+            # songs play with the default encoder settings until the calibration is available
+            if self.encode_profiles:
+                self.encode_profiles.calibrate_in_background()
+
+    # the song list is shared with the other rooms, see lib.library
+    @property
+    def available_songs(self):
+        return self.library.songs
+
+    @property
+    def youtubedl_version(self):
+        return self.downloads.youtubedl_version
+
+    def run_startup_task(self, name, target):
+        def task():
+            start_time = time.time()
+            try:
+                target()
+            except Exception as e:
+                logging.error("Startup phase '%s' failed: %s" % (name, e))
+            self.startup_events[name].set()
+            logging.info("Startup phase '%s' finished in %.2fs" % (name, time.time() - start_time))
+
+        t = Thread(target=task, name="startup-" + name)
+        t.daemon = True
+        t.start()
+
+    def is_ready(self):
+        return all(e.is_set() for e in self.startup_events.values())
+
+    def get_ffmpeg_stats(self):
+        return self.ffmpeg_stats.to_list()
+
+    # None while nothing plays or when the song is transcoded on another machine
+    def get_ffmpeg_pid(self):
+        transcode = self.transcode
+        return transcode.pid if transcode and transcode.is_running() else None
+
+    def get_transition_stats(self):
+        return {"summary": self.transition_tracer.get_summary(), "transitions": self.transition_tracer.to_list()}
+
+    def get_process_stats(self):
+        return self.supervisor.get_stats()
+
+    def get_startup_status(self):
+        return {name: e.is_set() for name, e in self.startup_events.items()}
+
+    def init_network(self):
         # Generate connection URL and QR code, 
         if self.platform == "raspberry_pi":
             #retry in case pi is still starting up
@@ -133,36 +341,33 @@ class Karaoke:
                 self.ip = addresses[0]
                 if not self.is_network_connected():
                     logging.debug("Couldn't get IP, retrying....")
+                    time.sleep(1)
                 else:
                     break
         else:
             self.ip = self.get_ip()
 
-        logging.debug("IP address (for QR code and splash screen): " + self.ip)
+        logging.debug("IP address (for QR code and splash screen): %s", self.ip)
+        self.set_url(self.ip, resolve_hostname=self.prefer_hostname)
+        self.generate_qr_code()
 
+    def set_url(self, ip, resolve_hostname=False):
         if self.url_override != None:
-            logging.debug("Overriding URL with " + self.url_override)
+            logging.debug("Overriding URL with %s", self.url_override)
             self.url = self.url_override
         else:
-            if (self.prefer_hostname):
+            if (resolve_hostname):
                 self.url = f"http://{socket.getfqdn().lower()}:{self.port}"
             else:
-                self.url = f"http://{self.ip}:{self.port}" 
+                self.url = f"http://{ip}:{self.port}" 
+        if self.room:
+            self.url = self.url.rstrip("/") + "/" + self.room
         self.url_parsed = urlparse(self.url)
-        if ffmpeg_url is None:
+        if self.ffmpeg_url_override is None:
             self.ffmpeg_url = f"{self.url_parsed.scheme}://{self.url_parsed.hostname}:{self.ffmpeg_port}"
         else:
-            self.ffmpeg_url = ffmpeg_url
+            self.ffmpeg_url = self.ffmpeg_url_override
 
-        # get songs from download_path
-        self.get_available_songs()
-
-        self.get_youtubedl_version()
-
-        self.generate_qr_code()
-   
-
- 
     # Other ip-getting methods are unreliable and sometimes return 127.0.0.1
     # https://stackoverflow.com/a/28950776
     def get_ip(self):
@@ -203,34 +408,10 @@ class Karaoke:
         return (server_port, ssid_prefix, ssl_enabled)
 
     def get_youtubedl_version(self):
-        self.youtubedl_version = (
-            check_output([self.youtubedl_path, "--version"]).strip().decode("utf8")
-        )
-        return self.youtubedl_version
+        return self.downloads.get_youtubedl_version()
 
     def upgrade_youtubedl(self):
-        logging.info(
-            "Upgrading youtube-dl, current version: %s" % self.youtubedl_version
-        )
-        try:  
-            output = check_output([self.youtubedl_path, "-U"], stderr=subprocess.STDOUT).decode("utf8").strip()
-        except CalledProcessError as e:
-            output = e.output.decode("utf8")
-        logging.info(output)
-        if "You installed yt-dlp with pip or using the wheel from PyPi" in output:
-            try:
-                logging.info("Attempting youtube-dl upgrade via pip3...")
-                output = check_output(
-                    ["pip3", "install", "--upgrade", "yt-dlp"]
-                ).decode("utf8")
-            except FileNotFoundError:
-                logging.info("Attempting youtube-dl upgrade via pip...")
-                output = check_output(
-                    ["pip", "install", "--upgrade", "yt-dlp"]
-                ).decode("utf8")
-            logging.info(output)
-        self.get_youtubedl_version()
-        logging.info("Done. New version: %s" % self.youtubedl_version)
+        self.downloads.upgrade_youtubedl()
 
     def is_network_connected(self):
         return not len(self.ip) < 7
@@ -245,98 +426,236 @@ class Karaoke:
         qr.add_data(self.url)
         qr.make()
         img = qr.make_image()
-        self.qr_code_path = os.path.join(self.base_path, "qrcode.png")
+        filename = "qrcode-%s.png" % self.room if self.room else "qrcode.png"
+        self.qr_code_path = os.path.join(self.base_path, filename)
         img.save(self.qr_code_path)
 
+    # Songs in the library whose file name contains the query, followed by those whose title, artist,
+    # channel or tags match it, as [{"path", "fileName", "keywords"}]
+    def search_library(self, query, limit=None):
+        q = query.lower()
+        songs = self.available_songs
+        paths = [each for each in songs if q in each.lower()]
+        found = set(paths)
+        paths += [each for each in self.metadata.search(query, songs, limit or len(songs)) if each not in found]
+        return [
+            {"path": each, "fileName": self.filename_from_path(each), "keywords": self.metadata.get_keywords(each)}
+            for each in paths[:limit]
+        ]
+
     def get_search_results(self, textToSearch):
-        logging.info("Searching YouTube for: " + textToSearch)
-        num_results = 10
-        yt_search = 'ytsearch%d:"%s"' % (num_results, unidecode(textToSearch))
-        cmd = [self.youtubedl_path, "-j", "--no-playlist", "--flat-playlist", yt_search]
-        logging.debug("Youtube-dl search command: " + " ".join(cmd))
-        try:
-            output = subprocess.check_output(cmd).decode("utf-8", "ignore")
-            logging.debug("Search results: " + output)
-            rc = []
-            for each in output.split("\n"):
-                if len(each) > 2:
-                    j = json.loads(each)
-                    if (not "title" in j) or (not "url" in j):
-                        continue
-                    rc.append([j["title"], j["url"], j["id"]])
-            return rc
-        except Exception as e:
-            logging.debug("Error while executing search: " + str(e))
-            raise e
+        return self.downloads.search(textToSearch)
 
     def get_karaoke_search_results(self, songTitle):
         return self.get_search_results(songTitle + " karaoke")
 
+    def get_download_stats(self):
+        return self.downloads.get_stats()
+
     def download_video(self, video_url, enqueue=False, user="Pikaraoke"):
-        logging.info("Downloading video: " + video_url)
-        dl_path = self.download_path + "%(title)s---%(id)s.%(ext)s"
-        file_quality = (
-            "bestvideo[ext!=webm][height<=1080]+bestaudio[ext!=webm]/best[ext!=webm]"
-            if self.high_quality
-            else "mp4"
-        )
-        cmd = [self.youtubedl_path, "-f", file_quality, "-o", dl_path, video_url]
-        logging.debug("Youtube-dl command: " + " ".join(cmd))
-        rc = subprocess.call(cmd)
-        if rc != 0:
-            logging.error("Error code while downloading, retrying once...")
-            rc = subprocess.call(cmd)  # retry once. Seems like this can be flaky
-        if rc == 0:
-            logging.debug("Song successfully downloaded: " + video_url)
-            self.get_available_songs()
-            if enqueue:
-                y = self.get_youtube_id_from_url(video_url)
-                s = self.find_song_by_youtube_id(y)
-                if s:
-                    self.enqueue(s, user)
-                else:
-                    logging.error("Error queueing song: " + video_url)
-        else:
-            logging.error("Error downloading song: " + video_url)
+        rc, song_path = self.downloads.download(video_url)
+        if rc == 0 and enqueue:
+            if song_path:
+                self.enqueue(song_path, user)
+            else:
+                logging.error("Error queueing song: " + video_url)
         return rc
 
+    # rescans every library root, including the manual ones
     def get_available_songs(self):
-        logging.info("Fetching available songs in: " + self.download_path)
-        types = ['.mp4', '.mp3', '.zip', '.mkv', '.avi', '.webm', '.mov']
-        files_grabbed = []
-        P=Path(self.download_path)
-        for file in P.rglob('*.*'):
-            base, ext = os.path.splitext(file.as_posix())
-            if ext.lower() in types:
-                if os.path.isfile(file.as_posix()):
-                    logging.debug("adding song: " + file.name)
-                    files_grabbed.append(file.as_posix())
-
-        self.available_songs = sorted(files_grabbed, key=lambda f: str.lower(os.path.basename(f)))
+        self.library.scan()
+
+    # Point any references to a song at its normalized replacement
+    def handle_normalized_song(self, old_path, new_path):
+        for each in self.queue:
+            if each["file"] == old_path:
+                each["file"] = new_path
+        if self.now_playing_filename == old_path:
+            self.now_playing_filename = new_path
 
     def delete(self, song_path):
-        logging.info("Deleting song: " + song_path)
-        with contextlib.suppress(FileNotFoundError):
-            os.remove(song_path)
-        ext = os.path.splitext(song_path)
-        # if we have an associated cdg file, delete that too
-        cdg_file = song_path.replace(ext[1],".cdg")
-        if (os.path.exists(cdg_file)):
-            os.remove(cdg_file)
-        
-        self.get_available_songs()
+        return self.update_files(deletes=[song_path])
 
     def rename(self, song_path, new_name):
-        logging.info("Renaming song: '" + song_path + "' to: " + new_name)
-        ext = os.path.splitext(song_path)
-        if len(ext) == 2:
-            new_file_name = new_name + ext[1]
-        os.rename(song_path, self.download_path + new_file_name)
-        # if we have an associated cdg file, rename that too
-        cdg_file = song_path.replace(ext[1],".cdg")
-        if (os.path.exists(cdg_file)):
-            os.rename(cdg_file, self.download_path + new_name + ".cdg")
-        self.get_available_songs()
+        return self.update_files(renames=[(song_path, new_name)])
+
+    # Songs queued or playing in any room
+    def get_songs_in_use(self):
+        songs = set()
+        for room in self.rooms:
+            songs.update(each["file"] for each in room.queue)
+            if room.now_playing_filename:
+                songs.add(room.now_playing_filename)
+        return songs
+
+    # Deletes and renames songs along with their .cdg files, and updates the library once for all of
+    # them. deletes are song paths, renames are [(song path, new name without the extension)]. All
+    # operations are checked against the queues up front, and the ones that can't be done are left out.
+    # No file of the kept songs or of the renamed songs gets deleted along with another song.
+    # Returns {"deleted": [song path], "renamed": [(old path, new path)], "errors": [(song path, error)]}.
+    def update_files(self, deletes=(), renames=(), keeps=()):
+        in_use = self.get_songs_in_use()
+        errors = []
+        touched = set()  # songs of an earlier operation in the batch
+        new_paths = set()
+        kept_files = set()
+        for song_path in list(keeps) + [song_path for song_path, new_name in renames]:
+            with contextlib.suppress(OSError):
+                kept_files.update(get_song_files(song_path))
+
+        def check(song_path):
+            if song_path in in_use:
+                return "Song is in the queue"
+            if song_path in touched:
+                return "Song is changed twice"
+            if not os.path.isfile(song_path):
+                return "Song not found"
+            return None
+
+        valid_deletes = []
+        for song_path in deletes:
+            error = check(song_path)
+            if error is None and not kept_files.isdisjoint(get_song_files(song_path)):
+                error = "Song shares files with a kept song"
+            if error:
+                errors.append((song_path, error))
+                continue
+            touched.add(song_path)
+            valid_deletes.append(song_path)
+
+        valid_renames = []
+        for song_path, new_name in renames:
+            error = check(song_path)
+            new_name = new_name.strip()
+            ext = os.path.splitext(song_path)[1]
+            new_path = os.path.join(os.path.dirname(song_path), new_name + ext)
+            if error is None:
+                if not new_name or "/" in new_name or os.sep in new_name:
+                    error = "Invalid name"
+                elif new_path in new_paths or os.path.exists(new_path):
+                    error = "Filename already exists"
+                elif len(get_song_files(song_path)) > 1 and os.path.exists(os.path.splitext(new_path)[0] + ".cdg"):
+                    error = "Filename of the .cdg file already exists"
+            if error:
+                errors.append((song_path, error))
+                continue
+            touched.add(song_path)
+            new_paths.add(new_path)
+            valid_renames.append((song_path, new_path))
+
+        deleted = []
+        for song_path in valid_deletes:
+            logging.info("Deleting song: " + song_path)
+            try:
+                self.remove_song_files(song_path)
+            except OSError as e:
+                errors.append((song_path, str(e)))
+                continue
+            deleted.append(song_path)
+
+        renamed = []
+        for song_path, new_path in valid_renames:
+            logging.info("Renaming song: '" + song_path + "' to: " + new_path)
+            try:
+                self.rename_song_files(song_path, new_path)
+            except OSError as e:
+                errors.append((song_path, str(e)))
+                continue
+            renamed.append((song_path, new_path))
+
+        for song_path, error in errors:
+            logging.warning("Could not change %s: %s" % (song_path, error))
+        if deleted or renamed:
+            self.library.update(
+                removed=deleted + [old for old, new in renamed], added=[new for old, new in renamed]
+            )
+        for old_path, new_path in renamed:
+            self.play_history.move(old_path, new_path)
+            if self.disk_quota:
+                self.disk_quota.move(old_path, new_path)
+        return {"deleted": deleted, "renamed": renamed, "errors": errors}
+
+    # the song and, for an mp3, its .cdg file
+    def remove_song_files(self, song_path):
+        for file_path in get_song_files(song_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file_path)
+
+    def rename_song_files(self, song_path, new_path):
+        files = get_song_files(song_path)
+        os.rename(song_path, new_path)
+        for file_path in files[1:]:
+            os.rename(file_path, os.path.splitext(new_path)[0] + ".cdg")
+
+    # Starts looking for songs with the same content in the background, see lib.duplicates
+    def scan_duplicates(self):
+        return self.duplicates.start_scan()
+
+    # The duplicates found by the last scan, with what the admin needs to pick the song to keep
+    def get_duplicates(self):
+        in_use = self.get_songs_in_use()
+        clusters = []
+        for cluster in self.duplicates.get_clusters():
+            songs = []
+            for song_path in cluster:
+                history = self.play_history.get(song_path) or {"count": 0, "last_played": None}
+                with contextlib.suppress(OSError):
+                    songs.append(
+                        {
+                            "file": song_path,
+                            "size": os.path.getsize(song_path),
+                            "play_count": history["count"],
+                            "last_played": history["last_played"],
+                            "pinned": self.is_song_pinned(song_path),
+                            "in_use": song_path in in_use,
+                        }
+                    )
+            # the song most worth keeping first
+            songs.sort(key=lambda s: (not s["pinned"], -s["play_count"]))
+            clusters.append(songs)
+        return {"clusters": clusters, **self.duplicates.get_status()}
+
+    # Removes duplicate songs, given as [(song path, kept song path)], see update_files. A removed song's
+    # play history and pin go to the kept song, unless that's None. Returns the songs removed.
+    def merge_duplicates(self, merges):
+        kept = dict(merges)
+        result = self.update_files(
+            deletes=[song_path for song_path, kept_path in merges if song_path != kept_path],
+            keeps=[kept_path for song_path, kept_path in merges if kept_path],
+        )
+        for song_path in result["deleted"]:
+            if kept[song_path]:
+                self.play_history.move(song_path, kept[song_path])
+                if self.disk_quota:
+                    self.disk_quota.move(song_path, kept[song_path])
+        return result["deleted"]
+
+    # Thumbnail keys of the songs that have one, see lib.thumbnails
+    def get_thumbnails(self, song_paths):
+        if self.thumbnails is None:
+            return {}
+        return self.thumbnails.get_keys(song_paths)
+
+    # What the disk quota would remove to make room for the next download, see lib.disk_quota
+    def get_storage_report(self):
+        if self.disk_quota is None:
+            return None
+        return self.disk_quota.plan(self.disk_quota.get_reserve())
+
+    def has_disk_quota(self):
+        return self.disk_quota is not None
+
+    # Recent log records of this process, newest first, see lib.logs
+    def get_logs(self, level=logging.NOTSET, limit=500):
+        return get_recent_logs(level, limit)
+
+    def is_song_pinned(self, song_path):
+        return self.disk_quota is not None and self.disk_quota.is_pinned(song_path)
+
+    # Pinned downloads are never removed to stay within the storage budget
+    def set_song_pinned(self, song_path, pinned):
+        if self.disk_quota:
+            self.disk_quota.set_pinned(song_path, pinned)
 
     def filename_from_path(self, file_path):
         rc = os.path.basename(file_path)
@@ -345,136 +664,147 @@ class Karaoke:
         return rc
 
     def find_song_by_youtube_id(self, youtube_id):
-        for each in self.available_songs:
-            if youtube_id in each:
-                return each
-        logging.error("No available song found with youtube id: " + youtube_id)
-        return None
-
-    def get_youtube_id_from_url(self, url):
-        s = url.split("watch?v=")
-        if len(s) == 2:
-            return s[1]
-        else:
-            logging.error("Error parsing youtube id from url: " + url)
-            return None
+        return self.library.find_by_youtube_id(youtube_id)
 
-    def play_file(self, file_path, semitones=0):
-        logging.info(f"Playing file: {file_path} transposed {semitones} semitones")
-        stream_uid = int(time.time())
+    # Stops the current stream and starts ffmpeg streaming the song from offset seconds in. Returns the
+    # gain the player should apply.
+    def start_transcode(self, file_path, semitones, offset=0):
+        # in milliseconds, so a song restarted within the same second still gets a new stream url
+        stream_uid = int(time.time() * 1000)
         stream_url = f"{self.ffmpeg_url}/{stream_uid}"
         # pass a 0.0.0.0 IP to ffmpeg which will work for both hostnames and direct IP access
         ffmpeg_url = f"http://0.0.0.0:{self.ffmpeg_port}/{stream_uid}"
 
-        pitch = 2**(semitones/12) #The pitch value is (2^x/12), where x represents the number of semitones
+        # Apply loudness normalization. If the audio gets re-encoded anyway (transposed or CDG), the gain
+        # is baked into that encode, otherwise the stream stays copied and the player scales its volume
+        # within its headroom.
+        gain_db = self.loudness_analyzer.get_gain_db(file_path) if self.loudness_analyzer else None
+
+        self.kill_ffmpeg()
+        self.transcode = self.transcoder.start(file_path, semitones, ffmpeg_url, stream_url, gain_db, offset=offset)
+
+        if not self.loudness_analyzer:
+            return 1.0
+        return get_player_gain(None if self.transcode.audio_reencoded else gain_db)
 
+    def play_file(self, file_path, semitones=0):
+        logging.info(f"Playing file: {file_path} transposed {semitones} semitones")
         try:
-            fr = FileResolver(file_path)
+            client_gain = self.start_transcode(file_path, semitones)
         except Exception as e:
             logging.error("Error resolving file: " + str(e))
             self.queue.pop(0)
+            self.transition_tracer.finish("failed")
             return False
+        self.transition_tracer.mark("ffmpeg_spawned")
+
+        if self.transcode.wait_until_ready():
+            logging.debug("Stream ready!")
+            self.transition_tracer.mark("stream_ready")
+            self.now_playing = self.filename_from_path(file_path)
+            self.now_playing_filename = file_path
+            self.now_playing_transpose = semitones
+            self.now_playing_gain = client_gain
+            self.now_playing_url = self.transcode.stream_url
+            self.now_playing_user=self.queue[0]["user"]
+            self.is_paused = False
+            self.queue.pop(0)
 
-        # use h/w acceleration on pi
-        default_vcodec = "h264_v4l2m2m" if self.platform == "raspberry_pi" else "libx264" 
-        # just copy the video stream if it's an mp4 or webm file, since they are supported natively in html5 
-        # otherwise use the default h264 codec
-        vcodec = "copy" if fr.file_extension == ".mp4" or fr.file_extension == ".webm" else default_vcodec
-        vbitrate = "5M" #seems to yield best results w/ h264_v4l2m2m on pi, recommended for 720p.
-
-        # copy the audio stream if no transposition, otherwise use the aac codec
-        is_transposed = semitones != 0
-        acodec = "aac" if is_transposed else "copy"
-        input = ffmpeg.input(fr.file_path)
-        audio = input.audio.filter("rubberband", pitch=pitch) if is_transposed else input.audio
-
-        if (fr.cdg_file_path != None): #handle CDG files
-            logging.info("Playing CDG/MP3 file: " + file_path)
-            # copyts helps with sync issues, fps=25 prevents ffmpeg from needlessly encoding cdg at 300fps
-            cdg_input = ffmpeg.input(fr.cdg_file_path, copyts=None)
-            video = cdg_input.video.filter("fps", fps=25)
-            #cdg is very fussy about these flags. pi needs to encode to aac and cant just copy the mp3 stream
-            output = ffmpeg.output(audio, video, ffmpeg_url, 
-                                   vcodec=vcodec, acodec="aac", 
-                                   pix_fmt="yuv420p", listen=1, f="mp4", video_bitrate=vbitrate,
-                                   movflags="frag_keyframe+default_base_moof")     
-        else: 
-            video = input.video
-            output = ffmpeg.output(audio, video, ffmpeg_url, 
-                                   vcodec=vcodec, acodec=acodec, 
-                                   listen=1, f="mp4", video_bitrate=vbitrate,
-                                   movflags="frag_keyframe+default_base_moof")
-        
-        args = output.get_args()
-        logging.debug(f"COMMAND: ffmpeg " + " ".join(args))
-
-        self.kill_ffmpeg()
-    
-        self.ffmpeg_process = output.run_async(pipe_stderr=True, pipe_stdin=True)
-
-        # ffmpeg outputs everything useful to stderr for some insane reason!
-        # prevent reading stderr from being a blocking action
-        q = Queue()
-        t = Thread(target=enqueue_output, args=(self.ffmpeg_process.stderr, q))
-        t.daemon = True
-        t.start()
-
-        while self.ffmpeg_process.poll() is None:
-            try:  
-                output = q.get_nowait() 
-                logging.debug("[FFMPEG] " + decode_ignore(output))
-            except Empty:
-                pass
-            else: 
-                if  "Stream #" in decode_ignore(output):
-                    logging.debug("Stream ready!")
-                    # Ffmpeg outputs "Stream #0" when the stream is ready to consume
-                    self.now_playing = self.filename_from_path(file_path)
-                    self.now_playing_filename = file_path
-                    self.now_playing_transpose = semitones
-                    self.now_playing_url = stream_url
-                    self.now_playing_user=self.queue[0]["user"]
-                    self.is_paused = False
-                    self.queue.pop(0)
-
-                    # Keep logging output until the splash screen reports back that the stream is playing
-                    max_retries = 100
-                    while self.is_playing == False and max_retries > 0:
-                        time.sleep(0.1) #prevents loop from trying to replay track
-                        try:  
-                            output = q.get_nowait() 
-                            logging.debug("[FFMPEG] " + decode_ignore(output))
-                        except Empty:
-                            pass
-                        max_retries -= 1
-                    if self.is_playing:
-                        logging.debug("Stream is playing")
-                        break
-                    else:   
-                        logging.error("Stream was not playable! Run with debug logging to see output. Skipping track")
-                        self.end_song()
-                        break
+            # Keep logging output until the splash screen reports back that the stream is playing
+            max_retries = 100
+            while self.is_playing == False and max_retries > 0:
+                self.transcode.log_output(0.1) #prevents loop from trying to replay track
+                max_retries -= 1
+            if self.is_playing:
+                logging.debug("Stream is playing")
+            else:
+                logging.error("Stream was not playable! Run with debug logging to see output. Skipping track")
+                self.transition_tracer.finish("failed")
+                self.end_song()
+
+    # Restarts the current song's stream as requested by transpose_current or restart. The song keeps
+    # playing meanwhile and the splash screen switches over to the new stream once it's ready, so only
+    # the rest of the song gets transcoded and the singer carries on where they were.
+    def resume(self):
+        semitones, offset = self.resume_request
+        self.resume_request = None
+        if not self.is_file_playing():
+            return
+        logging.info("Resuming %s at %.1fs transposed %d semitones", self.now_playing, offset, semitones)
+        # the player may see the old stream end before it switches over
+        self.resuming_until = time.time() + self.resume_timeout
+        try:
+            client_gain = self.start_transcode(self.now_playing_filename, semitones, offset)
+        except Exception as e:
+            logging.error("Error resolving file: " + str(e))
+            self.resuming_until = 0
+            self.end_song()
+            return
+        if not self.transcode.wait_until_ready():
+            logging.error("Stream was not playable! Run with debug logging to see output. Skipping track")
+            self.resuming_until = 0
+            self.end_song()
+            return
+        self.now_playing_transpose = semitones
+        self.now_playing_offset = offset
+        self.now_playing_position = None
+        self.now_playing_gain = client_gain
+        self.now_playing_url = self.transcode.stream_url
+
+    # The splash screen reports how many seconds into the stream at stream_url it is
+    def report_position(self, position, stream_url=None):
+        if stream_url == self.now_playing_url:
+            self.now_playing_position = position
+            self.position_reported_at = time.time()
+
+    # Seconds into the current song the player is at, or None if nothing is playing
+    def get_position(self):
+        if not self.is_file_playing():
+            return None
+        position = self.now_playing_offset
+        if self.now_playing_position is not None:
+            position += self.now_playing_position
+            if not self.is_paused:
+                position += time.time() - self.position_reported_at
+        return position
 
     def kill_ffmpeg(self):
         logging.debug("Killing ffmpeg process")
-        if self.ffmpeg_process:
-            self.ffmpeg_process.kill()
+        if self.transcode:
+            self.transcode.stop()
 
     def start_song(self):
         logging.info(f"Song starting: {self.now_playing}" )
+        self.resuming_until = 0  # the player is on the current stream
+        if not self.is_playing:
+            self.play_history.record(
+                self.now_playing_filename, self.now_playing_user, self.room, self.now_playing_transpose
+            )
         self.is_playing = True
+        self.transition_tracer.finish()
+
+    # the splash screen's player loaded the first frame of the stream
+    def video_loaded(self):
+        self.transition_tracer.mark("first_frame")
 
     def end_song(self):
+        if time.time() < self.resuming_until:
+            logging.debug("Ignoring the end of the previous stream of: %s", self.now_playing)
+            return
         logging.info(f"Song ending: {self.now_playing}" )
+        self.transition_tracer.begin("song_end")
         self.reset_now_playing()
         self.kill_ffmpeg()
         logging.debug("ffmpeg process killed")
 
     def transpose_current(self, semitones):
+        if not self.is_file_playing():
+            logging.warning("Tried to transpose, but no file is playing!")
+            return False
         logging.info(f"Transposing current song {self.now_playing} by {semitones} semitones")
-        # Insert the same song at the top of the queue with transposition
-        self.enqueue(self.now_playing_filename, self.now_playing_user, semitones, True)
-        self.skip()
+        # the run loop restarts the stream in the new key where the player is now
+        self.resume_request = (semitones, round(self.get_position(), 1))
+        return True
 
     def is_file_playing(self):
         return self.is_playing
@@ -485,6 +815,9 @@ class Karaoke:
                 return True
         return False
 
+    def is_song_in_use(self, song_path):
+        return song_path == self.now_playing_filename or self.is_song_in_queue(song_path)
+
     def enqueue(self, song_path, user="Pikaraoke", semitones=0, add_to_front=False):
         if (self.is_song_in_queue(song_path)):
             logging.warn("Song is already in queue, will not add: " + song_path)   
@@ -501,22 +834,18 @@ class Karaoke:
 
     def queue_add_random(self, amount):
         logging.info("Adding %d random songs to queue" % amount)
-        songs = list(self.available_songs)  # make a copy
+        songs = self.available_songs
         if len(songs) == 0:
             logging.warn("No available songs!")
             return False
-        i = 0
-        while i < amount:
-            r = random.randint(0, len(songs) - 1)
-            if self.is_song_in_queue(songs[r]):
-                logging.warn("Song already in queue, trying another... " + songs[r])
-            else:
-                self.enqueue(songs[r], "Randomizer")
-                i += 1
-            songs.pop(r)
-            if len(songs) == 0:
-                logging.warn("Ran out of songs!")
-                return False
+        exclude = set(each["file"] for each in self.queue)
+        exclude.add(self.now_playing_filename)
+        picked = self.random_fill.pick(songs, amount, exclude)
+        for song in picked:
+            self.enqueue(song, "Randomizer")
+        if len(picked) < amount:
+            logging.warn("Ran out of songs!")
+            return False
         return True
 
     def queue_clear(self):
@@ -564,9 +893,14 @@ class Karaoke:
             logging.error("Unrecognized direction: " + action)
             return False
 
+    def clear_command(self):
+        self.now_playing_command = None
+
     def skip(self):
         if self.is_file_playing():
             logging.info("Skipping: " + self.now_playing)
+            self.resume_request = None
+            self.resuming_until = 0
             self.now_playing_command = "skip"
             return True
         else:
@@ -585,14 +919,14 @@ class Karaoke:
         
     def volume_change(self, vol_level):
         self.volume = vol_level
-        logging.debug(f"Setting volume to: {self.volume}")
+        logging.debug("Setting volume to: %s", self.volume)
         if self.is_file_playing():
             self.now_playing_command = f"volume_change: {self.volume}"
         return True
 
     def vol_up(self):
         self.volume += 0.1
-        logging.debug(f"Increasing volume by 10%: {self.volume}")
+        logging.debug("Increasing volume by 10%%: %s", self.volume)
         if self.is_file_playing():
             self.now_playing_command = "vol_up"
             return True
@@ -602,7 +936,7 @@ class Karaoke:
 
     def vol_down(self):
         self.volume -= 0.1
-        logging.debug(f"Decreasing volume by 10%: {self.volume}")
+        logging.debug("Decreasing volume by 10%%: %s", self.volume)
         if self.is_file_playing():
             self.now_playing_command = "vol_down"
             return True
@@ -612,7 +946,11 @@ class Karaoke:
 
     def restart(self):
         if self.is_file_playing():
-            self.now_playing_command = "restart"
+            if self.now_playing_offset:
+                # the stream starts partway into the song, so it can't be rewound by the player
+                self.resume_request = (self.now_playing_transpose, 0)
+            else:
+                self.now_playing_command = "restart"
             return True
         else:
             logging.warning("Tried to restart, but no file is playing!")
@@ -632,23 +970,37 @@ class Karaoke:
         self.is_paused = True
         self.is_playing = False
         self.now_playing_transpose = 0
+        self.now_playing_gain = 1.0
+        self.now_playing_offset = 0
+        self.now_playing_position = None
+        self.resume_request = None
 
     def run(self):
-        logging.info("Starting PiKaraoke!")
+        logging.info("Starting PiKaraoke!" if self.room is None else "Starting PiKaraoke room: " + self.room)
+        # the stream URLs handed to the player depend on the resolved network address
+        self.startup_events["network"].wait()
         logging.info(f"Connect the player host to: {self.url}/splash")
         self.running = True
         while self.running:
             try:
+                if self.resume_request is not None:
+                    self.resume()
                 if not self.is_file_playing() and self.now_playing != None:
                     self.reset_now_playing()
                 if len(self.queue) > 0:
                     if not self.is_file_playing():
                         self.reset_now_playing()
+                        if not self.transition_tracer.is_active():
+                            self.transition_tracer.begin("queued")
+                        self.transition_tracer.mark("splash_delay")
                         i = 0
                         while i < (self.splash_delay * 1000):
                             self.handle_run_loop()
                             i += self.loop_interval
+                        self.transition_tracer.mark("play_file", self.queue[0]["file"])
                         self.play_file(self.queue[0]["file"], self.queue[0]["semitones"])
+                elif not self.is_file_playing():
+                    self.transition_tracer.cancel()
                 self.handle_run_loop()
             except KeyboardInterrupt:
                 logging.warn("Keyboard interrupt: Exiting pikaraoke...")
@@ -0,0 +1,169 @@
+import asyncio
+import io
+import json
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+# Routes which shell out to yt-dlp or rescan the library and can block for a long time. They get their
+# own small thread pool so a burst of searches can't starve the rest of the web UI.
+blocking_routes = ["/search", "/download", "/update_ytdl", "/refresh", "/profile"]
+long_poll_timeout = 20  # in seconds
+long_poll_interval = 0.25  # in seconds
+
+
+# Event loop based alternative to the CherryPy thread pool server, built on uvicorn (ASGI).
+# Connections, including the many idle keep-alive connections of phones polling the UI, live on a single
+# event loop thread. The Flask app itself runs on a bounded thread pool, and polling routes registered in
+# `state_routes` are answered straight from the event loop. Those also support long polling: when the
+# client passes the last "hash" it saw, the response is held until the state changes.
+class AsyncServer:
+    def __init__(self, wsgi_app, host="0.0.0.0", port=5555, workers=8, blocking_workers=2, state_routes=None):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wsgi")
+        self.blocking_executor = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix="wsgi-blocking")
+        # maps a route to a callable taking the request's query arguments and returning a json serializable
+        # dict containing a "hash" key. Rechecks while long polling pass no arguments, so whatever the
+        # route does with them happens once per request.
+        self.state_routes = state_routes or {}
+        self.server = None
+
+    def start(self):
+        import uvicorn
+
+        config = uvicorn.Config(
+            self,
+            host=self.host,
+            port=self.port,
+            lifespan="off",
+            access_log=False,
+            log_level="warning",
+            timeout_keep_alive=long_poll_timeout,
+        )
+        self.server = uvicorn.Server(config)
+        t = threading.Thread(target=self.server.run, name="async-server")
+        t.daemon = True
+        t.start()
+        logging.info("Started async server on %s:%s" % (self.host, self.port))
+
+    def stop(self):
+        if self.server:
+            self.server.should_exit = True
+        self.executor.shutdown(wait=False)
+        self.blocking_executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        path = scope["path"]
+        if path in self.state_routes:
+            await self.handle_state_route(scope, send, self.state_routes[path])
+        elif any(path.startswith(route) for route in blocking_routes):
+            await self.handle_wsgi(scope, receive, send, self.blocking_executor)
+        else:
+            await self.handle_wsgi(scope, receive, send, self.executor)
+
+    async def handle_state_route(self, scope, send, get_state):
+        query = parse_qs(scope["query_string"].decode("latin1"))
+        args = {key: values[0] for key, values in query.items()}
+        last_hash = args.get("hash")
+        try:
+            state = get_state(args)
+            waited = 0
+            while last_hash and state["hash"] == last_hash and waited < long_poll_timeout:
+                await asyncio.sleep(long_poll_interval)
+                waited += long_poll_interval
+                state = get_state({})
+            body = json.dumps(state).encode("utf-8")
+        except Exception as e:
+            logging.error("Problem loading %s, pikaraoke may still be starting up: %s" % (scope["path"], e))
+            body = b""
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def handle_wsgi(self, scope, receive, send, executor):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        loop = asyncio.get_running_loop()
+        environ = self.build_environ(scope, body)
+        status, headers, iterable = await loop.run_in_executor(executor, self.run_wsgi_app, environ)
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+
+        # stream the response body, reading each chunk on the worker pool in case the app generates it lazily
+        iterator = iter(iterable)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if hasattr(iterable, "close"):
+                await loop.run_in_executor(executor, iterable.close)
+        await send({"type": "http.response.body", "body": b""})
+
+    def run_wsgi_app(self, environ):
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(k.encode("latin1"), v.encode("latin1")) for k, v in headers]
+            return written.append
+
+        iterable = self.wsgi_app(environ, start_response)
+        if written:
+            # legacy write() callable was used, send its output ahead of the returned iterable
+            iterable = written + list(iterable)
+        return response["status"], response["headers"], iterable
+
+    def build_environ(self, scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope["query_string"].decode("latin1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        if scope.get("client"):
+            environ["REMOTE_ADDR"] = scope["client"][0]
+        for name, value in scope["headers"]:
+            name = name.decode("latin1")
+            value = value.decode("latin1")
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+                continue
+            if name == "content-length":
+                continue
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import re
+import shutil
+from threading import Lock
+
+# files yt-dlp downloaded, see DownloadManager.run_download
+downloaded_file_pattern = re.compile(r"---[A-Za-z0-9_-]{11}\.[A-Za-z0-9]+$")
+# CDG songs are never removed, even when they were named like a download
+protected_types = [".zip", ".mp3", ".cdg"]
+play_bonus = 7 * 24 * 3600  # in seconds, each play makes a song count as played this much more recently
+max_bonus_plays = 10
+default_reserve = 100 * 1024 * 1024  # in bytes, room made for a download before any sizes are known
+
+
+# Keeps the downloaded songs within a storage budget and the download disk above a minimum of free
+# space, by removing the least recently used downloads. Only songs yt-dlp downloaded into the download
+# path can be removed, never the songs of other library roots, CDG songs, pinned songs or songs that are
+# queued or playing in any room. Songs played often are kept longer than their last play alone would
+# suggest: every play, up to max_bonus_plays, counts as if the song was played play_bonus later.
+class DiskQuota:
+    def __init__(self, library, play_history, pinned_path, budget=None, min_free=None, dry_run=False):
+        self.library = library
+        self.play_history = play_history
+        self.pinned_path = pinned_path
+        self.budget = budget  # in bytes, for all downloaded songs
+        self.min_free = min_free  # in bytes, on the disk of the download path
+        self.dry_run = dry_run
+        self.lock = Lock()
+        self.in_use_checks = []
+        self.pinned = set()
+        self.load_pinned()
+
+    # callback(song_path) tells whether a song is queued or playing
+    def add_in_use_check(self, callback):
+        self.in_use_checks.append(callback)
+
+    def load_pinned(self):
+        try:
+            with open(self.pinned_path, "r", encoding="utf-8") as f:
+                self.pinned = set(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read pinned songs: " + str(e))
+
+    def save_pinned(self):
+        try:
+            os.makedirs(os.path.dirname(self.pinned_path), exist_ok=True)
+            tmp_path = self.pinned_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(sorted(self.pinned), f)
+            os.replace(tmp_path, self.pinned_path)
+        except OSError as e:
+            logging.warning("Could not save pinned songs: " + str(e))
+
+    def set_pinned(self, song_path, pinned):
+        with self.lock:
+            if pinned:
+                self.pinned.add(song_path)
+            else:
+                self.pinned.discard(song_path)
+            self.save_pinned()
+
+    def is_pinned(self, song_path):
+        return song_path in self.pinned
+
+    # callback for Library.add_listener, and for renamed songs
+    def move(self, old_path, new_path):
+        if old_path in self.pinned:
+            self.set_pinned(old_path, False)
+            self.set_pinned(new_path, True)
+
+    def is_download(self, song_path):
+        return (
+            self.library.get_root(song_path) is self.library.roots[0]
+            and downloaded_file_pattern.search(os.path.basename(song_path)) is not None
+            and os.path.splitext(song_path)[1].casefold() not in protected_types
+        )
+
+    def is_removable(self, song_path):
+        return (
+            self.is_download(song_path)
+            and not self.is_pinned(song_path)
+            and not any(check(song_path) for check in self.in_use_checks)
+        )
+
+    # [(path, size, mtime)] of the downloaded songs
+    def get_downloads(self):
+        downloads = []
+        for song_path in self.library.roots[0].songs:
+            if self.is_download(song_path):
+                try:
+                    st = os.stat(song_path)
+                except OSError:
+                    continue
+                downloads.append((song_path, st.st_size, st.st_mtime))
+        return downloads
+
+    # Expected size of the next download, the average of the current ones
+    def get_reserve(self):
+        sizes = [size for path, size, mtime in self.get_downloads()]
+        return sum(sizes) // len(sizes) if sizes else default_reserve
+
+    # The time a song counts as last used for eviction, later is kept longer
+    def get_last_used(self, song_path, mtime):
+        history = self.play_history.get(song_path)
+        if history is None:
+            return mtime  # when it was downloaded
+        return max(history["last_played"], mtime) + min(history["count"], max_bonus_plays) * play_bonus
+
+    # Works out which songs to remove to make room for reserve more bytes, without removing anything. The
+    # song keep is never removed.
+    def plan(self, reserve=0, keep=None):
+        downloads = self.get_downloads()
+        used = sum(size for path, size, mtime in downloads)
+        free = shutil.disk_usage(self.library.download_path).free
+        needed = 0
+        if self.budget is not None:
+            needed = max(needed, used + reserve - self.budget)
+        if self.min_free is not None:
+            needed = max(needed, self.min_free + reserve - free)
+
+        evict = []
+        freed = 0
+        if needed > 0:
+            candidates = sorted(
+                (self.get_last_used(path, mtime), path, size)
+                for path, size, mtime in downloads
+                if path != keep and self.is_removable(path)
+            )
+            for last_used, path, size in candidates:
+                if freed >= needed:
+                    break
+                history = self.play_history.get(path) or {"count": 0, "last_played": None}
+                evict.append(
+                    {"file": path, "size": size, "play_count": history["count"], "last_played": history["last_played"]}
+                )
+                freed += size
+        return {
+            "budget": self.budget,
+            "min_free": self.min_free,
+            "used": used,
+            "free": free,
+            "downloads": len(downloads),
+            "pinned": len(self.pinned),
+            "reserve": reserve,
+            "needed": needed,
+            "evict": evict,
+            "freed": freed,
+            "short": max(needed - freed, 0),
+        }
+
+    # Removes the songs plan() picks, returns the plan
+    def enforce(self, reserve=0, keep=None):
+        with self.lock:
+            plan = self.plan(reserve, keep)
+            if not plan["evict"]:
+                if plan["short"] > 0:
+                    logging.warning("Storage budget exceeded by %d MB, but no downloaded song can be removed" % (plan["short"] // 1024 // 1024))
+                return plan
+            if self.dry_run:
+                for each in plan["evict"]:
+                    logging.info("Dry run, would remove: %s (%d MB)" % (each["file"], each["size"] // 1024 // 1024))
+                return plan
+
+            removed = []
+            for each in plan["evict"]:
+                logging.info("Removing least recently used download: %s (%d MB)" % (each["file"], each["size"] // 1024 // 1024))
+                try:
+                    os.remove(each["file"])
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error("Could not remove %s: %s" % (each["file"], e))
+                    continue
+                removed.append(each["file"])
+            self.library.update(removed=removed)
+            logging.info("Freed %d MB by removing %d downloads" % (plan["freed"] // 1024 // 1024, len(removed)))
+            if plan["short"] > 0:
+                logging.warning("Storage budget still exceeded by %d MB" % (plan["short"] // 1024 // 1024))
+            return plan
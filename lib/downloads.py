@@ -0,0 +1,207 @@
+import json
+import logging
+import subprocess
+import time
+from collections import OrderedDict
+from subprocess import CalledProcessError, check_output
+from threading import Event, Lock
+
+from unidecode import unidecode
+
+
+# Runs the yt-dlp searches and downloads of every room on the server. Search results are cached for a
+# while, so the same search from several phones or rooms runs yt-dlp once, and a video that gets
+# requested again while it's still downloading is only downloaded once.
+class DownloadManager:
+    search_timeout = 60  # in seconds
+    download_timeout = 900  # in seconds
+
+    def __init__(
+        self,
+        youtubedl_path,
+        library,
+        supervisor,
+        high_quality=False,
+        media_normalizer=None,
+        disk_quota=None,
+        metadata=None,
+        search_cache_seconds=600,
+        max_cached_searches=100,
+    ):
+        self.youtubedl_path = youtubedl_path
+        self.library = library
+        self.supervisor = supervisor
+        self.high_quality = high_quality
+        self.media_normalizer = media_normalizer
+        self.disk_quota = disk_quota
+        self.metadata = metadata
+        self.search_cache_seconds = search_cache_seconds
+        self.max_cached_searches = max_cached_searches
+        self.youtubedl_version = None
+        self.lock = Lock()
+        self.search_cache = OrderedDict()  # search -> (time, results), least recently used first
+        self.pending = {}  # video url -> download in progress
+        self.stats = {"active": 0, "completed": 0, "failed": 0}
+
+    def get_youtubedl_version(self):
+        self.youtubedl_version = (
+            self.supervisor.check_output([self.youtubedl_path, "--version"], "yt-dlp", "interactive", timeout=30)
+            .strip()
+            .decode("utf8")
+        )
+        return self.youtubedl_version
+
+    def upgrade_youtubedl(self):
+        logging.info(
+            "Upgrading youtube-dl, current version: %s" % self.youtubedl_version
+        )
+        try:
+            output = (
+                self.supervisor.check_output([self.youtubedl_path, "-U"], "yt-dlp", timeout=300, stderr=subprocess.STDOUT)
+                .decode("utf8")
+                .strip()
+            )
+        except CalledProcessError as e:
+            output = e.output.decode("utf8")
+        logging.info(output)
+        if "You installed yt-dlp with pip or using the wheel from PyPi" in output:
+            try:
+                logging.info("Attempting youtube-dl upgrade via pip3...")
+                output = check_output(
+                    ["pip3", "install", "--upgrade", "yt-dlp"]
+                ).decode("utf8")
+            except FileNotFoundError:
+                logging.info("Attempting youtube-dl upgrade via pip...")
+                output = check_output(
+                    ["pip", "install", "--upgrade", "yt-dlp"]
+                ).decode("utf8")
+            logging.info(output)
+        self.get_youtubedl_version()
+        logging.info("Done. New version: %s" % self.youtubedl_version)
+
+    def get_cached_search(self, textToSearch):
+        with self.lock:
+            cached = self.search_cache.get(textToSearch)
+            if cached is None:
+                return None
+            if time.time() - cached[0] > self.search_cache_seconds:
+                del self.search_cache[textToSearch]
+                return None
+            self.search_cache.move_to_end(textToSearch)
+            return cached[1]
+
+    def search(self, textToSearch):
+        rc = self.get_cached_search(textToSearch)
+        if rc is not None:
+            logging.debug("Using cached search results for: %s", textToSearch)
+            return rc
+        logging.info("Searching YouTube for: " + textToSearch)
+        num_results = 10
+        yt_search = 'ytsearch%d:"%s"' % (num_results, unidecode(textToSearch))
+        cmd = [self.youtubedl_path, "-j", "--no-playlist", "--flat-playlist", yt_search]
+        logging.debug("Youtube-dl search command: %s", " ".join(cmd))
+        try:
+            output = self.supervisor.check_output(cmd, "yt-dlp", "interactive", timeout=self.search_timeout)
+            output = output.decode("utf-8", "ignore")
+            logging.debug("Search results: %s", output)
+            rc = []
+            for each in output.split("\n"):
+                if len(each) > 2:
+                    j = json.loads(each)
+                    if (not "title" in j) or (not "url" in j):
+                        continue
+                    rc.append([j["title"], j["url"], j["id"]])
+        except Exception as e:
+            logging.debug("Error while executing search: %s", e)
+            raise e
+        with self.lock:
+            self.search_cache[textToSearch] = (time.time(), rc)
+            while len(self.search_cache) > self.max_cached_searches:
+                self.search_cache.popitem(last=False)
+        return rc
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def update_stats(self, **changes):
+        with self.lock:
+            for key, change in changes.items():
+                self.stats[key] += change
+
+    # Downloads the video into the library. Returns yt-dlp's exit code and the path of the downloaded
+    # song, or None if it couldn't be found in the library afterwards.
+    def download(self, video_url):
+        with self.lock:
+            pending = self.pending.get(video_url)
+            is_new = pending is None
+            if is_new:
+                pending = self.pending[video_url] = {"done": Event(), "result": (-1, None)}
+        if not is_new:
+            logging.info("Already downloading, waiting for that download: " + video_url)
+            pending["done"].wait()
+            return pending["result"]
+
+        self.update_stats(active=1)
+        try:
+            pending["result"] = self.run_download(video_url)
+        finally:
+            rc = pending["result"][0]
+            self.update_stats(active=-1, **{"completed" if rc == 0 else "failed": 1})
+            with self.lock:
+                del self.pending[video_url]
+            pending["done"].set()
+        return pending["result"]
+
+    def call_youtubedl(self, cmd):
+        try:
+            return self.supervisor.run(cmd, "yt-dlp", timeout=self.download_timeout).returncode
+        except subprocess.TimeoutExpired:
+            return -1
+
+    def run_download(self, video_url):
+        logging.info("Downloading video: " + video_url)
+        dl_path = self.library.download_path + "%(title)s---%(id)s.%(ext)s"
+        file_quality = (
+            "bestvideo[ext!=webm][height<=1080]+bestaudio[ext!=webm]/best[ext!=webm]"
+            if self.high_quality
+            else "mp4"
+        )
+        # the file's modification time is taken as its download time, see DiskQuota.get_last_used
+        cmd = [self.youtubedl_path, "-f", file_quality, "--no-mtime", "-o", dl_path]
+        if self.metadata:
+            # keep the video's metadata for searching the library
+            cmd += ["--write-info-json", "-o", self.metadata.get_output_template()]
+        cmd.append(video_url)
+        logging.debug("Youtube-dl command: %s", " ".join(cmd))
+        if self.disk_quota:
+            # make room for the download first, a full disk would make it fail halfway
+            self.disk_quota.enforce(reserve=self.disk_quota.get_reserve())
+        rc = self.call_youtubedl(cmd)
+        if rc != 0:
+            logging.error("Error code while downloading, retrying once...")
+            rc = self.call_youtubedl(cmd)  # retry once. Seems like this can be flaky
+        if rc != 0:
+            logging.error("Error downloading song: " + video_url)
+            return rc, None
+        logging.debug("Song successfully downloaded: %s", video_url)
+        self.library.scan_downloads()
+        y = self.get_youtube_id_from_url(video_url)
+        s = self.library.find_by_youtube_id(y) if y else None
+        if self.disk_quota:
+            # the new song isn't queued yet, so it has to be kept explicitly
+            self.disk_quota.enforce(keep=s)
+        if y and self.metadata:
+            self.metadata.ingest(y)
+        if s and self.media_normalizer:
+            # normalize in the background, the song stays playable in its original form meanwhile
+            self.media_normalizer.submit(s)
+        return rc, s
+
+    def get_youtube_id_from_url(self, url):
+        s = url.split("watch?v=")
+        if len(s) == 2:
+            return s[1]
+        else:
+            logging.error("Error parsing youtube id from url: " + url)
+            return None
@@ -0,0 +1,169 @@
+import contextlib
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock, Thread
+
+from lib.song_cache import SongCache
+from lib.transcoder import get_song_files
+
+partial_size = 64 * 1024  # in bytes, read from the start and the end of every file for the partial hash
+read_size = 1024 * 1024  # in bytes
+part_types = [".mp3", ".cdg"]  # of the files in a zipped CDG archive that make up the song
+default_workers = 2
+
+
+# The files a song is made of as [(size, file object)], in the same order for a zipped CDG archive as
+# for a loose mp3 and cdg, so the same song compares equal however it's packaged
+@contextlib.contextmanager
+def open_parts(song_path):
+    with contextlib.ExitStack() as stack:
+        if os.path.splitext(song_path)[1].casefold() == ".zip":
+            zip_ref = stack.enter_context(zipfile.ZipFile(song_path, "r"))
+            members = [i for i in zip_ref.infolist() if os.path.splitext(i.filename)[1].casefold() in part_types]
+            members.sort(key=lambda i: os.path.splitext(i.filename)[1].casefold())
+            yield [(i.file_size, stack.enter_context(zip_ref.open(i))) for i in members]
+        else:
+            paths = sorted(get_song_files(song_path), key=lambda p: os.path.splitext(p)[1].casefold())
+            yield [(os.path.getsize(p), stack.enter_context(open(p, "rb"))) for p in paths]
+
+
+# Total size of the song's files, which is cheap to get: zip archives list their members' sizes
+def get_content_size(song_path):
+    if os.path.splitext(song_path)[1].casefold() == ".zip":
+        with zipfile.ZipFile(song_path, "r") as zip_ref:
+            return sum(i.file_size for i in zip_ref.infolist() if os.path.splitext(i.filename)[1].casefold() in part_types)
+    return sum(os.path.getsize(p) for p in get_song_files(song_path))
+
+
+# Hash of the song's content. The partial hash only reads the start and the end of every file, which
+# tells apart almost all songs of the same size. Runs in the worker processes.
+def hash_song(song_path, full=False):
+    digest = hashlib.sha1()
+    try:
+        with open_parts(song_path) as parts:
+            for size, f in parts:
+                digest.update(b"%d:" % size)
+                if full or size <= 2 * partial_size:
+                    for chunk in iter(lambda: f.read(read_size), b""):
+                        digest.update(chunk)
+                else:
+                    digest.update(f.read(partial_size))
+                    f.seek(size - partial_size)
+                    digest.update(f.read(partial_size))
+    except (OSError, zipfile.BadZipFile) as e:
+        logging.warning("Could not hash %s: %s" % (song_path, e))
+        return None
+    return digest.hexdigest()
+
+
+def hash_song_full(song_path):
+    return hash_song(song_path, full=True)
+
+
+def lower_priority(nice):
+    if hasattr(os, "nice"):
+        os.nice(nice)
+
+
+# Finds songs in the library with the same content, e.g. a song downloaded twice under different names,
+# or as a zipped CDG archive and as a loose mp3 and cdg. A scan runs in the background and only hashes
+# songs that share their size with another song, first partially and then fully for the songs whose
+# partial hashes match too, spread over a pool of worker processes. Sizes and hashes are cached by the
+# song's path, size and modification time, so later scans only hash new songs.
+class DuplicateFinder:
+    def __init__(self, library, cache_file, workers=default_workers, nice=0):
+        self.library = library
+        self.cache = SongCache(cache_file)
+        self.workers = workers
+        self.nice = nice  # of the worker processes
+        self.lock = Lock()
+        self.scanning = False
+        self.progress = None
+        self.scanned_at = None
+        self.clusters = []  # [[song path]] of songs with the same content
+
+    def start_scan(self):
+        with self.lock:
+            if self.scanning:
+                return False
+            self.scanning = True
+        Thread(target=self.run_scan, daemon=True, name="duplicates").start()
+        return True
+
+    def run_scan(self):
+        try:
+            self.scan()
+        except Exception as e:
+            logging.error("Duplicate scan failed: " + str(e))
+        finally:
+            self.progress = None
+            self.scanning = False
+
+    def scan(self):
+        start_time = time.time()
+        songs = self.library.songs
+        entries = {}
+        self.progress = "sizes"
+        for song_path in songs:
+            entry = self.cache.get(song_path)
+            if entry is None:
+                try:
+                    entry = {"size": get_content_size(song_path), "partial": None, "full": None}
+                except (OSError, zipfile.BadZipFile):
+                    continue
+                self.cache.set(song_path, entry)
+            entries[song_path] = entry
+
+        candidates = self.find_candidates(entries, ["size"])
+        self.hash(entries, [p for p in candidates if entries[p]["partial"] is None], "partial", hash_song)
+        candidates = self.find_candidates(entries, ["size", "partial"], candidates)
+        self.hash(entries, [p for p in candidates if entries[p]["full"] is None], "full", hash_song_full)
+        clusters = self.group(entries, ["size", "full"], candidates)
+
+        self.cache.prune(songs)
+        self.cache.save()
+        self.clusters = sorted(clusters, key=lambda c: str.lower(os.path.basename(c[0])))
+        self.scanned_at = time.time()
+        logging.info(
+            "Found %d duplicate songs among %d songs in %.1fs"
+            % (sum(len(c) - 1 for c in clusters), len(songs), time.time() - start_time)
+        )
+
+    # groups of songs with the same values of the keys, with songs that match no other song left out
+    def group(self, entries, keys, song_paths=None):
+        groups = {}
+        for song_path in entries if song_paths is None else song_paths:
+            values = tuple(entries[song_path][key] for key in keys)
+            if None not in values:
+                groups.setdefault(values, []).append(song_path)
+        return [sorted(g, key=lambda f: str.lower(os.path.basename(f))) for g in groups.values() if len(g) > 1]
+
+    def find_candidates(self, entries, keys, song_paths=None):
+        return [song_path for g in self.group(entries, keys, song_paths) for song_path in g]
+
+    def hash(self, entries, song_paths, key, function):
+        if not song_paths:
+            return
+        logging.info("Hashing %d songs (%s)" % (len(song_paths), key))
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            self.workers, mp_context=context, initializer=lower_priority, initargs=(self.nice,)
+        ) as executor:
+            for i, (song_path, digest) in enumerate(zip(song_paths, executor.map(function, song_paths, chunksize=4))):
+                self.progress = "%s hashes: %d of %d" % (key, i + 1, len(song_paths))
+                entries[song_path][key] = digest
+                self.cache.set(song_path, entries[song_path])
+
+    # The last scan's clusters, without the songs removed since
+    def get_clusters(self):
+        songs = set(self.library.songs)
+        clusters = [[p for p in c if p in songs] for c in self.clusters]
+        return [c for c in clusters if len(c) > 1]
+
+    def get_status(self):
+        return {"scanning": self.scanning, "progress": self.progress, "scanned_at": self.scanned_at}
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import subprocess
+import time
+from threading import Lock, Thread
+
+import ffmpeg
+
+from lib.ffmpeg_pipeline import default_cdg_fps, get_default_vcodec
+from lib.process_supervisor import ProcessSupervisor
+
+calibration_width = 1280
+calibration_height = 720
+calibration_seconds = 3
+reference_pixels = 1280 * 720  # default_vbitrate is tuned for 720p
+cdg_width = 300
+cdg_height = 216
+# candidate output heights when a source has to be downscaled to keep up with realtime
+scale_heights = [720, 540, 480, 360]
+# decoding some codecs costs a noticeable share of the encode budget, especially on a pi
+decode_cost = {"vp9": 1.3, "av1": 1.6, "hevc": 1.4}
+
+
+def parse_frame_rate(rate):
+    try:
+        num, den = rate.split("/")
+        return float(num) / float(den) if float(den) else 30.0
+    except (AttributeError, ValueError):
+        return 30.0
+
+
+# Measures how fast each available video encoder runs on this machine, caches the result, and picks the
+# encoder, preset, output resolution and bitrate for each song that keeps live transcoding above realtime.
+# Candidates are ordered from best quality to fastest.
+class EncodeProfiles:
+    def __init__(self, cache_file, platform, min_headroom=1.3, supervisor=None):
+        self.cache_file = cache_file
+        self.supervisor = supervisor or ProcessSupervisor()
+        self.platform = platform
+        self.min_headroom = min_headroom  # required ratio of encoder throughput to realtime
+        self.lock = Lock()
+        self.calibration = None
+        if platform == "raspberry_pi":
+            self.candidates = [("h264_v4l2m2m", None), ("libx264", "superfast"), ("libx264", "ultrafast")]
+        else:
+            self.candidates = [
+                ("libx264", "medium"),
+                ("libx264", "veryfast"),
+                ("libx264", "superfast"),
+                ("libx264", "ultrafast"),
+            ]
+
+    def get_ffmpeg_version(self):
+        try:
+            output = self.supervisor.check_output(
+                ["ffmpeg", "-hide_banner", "-version"], "ffmpeg", "interactive", timeout=10, stderr=subprocess.DEVNULL
+            )
+            return output.decode("utf-8", "ignore").split("\n")[0]
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    # calibration results are only valid for the same ffmpeg build on the same hardware
+    def get_cache_key(self):
+        return "%s|%s|%s" % (self.get_ffmpeg_version(), self.platform, os.cpu_count())
+
+    def load_calibration(self):
+        try:
+            with open(self.cache_file, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("key") != self.get_cache_key():
+            return None
+        return cached.get("results") or None  # calibrate again if no encoder worked last time
+
+    def calibrate_in_background(self):
+        t = Thread(target=self.get_calibration, name="encoder-calibration")
+        t.daemon = True
+        t.start()
+
+    def get_calibration(self):
+        with self.lock:
+            if self.calibration is None:
+                self.calibration = self.load_calibration()
+            if self.calibration is None:
+                self.calibration = self.calibrate()
+            return self.calibration
+
+    # Encodes a few seconds of a 720p test pattern with every candidate and records the frames per second
+    def calibrate(self):
+        logging.info("Calibrating video encoders, this may take a moment...")
+        results = {}
+        frames = calibration_seconds * 30
+        for vcodec, preset in self.candidates:
+            stream = ffmpeg.input(
+                "testsrc2=size=%dx%d:rate=30" % (calibration_width, calibration_height), f="lavfi", t=calibration_seconds
+            )
+            args = {"vcodec": vcodec, "pix_fmt": "yuv420p", "video_bitrate": "5M", "f": "null"}
+            if preset:
+                args["preset"] = preset
+            cmd = stream.output("-", **args).compile()
+            start_time = time.time()
+            try:
+                # same priority as playback, which is what's being measured
+                self.supervisor.run(
+                    cmd, "ffmpeg", "playback", timeout=60, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                )
+            except (OSError, subprocess.SubprocessError) as e:
+                logging.info("Encoder %s is not usable: %s" % (vcodec, e))
+                continue
+            fps = frames / (time.time() - start_time)
+            results[self.candidate_key(vcodec, preset)] = round(fps, 1)
+            logging.info("Encoder %s (preset: %s): %.1f fps at 720p" % (vcodec, preset, fps))
+        if not results:
+            # not cached, so the next start tries again, e.g. once ffmpeg is installed
+            logging.warning("No video encoder could be calibrated, using default encoder settings")
+            return results
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, "w") as f:
+                json.dump({"key": self.get_cache_key(), "results": results}, f)
+        except OSError as e:
+            logging.warning("Could not save encoder calibration: " + str(e))
+        return results
+
+    def candidate_key(self, vcodec, preset):
+        return "%s:%s" % (vcodec, preset) if preset else vcodec
+
+    def probe_source(self, fr, cdg_fps):
+        if fr.cdg_file_path != None:
+            return cdg_width, cdg_height, cdg_fps, "cdg"
+        probe = self.supervisor.probe(fr.file_path, select_streams="v:0")
+        video = probe["streams"][0]
+        return int(video["width"]), int(video["height"]), parse_frame_rate(video.get("avg_frame_rate")), video.get("codec_name")
+
+    # Returns build_pipeline arguments for a song whose video gets transcoded
+    def choose(self, fr, cdg_fps=default_cdg_fps):
+        fallback = {"default_vcodec": get_default_vcodec(self.platform)}
+        calibration = self.calibration  # don't wait for a calibration that's still running
+        if not calibration:
+            return fallback
+        try:
+            width, height, fps, codec = self.probe_source(fr, cdg_fps)
+        except Exception as e:
+            logging.warning("Could not probe %s, using default encoder settings: %s" % (fr.file_path, e))
+            return fallback
+
+        heights = [height] + [h for h in scale_heights if h < height]
+        for output_height in heights:
+            output_width = width * output_height / height
+            # pixels per second the encoder has to produce, compared against the calibrated throughput
+            required = output_width * output_height * fps * decode_cost.get(codec, 1.0)
+            for vcodec, preset in self.candidates:
+                measured_fps = calibration.get(self.candidate_key(vcodec, preset))
+                if not measured_fps:
+                    continue
+                headroom = measured_fps * calibration_width * calibration_height / required
+                if headroom >= self.min_headroom:
+                    profile = {
+                        "default_vcodec": vcodec,
+                        "preset": preset,
+                        "vbitrate": self.get_bitrate(output_width * output_height),
+                        "max_height": output_height if output_height != height else None,
+                    }
+                    logging.debug(
+                        "Encode profile for %dx%d@%.0f %s: %s (%.1fx realtime headroom)"
+                        % (width, height, fps, codec, profile, headroom)
+                    )
+                    return profile
+
+        # nothing keeps up, so use the fastest encoder at the smallest resolution
+        vcodec, preset = self.candidates[-1]
+        logging.warning("No encoder keeps up with realtime for %s, using the fastest settings" % fr.file_path)
+        return {
+            "default_vcodec": vcodec,
+            "preset": preset,
+            "vbitrate": self.get_bitrate(scale_heights[-1] * scale_heights[-1] * 16 / 9),
+            "max_height": scale_heights[-1] if height > scale_heights[-1] else None,
+        }
+
+    # scale the 720p default bitrate with the output's pixel count, within sensible bounds
+    def get_bitrate(self, pixels):
+        bitrate = 5.0 * pixels / reference_pixels
+        return "%.1fM" % max(1.0, min(8.0, bitrate))
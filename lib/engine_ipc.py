@@ -0,0 +1,246 @@
+import json
+import logging
+import os
+import time
+from functools import partial
+from multiprocessing.managers import BaseManager
+from threading import Lock, Thread
+
+# Support for running the web server in several worker processes next to the playback engine (the
+# Karaoke instance with the queue, run loop and ffmpeg). Workers read state from snapshot files which
+# the engine rewrites whenever something changes, and call Karaoke methods over a multiprocessing
+# manager connection. After every call the engine publishes a fresh snapshot before returning, so a
+# worker always sees the effects of its own requests.
+
+# Karaoke attributes published in the state snapshot
+state_fields = [
+    "queue",
+    "now_playing",
+    "now_playing_filename",
+    "now_playing_user",
+    "now_playing_transpose",
+    "now_playing_url",
+    "now_playing_command",
+    "now_playing_gain",
+    "is_paused",
+    "is_playing",
+    "volume",
+    "url",
+    "qr_code_path",
+    "youtubedl_version",
+    "hide_url",
+    "hide_overlay",
+    "screensaver_timeout",
+    "logo_path",
+    "download_path",
+]
+# Karaoke methods the web workers call on the engine
+remote_methods = [
+    "clear_command",
+    "delete",
+    "download_video",
+    "end_song",
+    "enqueue",
+    "get_available_songs",
+    "get_download_stats",
+    "get_duplicates",
+    "get_ffmpeg_pid",
+    "get_ffmpeg_stats",
+    "get_karaoke_search_results",
+    "get_logs",
+    "get_process_stats",
+    "get_search_results",
+    "get_storage_report",
+    "get_thumbnails",
+    "get_transition_stats",
+    "has_disk_quota",
+    "is_song_pinned",
+    "merge_duplicates",
+    "pause",
+    "queue_add_random",
+    "queue_clear",
+    "queue_edit",
+    "rename",
+    "report_position",
+    "restart",
+    "scan_duplicates",
+    "search_library",
+    "set_song_pinned",
+    "skip",
+    "start_song",
+    "stop",
+    "transpose_current",
+    "update_files",
+    "upgrade_youtubedl",
+    "video_loaded",
+    "vol_down",
+    "vol_up",
+    "volume_change",
+]
+publish_interval = 0.25  # in seconds
+
+
+class EngineManager(BaseManager):
+    pass
+
+
+# separate from EngineManager so connecting doesn't replace the engine registered by a host in the same process
+class EngineClient(BaseManager):
+    pass
+
+
+EngineClient.register("engine")
+
+
+def write_atomic(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Writes the engine's state to snapshot_dir: state.json with the small, frequently changing state and
+# library.json with the song list, which is only rewritten after a rescan.
+class SnapshotPublisher:
+    def __init__(self, karaoke, snapshot_dir):
+        self.k = karaoke
+        self.state_path = os.path.join(snapshot_dir, "state.json")
+        self.library_path = os.path.join(snapshot_dir, "library.json")
+        self.lock = Lock()
+        self.last_state = None
+        self.last_songs = None
+
+    def get_state(self):
+        state = {field: getattr(self.k, field) for field in state_fields}
+        state["ready"] = self.k.is_ready()
+        state["startup_status"] = self.k.get_startup_status()
+        return state
+
+    def publish(self):
+        with self.lock:
+            state = json.dumps(self.get_state(), sort_keys=True)
+            if state != self.last_state:
+                write_atomic(self.state_path, state)
+                self.last_state = state
+            # get_available_songs always assigns a new list, so the identity tells whether it changed
+            songs = self.k.available_songs
+            if songs is not self.last_songs:
+                write_atomic(self.library_path, json.dumps({"songs": songs}))
+                self.last_songs = songs
+
+    def run(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                logging.error("Error publishing engine snapshot: " + str(e))
+            time.sleep(publish_interval)
+
+
+# The object served to the web workers
+class EngineService:
+    def __init__(self, karaoke, publisher):
+        self.k = karaoke
+        self.publisher = publisher
+
+    def call(self, name, args, kwargs):
+        if name not in remote_methods:
+            raise AttributeError(name)
+        result = getattr(self.k, name)(*args, **kwargs)
+        self.publisher.publish()
+        return result
+
+
+# Runs in the engine process: serves the Karaoke instance over a unix socket (or localhost on platforms
+# without them) and keeps the snapshots up to date.
+class EngineHost:
+    def __init__(self, karaoke, snapshot_dir):
+        os.makedirs(snapshot_dir, exist_ok=True)
+        self.snapshot_dir = snapshot_dir
+        self.publisher = SnapshotPublisher(karaoke, snapshot_dir)
+        self.service = EngineService(karaoke, self.publisher)
+        self.authkey = os.urandom(32)
+        if hasattr(os, "fork"):
+            self.address = os.path.join(snapshot_dir, "engine.sock")
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        else:
+            self.address = ("127.0.0.1", 0)
+        EngineManager.register("engine", callable=lambda: self.service)
+        self.server = EngineManager(address=self.address, authkey=self.authkey).get_server()
+        self.address = self.server.address
+
+    def start(self):
+        self.publisher.publish()
+        for target, name in [(self.server.serve_forever, "engine-ipc"), (self.publisher.run, "engine-snapshots")]:
+            t = Thread(target=target, name=name)
+            t.daemon = True
+            t.start()
+
+    # closing the listener also removes the socket file
+    def stop(self):
+        self.server.listener.close()
+
+
+class SnapshotReader:
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.data = None
+        self.lock = Lock()
+
+    def read(self):
+        # the file is replaced on every publish, so a new inode means new data
+        inode = os.stat(self.path).st_ino
+        if inode != self.inode:
+            with self.lock:
+                if inode != self.inode:
+                    with open(self.path, "r") as f:
+                        self.data = json.load(f)
+                    self.inode = inode
+        return self.data
+
+
+# Stands in for the Karaoke instance in a web worker. Published attributes are read from the snapshots,
+# and the methods in remote_methods are forwarded to the engine. Anything else raises AttributeError,
+# and attributes are read-only: changes go through the engine's methods.
+class RemoteKaraoke:
+    def __init__(self, address, authkey, snapshot_dir):
+        manager = EngineClient(address=address, authkey=authkey)
+        manager.connect()
+        object.__setattr__(self, "service", manager.engine())
+        object.__setattr__(self, "state", SnapshotReader(os.path.join(snapshot_dir, "state.json")))
+        object.__setattr__(self, "library", SnapshotReader(os.path.join(snapshot_dir, "library.json")))
+
+    def __getattr__(self, name):
+        if name in ("service", "state", "library"):
+            raise AttributeError(name)  # not initialized yet
+        if name == "available_songs":
+            return self.library.read()["songs"]
+        if name in state_fields:
+            return self.state.read()[name]
+        if name in remote_methods:
+            return partial(self.call, name)
+        raise AttributeError("%r is neither published by nor callable on the engine" % name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("can't set %r of the engine from a web worker" % name)
+
+    def call(self, name, *args, **kwargs):
+        return self.service.call(name, args, kwargs)
+
+    # reads that would be wasteful round trips to the engine
+    def is_ready(self):
+        return self.state.read()["ready"]
+
+    def get_startup_status(self):
+        return self.state.read()["startup_status"]
+
+    def is_song_in_queue(self, song_path):
+        return any(each["file"] == song_path for each in self.queue)
+
+    def filename_from_path(self, file_path):
+        rc = os.path.basename(file_path)
+        rc = os.path.splitext(rc)[0]
+        rc = rc.split("---")[0]  # removes youtube id if present
+        return rc
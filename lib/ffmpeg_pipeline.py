@@ -0,0 +1,78 @@
+import ffmpeg
+
+default_vbitrate = "5M"  # seems to yield best results w/ h264_v4l2m2m on pi, recommended for 720p.
+default_cdg_fps = 25  # prevents ffmpeg from needlessly encoding cdg at 300fps
+
+
+def get_default_vcodec(platform):
+    # use h/w acceleration on pi
+    return "h264_v4l2m2m" if platform == "raspberry_pi" else "libx264"
+
+
+# just copy the video stream if it's an mp4 or webm file, since they are supported natively in html5
+def is_video_copied(fr):
+    return fr.cdg_file_path == None and (fr.file_extension == ".mp4" or fr.file_extension == ".webm")
+
+
+# the audio stream is copied unless it's transposed or from a CDG archive
+def is_audio_reencoded(fr, semitones):
+    return semitones != 0 or fr.cdg_file_path != None
+
+
+# Builds the ffmpeg command which streams a resolved song file (see FileResolver) to output_url.
+# By default ffmpeg listens on output_url and serves a fragmented mp4 stream to the splash screen player.
+# gain_db is only applied when the audio gets re-encoded anyway, and preset and max_height only when the
+# video does. offset starts the stream that many seconds into the song, with the stream's timestamps
+# starting from 0.
+def build_pipeline(
+    fr,
+    output_url,
+    semitones=0,
+    default_vcodec="libx264",
+    vbitrate=default_vbitrate,
+    preset=None,
+    max_height=None,
+    cdg_fps=default_cdg_fps,
+    gain_db=None,
+    rubberband_options=None,
+    listen=True,
+    offset=0,
+):
+    pitch = 2**(semitones/12) #The pitch value is (2^x/12), where x represents the number of semitones
+
+    vcodec = "copy" if is_video_copied(fr) else default_vcodec
+
+    # copy the audio stream if no transposition, otherwise use the aac codec
+    is_transposed = semitones != 0
+    acodec = "aac" if is_audio_reencoded(fr, semitones) else "copy"
+    # input seeking skips straight to the offset without decoding what's before it. Copied video starts
+    # from the keyframe before it.
+    input = ffmpeg.input(fr.file_path, ss=offset) if offset else ffmpeg.input(fr.file_path)
+    audio = input.audio.filter("rubberband", pitch=pitch, **(rubberband_options or {})) if is_transposed else input.audio
+    if gain_db and acodec != "copy":
+        audio = audio.filter("volume", f"{gain_db}dB")
+
+    output_args = {"f": "mp4", "video_bitrate": vbitrate, "movflags": "frag_keyframe+default_base_moof"}
+    if listen:
+        output_args["listen"] = 1
+    if preset and vcodec != "copy":
+        output_args["preset"] = preset
+
+    if (fr.cdg_file_path != None): #handle CDG files
+        # copyts helps with sync issues
+        cdg_input = ffmpeg.input(fr.cdg_file_path, copyts=None)
+        video = cdg_input.video
+        if offset:
+            # cdg can't be seeked, but draws so little that decoding up to the offset is quick. Copied
+            # timestamps keep the seeked audio at the offset as well, so both restart from 0.
+            video = video.filter("trim", start=offset).filter("setpts", "PTS-STARTPTS")
+            audio = audio.filter("asetpts", "PTS-STARTPTS")
+        video = video.filter("fps", fps=cdg_fps)
+        #cdg is very fussy about these flags. pi needs to encode to aac and cant just copy the mp3 stream
+        return ffmpeg.output(audio, video, output_url, vcodec=vcodec, acodec=acodec, pix_fmt="yuv420p", **output_args)
+    else:
+        video = input.video
+        if max_height and vcodec != "copy":
+            # -2 keeps the aspect ratio with an even width, which h264 requires
+            video = video.filter("scale", -2, max_height)
+        return ffmpeg.output(audio, video, output_url, vcodec=vcodec, acodec=acodec, **output_args)
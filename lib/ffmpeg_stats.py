@@ -0,0 +1,119 @@
+import re
+import time
+from collections import deque
+from threading import Lock
+
+# e.g. "frame=  120 fps= 30 q=28.0 size=    1024kB time=00:00:04.00 bitrate=2097.2kbits/s dup=0 drop=2 speed=1.01x"
+progress_fields = {
+    "frame": re.compile(r"frame=\s*(\d+)"),
+    "fps": re.compile(r"fps=\s*([\d.]+)"),
+    "out_time": re.compile(r"time=\s*(-?[\d:.]+)"),
+    "bitrate_kbps": re.compile(r"bitrate=\s*([\d.]+)kbits/s"),
+    "dup": re.compile(r"dup=\s*(\d+)"),
+    "drop": re.compile(r"drop=\s*(\d+)"),
+    "speed": re.compile(r"speed=\s*([\d.]+)x"),
+}
+
+
+def parse_duration(value):
+    seconds = 0.0
+    for part in value.lstrip("-").split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def is_progress_line(line):
+    return line.startswith("frame=") or (line.startswith("size=") and "speed=" in line)
+
+
+# Metrics of one play, updated from ffmpeg's stderr as the lines come in
+class PlayStats:
+    def __init__(self, file_path, semitones=0, vcodec=None, acodec=None):
+        self.lock = Lock()
+        self.file_path = file_path
+        self.semitones = semitones
+        self.vcodec = vcodec
+        self.acodec = acodec
+        self.started_at = time.time()
+        self.start_time = time.perf_counter()
+        self.time_to_stream = None
+        self.progress = {}
+        self.min_speed = None
+        self.exit_code = None
+        self.duration = None
+
+    def parse_line(self, line):
+        if self.time_to_stream is None and "Stream #" in line:
+            self.time_to_stream = round(time.perf_counter() - self.start_time, 3)
+        elif is_progress_line(line):
+            progress = {}
+            for field, regex in progress_fields.items():
+                m = regex.search(line)
+                if m:
+                    value = m.group(1)
+                    if field == "out_time":
+                        progress[field] = round(parse_duration(value), 2)
+                    elif field in ("frame", "dup", "drop"):
+                        progress[field] = int(value)
+                    else:
+                        progress[field] = float(value)
+            with self.lock:
+                self.progress.update(progress)
+                # ffmpeg's speed is an average since the start, so ignore the first seconds where it's noisy
+                if "speed" in progress and progress.get("out_time", 0) >= 5:
+                    if self.min_speed is None or progress["speed"] < self.min_speed:
+                        self.min_speed = progress["speed"]
+
+    def finish(self, exit_code):
+        self.exit_code = exit_code
+        self.duration = round(time.perf_counter() - self.start_time, 1)
+
+    # takes over the stats of a play that ran elsewhere, see lib.transcoder
+    def load(self, d):
+        with self.lock:
+            self.vcodec = d["vcodec"]
+            self.acodec = d["acodec"]
+            self.time_to_stream = d["time_to_stream"]
+            self.min_speed = d["min_speed"]
+            self.exit_code = d["exit_code"]
+            self.duration = d["duration"]
+            for field, key in [("frame", "frames"), ("fps", "fps"), ("speed", "speed"), ("dup", "dup"),
+                               ("drop", "drop"), ("bitrate_kbps", "bitrate_kbps"), ("out_time", "out_time")]:
+                if d[key] is not None:
+                    self.progress[field] = d[key]
+
+    def to_dict(self):
+        with self.lock:
+            progress = dict(self.progress)
+        return {
+            "file": self.file_path,
+            "semitones": self.semitones,
+            "vcodec": self.vcodec,
+            "acodec": self.acodec,
+            "started_at": self.started_at,
+            "time_to_stream": self.time_to_stream,
+            "fps": progress.get("fps"),
+            "speed": progress.get("speed"),
+            "min_speed": self.min_speed,
+            "frames": progress.get("frame"),
+            "dup": progress.get("dup"),
+            "drop": progress.get("drop"),
+            "bitrate_kbps": progress.get("bitrate_kbps"),
+            "out_time": progress.get("out_time"),
+            "exit_code": self.exit_code,
+            "duration": self.duration,
+        }
+
+
+# Bounded history of the most recent plays, newest first
+class FfmpegStatsLog:
+    def __init__(self, max_plays=50):
+        self.plays = deque(maxlen=max_plays)
+
+    def start(self, file_path, semitones=0, vcodec=None, acodec=None):
+        stats = PlayStats(file_path, semitones, vcodec, acodec)
+        self.plays.appendleft(stats)
+        return stats
+
+    def to_list(self):
+        return [s.to_dict() for s in list(self.plays)]
@@ -13,22 +13,41 @@ class FileResolver:
     file_extension = None
     pid = os.getpid() # for scoping tmp directories to this process
 
-    def __init__(self, file_path):
+    # rooms playing at the same time pass their name as scope, so they don't extract into the same directory
+    def __init__(self, file_path, scope=None):
         # Determine tmp directories (for things like extracted cdg files)
         if get_platform() == "windows":
             self.tmp_dir = os.path.expanduser(r"~\\AppData\\Local\\Temp\\pikaraoke\\" + str(self.pid) + r"\\")
         else:
             self.tmp_dir = f"/tmp/pikaraoke/{self.pid}"
+        if scope:
+            self.tmp_dir = os.path.join(self.tmp_dir, scope)
         self.resolved_file_path = self.process_file(file_path)
 
-    # Extract zipped cdg + mp3 files into a temporary directory, and set the paths to both files.
+    # Extract zipped cdg + mp3 files into a temporary directory, and set the paths to both files. The last
+    # extraction is reused when the same zip is played again, e.g. when the song is restarted in another key.
     def handle_zipped_cdg(self, file_path):
         extracted_dir = os.path.join(self.tmp_dir, "extracted")
-        if (os.path.exists(extracted_dir)):
-            shutil.rmtree(extracted_dir) #clears out any previous extractions
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(extracted_dir)
-        
+        marker_path = os.path.join(self.tmp_dir, "extracted.source")
+        st = os.stat(file_path)
+        source = "%s:%d:%d" % (file_path, st.st_size, st.st_mtime_ns)
+        try:
+            with open(marker_path, "r", encoding="utf-8") as f:
+                cached = f.read() == source
+        except OSError:
+            cached = False
+
+        if not cached:
+            if (os.path.exists(marker_path)):
+                os.remove(marker_path)
+            if (os.path.exists(extracted_dir)):
+                shutil.rmtree(extracted_dir) #clears out any previous extractions
+            with zipfile.ZipFile(file_path, 'r') as zip_ref:
+                zip_ref.extractall(extracted_dir)
+            # written last, so an interrupted extraction is never reused
+            with open(marker_path, "w", encoding="utf-8") as f:
+                f.write(source)
+
         mp3_file = None
         cdg_file = None
         files = os.listdir(extracted_dir)
@@ -0,0 +1,51 @@
+import os
+import sys
+import threading
+import time
+
+import jinja2
+from flask import g, has_request_context
+
+max_profile_seconds = 60
+
+
+# Adds the time spent rendering templates to the current request, see the request hooks in app.py.
+# Flask's template signals would need blinker, which isn't a dependency.
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            if has_request_context():
+                g.render_time = g.get("render_time", 0.0) + time.perf_counter() - start_time
+
+
+def frame_name(frame):
+    code = frame.f_code
+    # semicolons separate the frames of a folded stack
+    return ("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)).replace(";", ":")
+
+
+# Samples the python stacks of all other threads every interval secs for the given duration and returns
+# them in the folded format ("thread;outer;...;inner count" per line), which flamegraph.pl and speedscope
+# can read.
+def capture_profile(seconds, interval=0.01):
+    seconds = min(float(seconds), max_profile_seconds)
+    own_thread = threading.get_ident()
+    counts = {}
+    end_time = time.monotonic() + seconds
+    while time.monotonic() < end_time:
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)).replace(";", ":"))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return "".join("%s %d\n" % (stack, count) for stack, count in sorted(counts.items()))
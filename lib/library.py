@@ -0,0 +1,242 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock, Thread
+
+song_types = [".mp4", ".mp3", ".zip", ".mkv", ".avi", ".webm", ".mov"]
+scan_policies = ["watched", "periodic", "manual"]
+watch_interval = 5  # in seconds, how often watched and periodic roots are checked
+default_scan_interval = 3600  # in seconds, for periodic roots
+
+
+# Parses a library root given as PATH, PATH=watched, PATH=periodic, PATH=periodic:SECONDS or PATH=manual.
+# Returns (path, policy, scan interval in seconds or None).
+def parse_root(spec):
+    path, _, policy = spec.rpartition("=") if "=" in spec else (spec, "", "watched")
+    policy, _, interval = policy.partition(":")
+    if policy not in scan_policies:
+        raise ValueError("Unknown scan policy '%s', expected one of: %s" % (policy, ", ".join(scan_policies)))
+    if interval and policy != "periodic":
+        raise ValueError("Only periodic roots take a scan interval: " + spec)
+    return path, policy, int(interval) if interval else None
+
+
+# A directory songs are found in. The songs found by its last scan are kept in a manifest file, so the
+# root's songs are known at startup without scanning it. The policy decides when it gets rescanned:
+#   watched   whenever one of its directories changes, checked every few seconds
+#   periodic  every interval seconds
+#   manual    only from the admin's refresh, for big archives on slow or read-only disks
+class LibraryRoot:
+    def __init__(self, path, policy, manifest_path, interval=None):
+        self.path = path
+        self.policy = policy
+        self.interval = interval or default_scan_interval
+        self.manifest_path = manifest_path
+        self.songs = []
+        self.directories = {}  # directory -> mtime at the last scan, see has_changed
+        self.scanned_at = None
+        self.lock = Lock()
+        self.load_manifest()
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read library manifest of %s: %s" % (self.path, e))
+            return
+        if manifest.get("path") == self.path:
+            self.songs = manifest["songs"]
+            self.directories = manifest["directories"]
+            self.scanned_at = manifest["scanned_at"]
+
+    def save_manifest(self):
+        manifest = {
+            "path": self.path,
+            "songs": self.songs,
+            "directories": self.directories,
+            "scanned_at": self.scanned_at,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            logging.warning("Could not save library manifest of %s: %s" % (self.path, e))
+
+    def scan(self):
+        # a scan asked for while one is running waits for it, then scans again to pick up later changes
+        with self.lock:
+            logging.info("Fetching available songs in: " + self.path)
+            start_time = time.time()
+            songs = []
+            directories = {}
+            self.walk(os.path.normpath(self.path), songs, directories)
+            self.songs = songs
+            self.directories = directories
+            self.scanned_at = time.time()
+            self.save_manifest()
+            logging.info("Found %d songs in %s in %.2fs" % (len(songs), self.path, time.time() - start_time))
+
+    def walk(self, directory, songs, directories):
+        try:
+            directories[directory] = os.stat(directory).st_mtime
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logging.warning("Could not read song directory %s: %s" % (directory, e))
+            return
+        for entry in entries:
+            if entry.is_dir():
+                self.walk(entry.path, songs, directories)
+            elif os.path.splitext(entry.name)[1].lower() in song_types and entry.is_file():
+                logging.debug("adding song: %s", entry.name)
+                songs.append(Path(entry.path).as_posix())
+
+    # Whether a file was added, removed or renamed since the last scan. Only the directories get
+    # checked, as those changes update the modification time of the directory holding the file.
+    def has_changed(self):
+        if self.scanned_at is None:
+            return True
+        for directory, mtime in list(self.directories.items()):
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def is_due(self):
+        if self.policy == "watched":
+            return self.has_changed()
+        if self.policy == "periodic":
+            return self.scanned_at is None or time.time() - self.scanned_at > self.interval
+        return False
+
+    def contains(self, path):
+        return Path(path).as_posix().startswith(Path(self.path).as_posix().rstrip("/") + "/")
+
+    # Applies a change this server made to the root's files, without rescanning it
+    def update(self, removed, added):
+        with self.lock:
+            removed = set(removed)
+            self.songs = [s for s in self.songs if s not in removed] + [s for s in added if s not in self.songs]
+            # keeps the watcher from rescanning the root for the change
+            for path in list(removed) + list(added):
+                directory = os.path.dirname(path)
+                if directory in self.directories:
+                    with contextlib.suppress(OSError):
+                        self.directories[directory] = os.stat(directory).st_mtime
+            self.save_manifest()
+
+
+# Index of the songs in the library roots. The first root is the download directory, the others hold
+# existing collections. When the server hosts several rooms, they all share one instance, so the roots
+# are scanned and the song list held in memory once.
+class Library:
+    def __init__(self, roots, manifest_dir, loudness_analyzer=None, thumbnails=None):
+        self.roots = [
+            LibraryRoot(path, policy, os.path.join(manifest_dir, self.get_manifest_name(path)), interval)
+            for path, policy, interval in roots
+        ]
+        self.download_path = self.roots[0].path
+        self.loudness_analyzer = loudness_analyzer
+        self.thumbnails = thumbnails
+        self.merge_lock = Lock()
+        self.listeners = []
+        self.merge()
+
+    def get_manifest_name(self, path):
+        return hashlib.sha1(path.encode("utf-8", "ignore")).hexdigest()[:16] + ".json"
+
+    # callback(old_path, new_path) is called when a song file got replaced, e.g. by its normalized version
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    # Rebuilds the song list from the roots' songs
+    def merge(self):
+        with self.merge_lock:
+            songs = dict.fromkeys(s for root in self.roots for s in root.songs)
+            # always assign a new list, readers holding the old one keep a consistent view
+            self.songs = sorted(songs, key=lambda f: str.lower(os.path.basename(f)))
+
+    # Scans the given roots, all of them by default, in parallel
+    def scan(self, roots=None):
+        roots = roots or self.roots
+        if len(roots) == 1:
+            roots[0].scan()
+        else:
+            with ThreadPoolExecutor(max_workers=len(roots), thread_name_prefix="library-scan") as executor:
+                list(executor.map(lambda root: root.scan(), roots))
+        self.merge()
+        self.analyze(roots)
+
+    # Rescans the download directory, after a download
+    def scan_downloads(self):
+        self.scan([self.roots[0]])
+
+    # Brings the roots up to date at startup. Manual roots keep the songs of their manifest, everything
+    # else gets rescanned, and the watched and periodic roots are checked from then on.
+    def start(self):
+        stale = [root for root in self.roots if root.policy != "manual" or root.scanned_at is None]
+        if stale:
+            self.scan(stale)
+        self.analyze([root for root in self.roots if root not in stale])
+        if any(root.policy != "manual" for root in self.roots):
+            Thread(target=self.run_monitor, daemon=True, name="library-monitor").start()
+
+    def run_monitor(self):
+        while True:
+            time.sleep(watch_interval)
+            try:
+                due = [root for root in self.roots if root.is_due()]
+                if due:
+                    self.scan(due)
+            except Exception as e:
+                logging.error("Library rescan failed: " + str(e))
+
+    # Queues the roots' songs for the background work done on every song
+    def analyze(self, roots):
+        songs = [s for root in roots for s in root.songs]
+        if self.loudness_analyzer and songs:
+            self.loudness_analyzer.analyze_library(songs, library_songs=self.songs)
+        if self.thumbnails and songs:
+            self.thumbnails.generate_library(songs)
+
+    def get_root(self, path):
+        matches = [root for root in self.roots if root.contains(path)]
+        return max(matches, key=lambda root: len(root.path), default=None)
+
+    # Applies files this server removed or added to the song list, without rescanning their roots
+    def update(self, removed=(), added=()):
+        for root in self.roots:
+            root_removed = [Path(p).as_posix() for p in removed if self.get_root(p) is root]
+            root_added = [Path(p).as_posix() for p in added if self.get_root(p) is root]
+            if root_removed or root_added:
+                root.update(root_removed, root_added)
+        self.merge()
+
+    def replace_song(self, old_path, new_path):
+        if old_path != new_path:
+            for callback in self.listeners:
+                callback(old_path, new_path)
+        self.update(removed=[old_path], added=[new_path])
+        if self.loudness_analyzer:
+            self.loudness_analyzer.analyze(Path(new_path).as_posix())
+        if self.thumbnails:
+            self.thumbnails.generate(Path(new_path).as_posix())
+
+    def find_by_youtube_id(self, youtube_id):
+        for each in self.songs:
+            if youtube_id in each:
+                return each
+        logging.error("No available song found with youtube id: " + youtube_id)
+        return None
@@ -0,0 +1,94 @@
+import atexit
+import logging
+import logging.handlers
+import time
+from collections import deque
+from queue import Queue
+
+log_format = "[%(asctime)s] %(levelname)s: %(message)s"
+date_format = "%Y-%m-%d %H:%M:%S"
+log_levels = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+ring_size = 2000  # records kept for the logs page
+ffmpeg_lines_per_second = 20  # of ffmpeg output, beyond which lines are dropped until the next second
+
+ring = None
+listener = None
+
+
+# Keeps the most recent records in memory, for the admin's logs page
+class RingHandler(logging.Handler):
+    def __init__(self, capacity):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "levelno": record.levelno,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        self.records.append(entry)  # handle() holds self.lock
+
+    # Newest first, at most limit records at or above level
+    def get_records(self, level=logging.NOTSET, limit=500):
+        with self.lock:
+            records = list(self.records)
+        return [dict(r) for r in reversed(records) if r["levelno"] >= level][:limit]
+
+
+# Lets through at most max_per_second records a second. The number of records dropped is added to the
+# next record that gets through, so a burst of ffmpeg output can't flood the log or slow down playback.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, max_per_second):
+        super().__init__()
+        self.max_per_second = max_per_second
+        self.second = 0
+        self.count = 0
+        self.dropped = 0
+
+    def filter(self, record):
+        second = int(time.time())
+        if second != self.second:
+            self.second = second
+            self.count = 0
+        self.count += 1
+        if self.count > self.max_per_second:
+            self.dropped += 1
+            return False
+        if self.dropped:
+            record.msg = "(%d lines dropped) %s" % (self.dropped, record.msg)
+            self.dropped = 0
+        return True
+
+
+# Sends all logging through a queue, so the threads that log only enqueue their records while a
+# background thread formats them and writes them to the console and the in-memory ring. Calling it again,
+# e.g. for every room, only updates the level.
+def setup_logging(level):
+    global ring, listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    if listener is not None:
+        return
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(log_format, date_format))
+    ring = RingHandler(ring_size)
+    queue = Queue()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    listener = logging.handlers.QueueListener(queue, console, ring)
+    listener.start()
+    # flushes what's still queued
+    atexit.register(listener.stop)
+
+    logging.getLogger("ffmpeg").addFilter(RateLimitFilter(ffmpeg_lines_per_second))
+
+
+def get_recent_logs(level=logging.NOTSET, limit=500):
+    if ring is None:
+        return []
+    return ring.get_records(level, limit)
@@ -0,0 +1,126 @@
+import logging
+import os
+import re
+import subprocess
+import zipfile
+from queue import Queue
+from threading import Lock, Thread
+
+import ffmpeg
+
+from lib.process_supervisor import ProcessSupervisor
+from lib.song_cache import SongCache
+
+target_loudness = -16.0  # LUFS
+max_true_peak = -1.0  # dBTP, headroom kept when boosting quiet songs
+max_boost = 10.0  # dB
+max_cut = -20.0  # dB
+# dB the splash screen player runs below full volume, so it can raise copied audio by up to as much. Larger
+# boosts only fully apply when the audio gets re-encoded anyway.
+player_headroom = 6.0
+analysis_timeout = 600  # in seconds
+
+
+# Reads the mp3 out of a zipped CDG archive without extracting it to disk
+def read_zipped_mp3(file_path):
+    with zipfile.ZipFile(file_path, "r") as zip_ref:
+        for name in zip_ref.namelist():
+            if os.path.splitext(name)[1].casefold() == ".mp3":
+                return zip_ref.read(name)
+    raise Exception("No .mp3 was found in the zip file: " + file_path)
+
+
+# Volume factor the splash screen player applies to a song with the given gain, or to a song whose gain is
+# baked into its stream when gain_db is None
+def get_player_gain(gain_db):
+    return round(10 ** ((min(gain_db or 0, player_headroom) - player_headroom) / 20), 3)
+
+
+# Measures EBU R128 loudness of songs on a small pool of background workers and keeps the results in a
+# persistent per-song cache, so playback can apply a per-song gain without any extra encoding work.
+class LoudnessAnalyzer:
+    def __init__(self, cache_file, workers=1, target=target_loudness, supervisor=None):
+        self.cache = SongCache(cache_file)
+        self.supervisor = supervisor or ProcessSupervisor()
+        self.target = target
+        self.pending = Queue()
+        self.queued = set()
+        self.lock = Lock()
+        for i in range(workers):
+            Thread(target=self.run, daemon=True, name="loudness-%d" % i).start()
+
+    def analyze(self, song_path):
+        with self.lock:
+            if song_path in self.queued or self.cache.has(song_path):
+                return False
+            self.queued.add(song_path)
+        self.pending.put(song_path)
+        return True
+
+    # Queue every song that doesn't have a cached measurement yet. library_songs are all songs in the
+    # library, when only some of them are given, and keep their measurements.
+    def analyze_library(self, song_paths, library_songs=None):
+        count = 0
+        for song_path in song_paths:
+            if self.analyze(song_path):
+                count += 1
+        if count > 0:
+            logging.info("Queued %d songs for loudness analysis" % count)
+        self.cache.prune(song_paths if library_songs is None else library_songs)
+
+    def run(self):
+        while True:
+            song_path = self.pending.get()
+            try:
+                self.cache.set(song_path, self.measure(song_path))
+            except Exception as e:
+                logging.error("Loudness analysis failed for %s: %s" % (song_path, e))
+            finally:
+                with self.lock:
+                    self.queued.discard(song_path)
+                if self.pending.empty():
+                    self.cache.save()
+
+    def measure(self, song_path):
+        logging.debug("Analyzing loudness: %s", song_path)
+        ext = os.path.splitext(song_path)[1].casefold()
+        if ext == ".zip":
+            stdin = read_zipped_mp3(song_path)
+            input = ffmpeg.input("pipe:", f="mp3")
+        else:
+            stdin = None
+            input = ffmpeg.input(song_path)
+        # framelog=verbose keeps the per-frame measurements out of stderr, only the summary is printed
+        stream = input.audio.filter("ebur128", peak="true", framelog="verbose").output("-", f="null")
+        cmd = stream.global_args("-nostats").compile()
+        result = self.supervisor.run(
+            cmd, "ffmpeg", timeout=analysis_timeout, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if result.returncode != 0:
+            raise ffmpeg.Error("ffmpeg", result.stdout, result.stderr)
+        stderr = result.stderr
+        summary = stderr.decode("utf-8", "ignore").split("Summary:")[-1]
+
+        integrated = re.search(r"I:\s+(-?[\d.]+) LUFS", summary)
+        loudness_range = re.search(r"LRA:\s+([\d.]+) LU", summary)
+        peak = re.search(r"Peak:\s+(-?[\d.]+|-inf) dBFS", summary)
+        if integrated is None:
+            raise Exception("No loudness summary in ffmpeg output")
+        result = {
+            "integrated": float(integrated.group(1)),
+            "lra": float(loudness_range.group(1)) if loudness_range else None,
+            "true_peak": float(peak.group(1)) if peak and peak.group(1) != "-inf" else None,
+        }
+        logging.debug("Loudness of %s: %s", song_path, result)
+        return result
+
+    # Gain in dB that brings the song to the target loudness, or None if it hasn't been analyzed yet
+    def get_gain_db(self, song_path):
+        result = self.cache.get(song_path)
+        if result is None:
+            self.analyze(song_path)  # so it's ready next time
+            return None
+        gain = self.target - result["integrated"]
+        if result["true_peak"] is not None:
+            gain = min(gain, max_true_peak - result["true_peak"])
+        return round(max(max_cut, min(max_boost, gain)), 2)
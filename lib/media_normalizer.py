@@ -0,0 +1,147 @@
+import logging
+import os
+import struct
+import subprocess
+from queue import Full, Queue
+from threading import Thread
+
+import ffmpeg
+
+from lib.process_supervisor import ProcessSupervisor
+
+# Containers that may need remuxing. CDG archives (.zip/.mp3) are left alone, and .webm is already
+# stream-copied by play_file, so converting it would only cost a pointless transcode.
+normalizable_extensions = [".mp4", ".mkv", ".mov", ".avi"]
+normalize_timeout = 3600  # in seconds
+
+
+# Walks the top-level mp4 boxes and reports whether the "moov" index is placed before the media data,
+# which lets the browser (and ffmpeg) start reading the file without seeking to the end first.
+def is_faststart(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, box_type = struct.unpack(">I4s", header)
+                if box_type == b"moov":
+                    return True
+                if box_type == b"mdat":
+                    return False
+                if size == 1:  # 64 bit box size follows the header
+                    size = struct.unpack(">Q", f.read(8))[0]
+                    f.seek(size - 16, os.SEEK_CUR)
+                elif size == 0:  # box extends to the end of the file
+                    return False
+                else:
+                    f.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+# Converts downloaded songs into faststart H.264/AAC mp4 files on a single background worker, so every
+# later play of the song qualifies for the cheap "vcodec=copy" path in play_file.
+# Streams that are already H.264/AAC are only remuxed, anything else is transcoded once.
+class MediaNormalizer:
+    def __init__(self, on_normalized=None, max_pending=50, supervisor=None):
+        # called with (old_path, new_path) after a file was replaced
+        self.on_normalized = on_normalized
+        self.supervisor = supervisor or ProcessSupervisor()
+        self.pending = Queue(maxsize=max_pending)
+        self.worker = None
+
+    def submit(self, file_path):
+        ext = os.path.splitext(file_path)[1].casefold()
+        if ext not in normalizable_extensions:
+            logging.debug("Skipping normalization of unsupported file: %s", file_path)
+            return False
+        if self.worker is None:
+            self.worker = Thread(target=self.run, daemon=True)
+            self.worker.start()
+        try:
+            self.pending.put_nowait(file_path)
+        except Full:
+            logging.warning("Normalization queue is full, skipping: " + file_path)
+            return False
+        return True
+
+    def run(self):
+        while True:
+            file_path = self.pending.get()
+            try:
+                new_path = self.normalize(file_path)
+                if new_path and self.on_normalized:
+                    self.on_normalized(file_path, new_path)
+            except Exception as e:
+                logging.error("Error normalizing file: %s: %s" % (file_path, e))
+            finally:
+                self.pending.task_done()
+
+    def get_codecs(self, file_path):
+        probe = self.supervisor.probe(file_path)
+        vcodec = None
+        acodec = None
+        for stream in probe["streams"]:
+            if stream["codec_type"] == "video" and vcodec is None:
+                vcodec = stream["codec_name"]
+            elif stream["codec_type"] == "audio" and acodec is None:
+                acodec = stream["codec_name"]
+        return vcodec, acodec
+
+    # Returns the path of the normalized file, or None if nothing was changed
+    def normalize(self, file_path):
+        if not os.path.isfile(file_path):
+            logging.warning("File disappeared before normalization: " + file_path)
+            return None
+        base, ext = os.path.splitext(file_path)
+        new_path = base + ".mp4"
+        if new_path != file_path and os.path.exists(new_path):
+            logging.warning("Not normalizing, target already exists: " + new_path)
+            return None
+
+        vcodec, acodec = self.get_codecs(file_path)
+        if vcodec is None:
+            logging.debug("No video stream, skipping normalization: %s", file_path)
+            return None
+        if ext.casefold() == ".mp4" and vcodec == "h264" and acodec in ("aac", None) and is_faststart(file_path):
+            logging.debug("File is already normalized: %s", file_path)
+            return None
+
+        output_args = {"movflags": "+faststart", "f": "mp4"}
+        if vcodec == "h264":
+            output_args["vcodec"] = "copy"
+        else:
+            output_args.update(vcodec="libx264", preset="veryfast", crf=20, pix_fmt="yuv420p")
+        if acodec == "aac" or acodec is None:
+            output_args["acodec"] = "copy"
+        else:
+            output_args.update(acodec="aac", audio_bitrate="192k")
+
+        action = "Remuxing" if output_args["vcodec"] == "copy" and output_args["acodec"] == "copy" else "Transcoding"
+        logging.info("%s downloaded file to faststart mp4: %s" % (action, file_path))
+
+        # write next to the original so the final rename stays on the same filesystem and is atomic.
+        # The .tmp extension keeps the partial file out of the song list while it's being written.
+        tmp_path = base + ".normalizing.tmp"
+        input = ffmpeg.input(file_path)
+        streams = [input.video] if acodec is None else [input.video, input.audio]
+        try:
+            cmd = ffmpeg.output(*streams, tmp_path, **output_args).overwrite_output().compile()
+            result = self.supervisor.run(
+                cmd, "ffmpeg", timeout=normalize_timeout, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            if result.returncode != 0:
+                raise ffmpeg.Error("ffmpeg", result.stdout, result.stderr)
+            os.replace(tmp_path, new_path)
+        except (ffmpeg.Error, OSError, subprocess.TimeoutExpired) as e:
+            stderr = e.stderr.decode("utf-8", "ignore") if isinstance(e, ffmpeg.Error) else str(e)
+            logging.error("Normalization failed for %s: %s" % (file_path, stderr))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+        if new_path != file_path:
+            os.remove(file_path)
+        logging.info("Normalized file: " + new_path)
+        return new_path
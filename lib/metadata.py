@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import re
+import time
+from bisect import bisect_left
+from threading import Lock, Thread
+
+from unidecode import unidecode
+
+# fields of yt-dlp's info json kept in the index, and how much a search term matching them counts
+field_weights = {"title": 3, "track": 3, "artist": 3, "channel": 1, "uploader": 1, "tags": 1}
+# other fields kept for display
+extra_fields = ["duration", "upload_date"]
+# bulky fields dropped from the info json files once ingested, they make up most of their size
+bulky_fields = ["formats", "requested_formats", "thumbnails", "automatic_captions", "subtitles", "heatmap"]
+info_suffix = ".info.json"
+youtube_id_pattern = re.compile(r"---([A-Za-z0-9_-]{11})\.[A-Za-z0-9]+$")
+
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", unidecode(text).lower())
+
+
+# Searchable metadata of downloaded songs, from the info json yt-dlp writes next to every download (see
+# DownloadManager.run_download). The interesting fields of every info file are ingested into a compact
+# index file, which is loaded at startup into an inverted index of the words in the title, artist,
+# channel and tags, so searching the library by them takes no more than a few dictionary lookups.
+class MetadataIndex:
+    def __init__(self, info_dir):
+        self.info_dir = info_dir
+        self.index_file = os.path.join(info_dir, "index.json")
+        self.lock = Lock()
+        self.entries = {}  # youtube id -> metadata
+        self.words = {}  # word -> {youtube id: weight}
+        self.sorted_words = []
+        self.song_paths = {}  # youtube id -> song path, see get_song_path
+        self.indexed_songs = None
+        os.makedirs(info_dir, exist_ok=True)
+        self.load()
+        Thread(target=self.ingest_all, daemon=True, name="metadata").start()
+
+    def load(self):
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read the metadata index, rebuilding it: " + str(e))
+            return
+        with self.lock:
+            for youtube_id, entry in entries.items():
+                self.add(youtube_id, entry)
+            self.sorted_words = sorted(self.words)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries)
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_file, self.index_file)
+
+    def get_info_path(self, youtube_id):
+        return os.path.join(self.info_dir, youtube_id + info_suffix)
+
+    # The output template that has yt-dlp write the info json where ingest finds it
+    def get_output_template(self):
+        return "infojson:" + os.path.join(self.info_dir, "%(id)s.%(ext)s")
+
+    # callers hold self.lock
+    def add(self, youtube_id, entry):
+        self.entries[youtube_id] = entry
+        for field, weight in field_weights.items():
+            value = entry.get(field)
+            if not value:
+                continue
+            for word in tokenize(" ".join(value) if isinstance(value, list) else str(value)):
+                ids = self.words.setdefault(word, {})
+                ids[youtube_id] = max(ids.get(youtube_id, 0), weight)
+
+    # Adds the info json of a download to the index, and strips the fields the index doesn't need from
+    # it. Returns False if there's no info json for the video.
+    def ingest(self, youtube_id, save=True):
+        info_path = self.get_info_path(youtube_id)
+        try:
+            with open(info_path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read %s: %s" % (info_path, e))
+            return False
+        entry = {field: info[field] for field in list(field_weights) + extra_fields if info.get(field)}
+        with self.lock:
+            self.add(youtube_id, entry)
+            self.sorted_words = sorted(self.words)
+        if any(field in info for field in bulky_fields):
+            for field in bulky_fields:
+                info.pop(field, None)
+            tmp_path = info_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(info, f)
+            os.replace(tmp_path, info_path)
+        if save:
+            self.save()
+        logging.debug("Ingested metadata of %s: %s", youtube_id, entry.get("title"))
+        return True
+
+    # Ingests the info json files that aren't in the index yet
+    def ingest_all(self):
+        start_time = time.time()
+        try:
+            names = [n for n in os.listdir(self.info_dir) if n.endswith(info_suffix)]
+        except OSError as e:
+            logging.warning("Could not read the metadata directory: " + str(e))
+            return
+        new_ids = [n[: -len(info_suffix)] for n in names if n[: -len(info_suffix)] not in self.entries]
+        count = sum(1 for youtube_id in new_ids if self.ingest(youtube_id, save=False))
+        if count > 0:
+            self.save()
+            logging.info("Ingested metadata of %d songs in %.2fs" % (count, time.time() - start_time))
+
+    # The searchable metadata of the song as one string, empty if there's none
+    def get_keywords(self, song_path):
+        m = youtube_id_pattern.search(song_path)
+        entry = self.entries.get(m.group(1)) if m else None
+        if not entry:
+            return ""
+        values = [" ".join(v) if isinstance(v, list) else str(v) for v in map(entry.get, field_weights) if v]
+        return " ".join(dict.fromkeys(values))  # the channel and uploader are often the same
+
+    def get_song_path(self, youtube_id, songs):
+        # the library assigns a new song list whenever it changes
+        if songs is not self.indexed_songs:
+            song_paths = {}
+            for song_path in songs:
+                m = youtube_id_pattern.search(song_path)
+                if m:
+                    song_paths[m.group(1)] = song_path
+            self.song_paths = song_paths
+            self.indexed_songs = songs
+        return self.song_paths.get(youtube_id)
+
+    # Paths of the songs among songs whose metadata contains all words of the query, the last of them
+    # possibly only partly typed, best matches first
+    def search(self, query, songs, limit=20):
+        words = tokenize(query)
+        if not words:
+            return []
+        scores = None
+        with self.lock:
+            for i, word in enumerate(words):
+                matches = dict(self.words.get(word, {}))
+                if i == len(words) - 1:
+                    # every indexed word starting with the last word of the query
+                    start = bisect_left(self.sorted_words, word)
+                    for indexed_word in self.sorted_words[start:]:
+                        if not indexed_word.startswith(word):
+                            break
+                        for youtube_id, weight in self.words[indexed_word].items():
+                            matches[youtube_id] = max(matches.get(youtube_id, 0), weight)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {i: s + matches[i] for i, s in scores.items() if i in matches}
+                if not scores:
+                    return []
+        results = []
+        for youtube_id, score in sorted(scores.items(), key=lambda each: -each[1]):
+            song_path = self.get_song_path(youtube_id, songs)
+            if song_path:
+                results.append(song_path)
+                if len(results) >= limit:
+                    break
+        return results
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+
+import psutil
+
+# upper bounds of the request latency histogram buckets, in seconds
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = {}  # status code -> count
+        self.buckets = [0] * (len(latency_buckets) + 1)  # the last one is +Inf
+        self.latency_sum = 0.0
+        self.render_sum = 0.0
+        self.response_bytes_sum = 0
+        self.count = 0
+
+    def observe(self, status, seconds, render_seconds=0.0, response_bytes=None):
+        self.requests[status] = self.requests.get(status, 0) + 1
+        for i, bound in enumerate(latency_buckets):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+        self.latency_sum += seconds
+        self.render_sum += render_seconds
+        self.response_bytes_sum += response_bytes or 0
+        self.count += 1
+
+    def to_dict(self):
+        return dict(vars(self), requests={str(k): v for k, v in self.requests.items()})
+
+    def merge(self, d):
+        for status, count in d["requests"].items():
+            self.requests[int(status)] = self.requests.get(int(status), 0) + count
+        self.buckets = [a + b for a, b in zip(self.buckets, d["buckets"])]
+        self.latency_sum += d["latency_sum"]
+        self.render_sum += d["render_sum"]
+        self.response_bytes_sum += d["response_bytes_sum"]
+        self.count += d["count"]
+
+
+# Samples system and pikaraoke state on a background thread, so reading metrics never waits on psutil,
+# and counts requests per route. Samples are kept in a fixed size ring buffer (an hour at the default
+# interval) and the latest one is served in the Prometheus text format.
+# When the web server runs in several processes, each one passes the same shared_dir. The request stats
+# of every process are written there once per interval and added up when serving metrics.
+class MetricsCollector:
+    def __init__(self, karaoke, interval=5, history=720, shared_dir=None):
+        self.k = karaoke
+        self.shared_dir = shared_dir
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self.routes = {}
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.ffmpeg_process = None
+
+    def start(self):
+        psutil.cpu_percent(percpu=True)  # the first call only sets the baseline
+        t = Thread(target=self.run, name="metrics-sampler")
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        # the first sample right away, so the metrics aren't empty for the first interval
+        while True:
+            try:
+                self.samples.append(self.sample())
+                if self.shared_dir:
+                    self.save_request_stats()
+            except Exception as e:
+                logging.warning("Error sampling metrics: " + str(e))
+            if self.stop_event.wait(self.interval):
+                break
+
+    def save_request_stats(self):
+        with self.lock:
+            data = json.dumps({route: stats.to_dict() for route, stats in self.routes.items()})
+        path = os.path.join(self.shared_dir, "requests-%d.json" % os.getpid())
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    # this process' request stats plus the last saved ones of the other running processes
+    def get_request_stats(self):
+        routes = {}
+        with self.lock:
+            for route, stats in self.routes.items():
+                routes[route] = RouteStats()
+                routes[route].merge(stats.to_dict())
+        if not self.shared_dir:
+            return routes
+        for name in os.listdir(self.shared_dir):
+            if not (name.startswith("requests-") and name.endswith(".json")):
+                continue
+            pid = int(name[len("requests-") : -len(".json")])
+            if pid == os.getpid() or not psutil.pid_exists(pid):
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, name), "r") as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for route, d in saved.items():
+                routes.setdefault(route, RouteStats()).merge(d)
+        return routes
+
+    def get_ffmpeg_usage(self):
+        pid = self.k.get_ffmpeg_pid()
+        if pid is None:
+            return None, None
+        try:
+            # keep the psutil.Process around, cpu_percent() measures the time since its last call
+            if self.ffmpeg_process is None or self.ffmpeg_process.pid != pid:
+                self.ffmpeg_process = psutil.Process(pid)
+                self.ffmpeg_process.cpu_percent()
+            return self.ffmpeg_process.cpu_percent(), self.ffmpeg_process.memory_info().rss
+        except psutil.Error:
+            return None, None
+
+    def sample(self):
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self.k.download_path if os.path.isdir(self.k.download_path) else "/")
+        ffmpeg_cpu, ffmpeg_rss = self.get_ffmpeg_usage()
+        downloads = self.k.get_download_stats()
+        return {
+            "time": time.time(),
+            "cpu_percent": psutil.cpu_percent(percpu=True),
+            "memory_available_bytes": memory.available,
+            "memory_total_bytes": memory.total,
+            "disk_free_bytes": disk.free,
+            "disk_total_bytes": disk.total,
+            "ffmpeg_cpu_percent": ffmpeg_cpu,
+            "ffmpeg_rss_bytes": ffmpeg_rss,
+            "queue_length": len(self.k.queue),
+            "library_songs": len(self.k.available_songs),
+            "downloads_active": downloads["active"],
+            "downloads_completed": downloads["completed"],
+            "downloads_failed": downloads["failed"],
+        }
+
+    def get_latest(self):
+        return self.samples[-1] if self.samples else None
+
+    # average total cpu usage over the last seconds
+    def get_cpu_average(self, seconds=60):
+        cutoff = time.time() - seconds
+        values = [sum(s["cpu_percent"]) / len(s["cpu_percent"]) for s in list(self.samples) if s["time"] >= cutoff]
+        return round(sum(values) / len(values), 1) if values else None
+
+    def observe_request(self, route, status, seconds, render_seconds=0.0, response_bytes=None):
+        with self.lock:
+            if route not in self.routes:
+                self.routes[route] = RouteStats()
+            self.routes[route].observe(status, seconds, render_seconds, response_bytes)
+
+    def format_prometheus(self):
+        lines = []
+
+        def metric(name, metric_type, help_text, values):
+            lines.append("# HELP pikaraoke_%s %s" % (name, help_text))
+            lines.append("# TYPE pikaraoke_%s %s" % (name, metric_type))
+            for labels, value in values:
+                label_text = ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels.items())
+                lines.append("pikaraoke_%s%s %s" % (name, "{%s}" % label_text if label_text else "", value))
+
+        s = self.get_latest()
+        if s:
+            metric("cpu_percent", "gauge", "CPU usage per core.", [({"core": i}, v) for i, v in enumerate(s["cpu_percent"])])
+            metric("memory_available_bytes", "gauge", "Available memory.", [({}, s["memory_available_bytes"])])
+            metric("memory_total_bytes", "gauge", "Total memory.", [({}, s["memory_total_bytes"])])
+            metric("disk_free_bytes", "gauge", "Free space on the download disk.", [({}, s["disk_free_bytes"])])
+            metric("disk_total_bytes", "gauge", "Size of the download disk.", [({}, s["disk_total_bytes"])])
+            if s["ffmpeg_cpu_percent"] is not None:
+                metric("ffmpeg_cpu_percent", "gauge", "CPU usage of the playing ffmpeg process.", [({}, s["ffmpeg_cpu_percent"])])
+                metric("ffmpeg_rss_bytes", "gauge", "Resident memory of the playing ffmpeg process.", [({}, s["ffmpeg_rss_bytes"])])
+            metric("queue_length", "gauge", "Songs in the queue.", [({}, s["queue_length"])])
+            metric("library_songs", "gauge", "Songs in the library.", [({}, s["library_songs"])])
+            metric("downloads_active", "gauge", "Downloads in progress.", [({}, s["downloads_active"])])
+            metric("downloads_completed_total", "counter", "Finished downloads.", [({}, s["downloads_completed"])])
+            metric("downloads_failed_total", "counter", "Failed downloads.", [({}, s["downloads_failed"])])
+
+        routes = sorted(self.get_request_stats().items())
+        requests = []
+        histogram = []
+        handler = []
+        render = []
+        response_bytes = []
+        for route, stats in routes:
+            handler.append(({"route": route}, round(stats.latency_sum - stats.render_sum, 6)))
+            render.append(({"route": route}, round(stats.render_sum, 6)))
+            response_bytes.append(({"route": route}, stats.response_bytes_sum))
+            for status, count in sorted(stats.requests.items()):
+                requests.append(({"route": route, "status": status}, count))
+            cumulative = 0
+            for bound, count in zip(latency_buckets + ["+Inf"], stats.buckets):
+                cumulative += count
+                histogram.append(("_bucket", {"route": route, "le": bound}, cumulative))
+            histogram.append(("_sum", {"route": route}, round(stats.latency_sum, 6)))
+            histogram.append(("_count", {"route": route}, stats.count))
+        metric("requests_total", "counter", "HTTP requests per route and status code.", requests)
+        metric("request_handler_seconds_total", "counter", "Time spent in route handlers, excluding template rendering.", handler)
+        metric("request_render_seconds_total", "counter", "Time spent rendering templates per route.", render)
+        metric("response_bytes_total", "counter", "Response body bytes per route, where the size is known.", response_bytes)
+        lines.append("# HELP pikaraoke_request_duration_seconds HTTP request latency per route.")
+        lines.append("# TYPE pikaraoke_request_duration_seconds histogram")
+        for suffix, labels, value in histogram:
+            label_text = ",".join('%s="%s"' % (k, v) for k, v in labels.items())
+            lines.append("pikaraoke_request_duration_seconds%s{%s} %s" % (suffix, label_text, value))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+compact_threshold = 20000  # lines in the log, beyond which it gets compacted at startup
+keep_days = 30  # plays in the last days stay in the log as they are when compacting
+
+
+# Adds the plays in history to the song's in songs
+def combine(songs, song_path, history):
+    song = songs.setdefault(song_path, {"count": 0, "last_played": 0})
+    song["count"] += history["count"]
+    song["last_played"] = max(song["last_played"], history["last_played"])
+
+
+# Record of every song played, kept as an append-only log of json lines so recording a play is a single
+# small write. The log is replayed into per-song play counts and last played times at startup. Songs
+# that get renamed or replaced by their normalized version take their history along through "moved_to"
+# events. Once the log grows long, older plays are folded into one summary line per song.
+class PlayHistory:
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.lock = Lock()
+        self.songs = {}  # song path -> {"count", "last_played"}
+        self.load()
+
+    def load(self):
+        start_time = time.time()
+        lines = 0
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        continue  # a line cut short by a crash
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logging.warning("Could not read play history: " + str(e))
+            return
+        logging.info("Loaded play history of %d songs in %.2fs" % (len(self.songs), time.time() - start_time))
+        if lines > compact_threshold:
+            self.compact()
+
+    # Rewrites the log with one summary line per song for the plays older than keep_days, followed by the
+    # newer events as they were. Replaying it gives the same counts and last played times.
+    def compact(self):
+        cutoff = time.time() - keep_days * 24 * 3600
+        summary = {}
+        recent = []
+        with self.lock:
+            try:
+                with open(self.log_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            event = json.loads(line)
+                            # everything from the first recent event on is kept, so events stay in order
+                            if recent or event["time"] >= cutoff:
+                                recent.append(line if line.endswith("\n") else line + "\n")
+                            elif "moved_to" in event:
+                                moved = summary.pop(event["file"], None)
+                                if moved:
+                                    combine(summary, event["moved_to"], moved)
+                            else:
+                                song = summary.setdefault(event["file"], {"count": 0, "last_played": 0})
+                                song["count"] += event.get("count", 1)
+                                song["last_played"] = max(song["last_played"], event.get("last_played", event["time"]))
+                        except (ValueError, KeyError):
+                            continue
+                tmp_path = self.log_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for song_path, song in summary.items():
+                        f.write(json.dumps({"time": song["last_played"], "file": song_path, **song}) + "\n")
+                    f.writelines(recent)
+                os.replace(tmp_path, self.log_path)
+            except OSError as e:
+                logging.warning("Could not compact play history: " + str(e))
+                return
+        logging.info("Compacted play history to %d summaries and %d recent events" % (len(summary), len(recent)))
+
+    def apply(self, event):
+        if "moved_to" in event:
+            moved = self.songs.pop(event["file"], None)
+            if moved:
+                combine(self.songs, event["moved_to"], moved)
+        else:
+            # a play, or a summary of several written by compact
+            song = self.songs.setdefault(event["file"], {"count": 0, "last_played": 0})
+            song["count"] += event.get("count", 1)
+            song["last_played"] = max(song["last_played"], event.get("last_played", event["time"]))
+
+    def append(self, event):
+        with self.lock:
+            self.apply(event)
+            try:
+                os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(event) + "\n")
+            except OSError as e:
+                logging.warning("Could not write play history: " + str(e))
+
+    def record(self, song_path, user=None, room=None, semitones=0):
+        self.append({"time": time.time(), "file": song_path, "user": user, "room": room, "semitones": semitones})
+
+    # callback for Library.add_listener, and for renamed songs. A song merged into a duplicate adds its
+    # plays to the duplicate's.
+    def move(self, old_path, new_path):
+        if old_path != new_path:
+            self.append({"time": time.time(), "file": old_path, "moved_to": new_path})
+
+    # {"count", "last_played"} of the song, or None if it was never played
+    def get(self, song_path):
+        return self.songs.get(song_path)
@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import subprocess
+import time
+from collections import deque
+from threading import Lock, Thread
+
+import ffmpeg
+import psutil
+
+# nice values per kind of process. Web requests run at the default priority, so heavy media work can't
+# starve the threads that serve the splash screen and phones.
+#   interactive: short jobs someone is waiting on, like searches and probes
+#   playback:    the ffmpeg process streaming the current song, which has to stay realtime
+#   background:  downloads, normalization, loudness analysis and other batch work
+default_nice = {"interactive": 0, "playback": 5, "background": 15}
+monitor_interval = 1  # in seconds
+
+
+# ffprobe options as command line arguments, e.g. select_streams="v:0" -> ["-select_streams", "v:0"].
+# A None value is passed as a bare flag.
+def to_cmd_line_args(kwargs):
+    args = []
+    for key, value in sorted(kwargs.items()):
+        args.append("-" + key)
+        if value is not None:
+            args.append(str(value))
+    return args
+
+
+class ProcessInfo:
+    def __init__(self, process, name, kind, timeout):
+        self.process = process
+        self.name = name
+        self.kind = kind
+        self.timeout = timeout
+        self.started_at = time.time()
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.readers = []
+        self.killed_reason = None
+        self.cpu_seconds = None
+        self.max_rss = None
+        try:
+            self.ps = psutil.Process(process.pid)
+        except psutil.Error:
+            self.ps = None
+
+    # resource usage is sampled while the process runs, it can't be read anymore once it has been reaped
+    def sample(self):
+        if self.ps is None:
+            return
+        try:
+            with self.ps.oneshot():
+                cpu = self.ps.cpu_times()
+                rss = self.ps.memory_info().rss
+        except psutil.Error:
+            return
+        self.cpu_seconds = round(cpu.user + cpu.system, 2)
+        self.max_rss = max(rss, self.max_rss or 0)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "pid": self.process.pid,
+            "started_at": self.started_at,
+            "seconds": round((self.end_time or time.monotonic()) - self.start_time, 1),
+            "returncode": self.process.returncode,
+            "killed": self.killed_reason,
+            "cpu_seconds": self.cpu_seconds,
+            "max_rss": self.max_rss,
+        }
+
+
+# Starts and watches the external processes pikaraoke runs (ffmpeg, ffprobe, yt-dlp). Processes get a
+# nice/ionice level for their kind and the optional CPU affinity, are killed when they exceed their
+# timeout, and are always reaped. The most recent finished processes are kept with their resource usage.
+class ProcessSupervisor:
+    def __init__(self, nice=None, cpu_affinity=None, max_history=100):
+        self.nice = dict(default_nice, **(nice or {}))
+        self.cpu_affinity = cpu_affinity
+        self.lock = Lock()
+        self.running = {}  # pid -> ProcessInfo
+        self.finished = deque(maxlen=max_history)
+        self.monitor = None
+
+    def set_priority(self, info):
+        if info.ps is None or os.name != "posix":
+            return
+        try:
+            info.ps.nice(self.nice[info.kind])
+            if hasattr(psutil, "IOPRIO_CLASS_BE"):
+                info.ps.ionice(psutil.IOPRIO_CLASS_BE, 0 if info.kind == "interactive" else 7)
+            if self.cpu_affinity and hasattr(info.ps, "cpu_affinity"):
+                info.ps.cpu_affinity(self.cpu_affinity)
+        except (psutil.Error, ValueError, OSError) as e:
+            logging.debug("Could not set the priority of %s: %s", info.name, e)
+
+    # Starts cmd like subprocess.Popen. The process is killed after timeout secs if it's still running.
+    def spawn(self, cmd, name, kind="background", timeout=None, **popen_args):
+        process = subprocess.Popen(cmd, **popen_args)
+        info = ProcessInfo(process, name, kind, timeout)
+        self.set_priority(info)
+        with self.lock:
+            self.running[process.pid] = info
+            if self.monitor is None:
+                self.monitor = Thread(target=self.run_monitor, name="process-supervisor")
+                self.monitor.daemon = True
+                self.monitor.start()
+        return process
+
+    # threads reading the process' pipes, they are joined once the process is killed
+    def add_reader(self, process, thread):
+        with self.lock:
+            info = self.running.get(process.pid)
+            if info:
+                info.readers.append(thread)
+
+    def kill(self, process, reason="killed"):
+        with self.lock:
+            info = self.running.get(process.pid)
+        if process.poll() is None:
+            if info:
+                info.sample()
+                info.killed_reason = reason
+            process.kill()
+        process.wait()
+        if info:
+            for reader in info.readers:
+                reader.join(timeout=5)
+            self.reap(info)
+
+    # Like subprocess.run, raises subprocess.TimeoutExpired once the process was killed for taking too long
+    def run(self, cmd, name, kind="background", timeout=None, input=None, check=False, **popen_args):
+        # ffmpeg reads keyboard commands from stdin, so don't let it inherit ours
+        popen_args.setdefault("stdin", subprocess.PIPE if input is not None else subprocess.DEVNULL)
+        process = self.spawn(cmd, name, kind, **popen_args)
+        try:
+            stdout, stderr = process.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning("%s timed out after %ss, killing it" % (name, timeout))
+            self.kill(process, "timeout")
+            raise
+        except BaseException:
+            self.kill(process)
+            raise
+        self.reap(self.running.get(process.pid))
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+    def check_output(self, cmd, name, kind="background", timeout=None, **popen_args):
+        return self.run(cmd, name, kind, timeout, check=True, stdout=subprocess.PIPE, **popen_args).stdout
+
+    # Same as ffmpeg.probe, but supervised
+    def probe(self, filename, timeout=30, **kwargs):
+        cmd = ["ffprobe", "-show_format", "-show_streams", "-of", "json"]
+        cmd += to_cmd_line_args(kwargs)
+        cmd += [filename]
+        result = self.run(cmd, "ffprobe", "interactive", timeout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise ffmpeg.Error("ffprobe", result.stdout, result.stderr)
+        return json.loads(result.stdout.decode("utf-8"))
+
+    def reap(self, info):
+        if info is None:
+            return
+        with self.lock:
+            # pids get reused, so make sure the entry still belongs to this process
+            if self.running.get(info.process.pid) is not info:
+                return
+            del self.running[info.process.pid]
+            info.end_time = time.monotonic()
+            self.finished.append(info)
+        if info.killed_reason == "timeout" or (info.process.returncode or 0) > 0:
+            logging.debug("%s exited: %s", info.name, info.to_dict())
+
+    def run_monitor(self):
+        while True:
+            time.sleep(monitor_interval)
+            with self.lock:
+                running = list(self.running.values())
+            for info in running:
+                if info.process.poll() is not None:
+                    self.reap(info)
+                    continue
+                info.sample()
+                if info.timeout and time.monotonic() - info.start_time > info.timeout:
+                    logging.warning("%s exceeded its timeout of %ss, killing it" % (info.name, info.timeout))
+                    self.kill(info.process, "timeout")
+
+    def get_stats(self):
+        with self.lock:
+            running = list(self.running.values())
+            finished = list(self.finished)
+        return {
+            "running": [i.to_dict() for i in running],
+            "finished": [i.to_dict() for i in reversed(finished)],
+        }
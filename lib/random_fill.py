@@ -0,0 +1,67 @@
+import heapq
+import random
+import time
+
+fill_modes = ["uniform", "popular", "recent"]
+max_weight = 10.0  # of a song, relative to a song that was never played
+recent_half_life = 30 * 24 * 3600  # in seconds, after which a play adds half as much weight in recent mode
+attempts_per_song = 50  # random draws per requested song before falling back to a full pass
+
+
+# Picks random songs for the queue, weighted by the play history:
+#   uniform  every song is as likely
+#   popular  songs played more often are more likely, up to max_weight
+#   recent   songs played in the last weeks are more likely, fading with recent_half_life
+# Songs played within the exclusion window are never picked. Picking k songs draws random songs from the
+# library and accepts each with a chance proportional to its weight (rejection sampling), which takes
+# O(k) draws without copying or scanning the song list. Only when most songs are excluded or unlikely does
+# it fall back to one weighted pass over the whole library.
+class RandomFill:
+    def __init__(self, play_history, mode="popular", exclude_seconds=0):
+        self.play_history = play_history
+        self.mode = mode
+        self.exclude_seconds = exclude_seconds
+        self.max_weight = 1.0 if mode == "uniform" else max_weight
+
+    def get_weight(self, song_path, now):
+        history = self.play_history.get(song_path)
+        if history is None:
+            return 1.0
+        age = now - history["last_played"]
+        if age < self.exclude_seconds:
+            return 0.0
+        if self.mode == "popular":
+            return min(1.0 + history["count"], max_weight)
+        if self.mode == "recent":
+            return 1.0 + (max_weight - 1.0) * 0.5 ** (age / recent_half_life)
+        return 1.0
+
+    # Up to amount distinct songs, none of them in exclude
+    def pick(self, songs, amount, exclude=()):
+        now = time.time()
+        picked = []
+        seen = set(exclude)
+        attempts = amount * attempts_per_song
+        while len(picked) < amount and attempts > 0 and songs:
+            attempts -= 1
+            song = songs[random.randrange(len(songs))]
+            if song in seen:
+                continue
+            if random.random() * self.max_weight < self.get_weight(song, now):
+                picked.append(song)
+                seen.add(song)
+        if len(picked) < amount:
+            picked += self.pick_weighted(songs, amount - len(picked), seen, now)
+        return picked
+
+    # Weighted sampling without replacement in one pass, keeping the songs with the largest
+    # random() ** (1 / weight) keys (Efraimidis-Spirakis)
+    def pick_weighted(self, songs, amount, seen, now):
+        keyed = []
+        for song in songs:
+            if song in seen:
+                continue
+            weight = self.get_weight(song, now)
+            if weight > 0:
+                keyed.append((random.random() ** (1.0 / weight), song))
+        return [song for key, song in heapq.nlargest(amount, keyed)]
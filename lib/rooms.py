@@ -0,0 +1,19 @@
+room_environ_key = "pikaraoke.room"
+
+
+# WSGI middleware for hosting several rooms from one app. Requests under /<room>/ get the room prefix moved
+# from PATH_INFO to SCRIPT_NAME, so the app's routes and url_for() work unchanged within each room, and the
+# room name stored in the environ. Requests without a room prefix are left alone and go to the default room.
+class RoomDispatcher:
+    def __init__(self, app, room_names):
+        self.app = app
+        self.room_names = set(room_names)
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        name = path.split("/", 2)[1] if path.startswith("/") else ""
+        if name in self.room_names:
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + "/" + name
+            environ["PATH_INFO"] = path[len(name) + 1 :] or "/"
+            environ[room_environ_key] = name
+        return self.app(environ, start_response)
@@ -0,0 +1,82 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+
+# Persistent per-song key/value store, saved as a json file. Entries are tied to the song file's
+# size and modification time, so a replaced or edited file is treated as a cache miss.
+class SongCache:
+    def __init__(self, cache_file, save_interval=10):
+        self.cache_file = cache_file
+        self.save_interval = save_interval  # in seconds, limits rewrites of the cache file
+        self.lock = Lock()
+        self.entries = {}
+        self.dirty = False
+        self.last_save = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read cache file %s, starting empty: %s" % (self.cache_file, e))
+            self.entries = {}
+
+    def file_signature(self, song_path):
+        try:
+            st = os.stat(song_path)
+        except OSError:
+            return None
+        return [st.st_size, int(st.st_mtime)]
+
+    def get(self, song_path, default=None):
+        entry = self.entries.get(song_path)
+        if entry is None or entry["signature"] != self.file_signature(song_path):
+            return default
+        return entry["value"]
+
+    def has(self, song_path):
+        return self.get(song_path) is not None
+
+    def set(self, song_path, value):
+        signature = self.file_signature(song_path)
+        if signature is None:
+            return
+        with self.lock:
+            self.entries[song_path] = {"signature": signature, "value": value}
+            self.dirty = True
+        if time.time() - self.last_save > self.save_interval:
+            self.save()
+
+    def remove(self, song_path):
+        with self.lock:
+            if self.entries.pop(song_path, None) is not None:
+                self.dirty = True
+
+    # Drop entries for songs that are no longer in the library
+    def prune(self, song_paths):
+        keep = set(song_paths)
+        with self.lock:
+            stale = [p for p in self.entries if p not in keep]
+            for p in stale:
+                del self.entries[p]
+            if stale:
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries)
+            self.dirty = False
+            self.last_save = time.time()
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import os
+import subprocess
+import time
+import zipfile
+from queue import Queue
+from threading import Lock, Thread
+
+import ffmpeg
+
+from lib.process_supervisor import ProcessSupervisor
+from lib.song_cache import SongCache
+from lib.transcoder import get_song_files
+
+thumbnail_width = 160  # in pixels
+video_offset = 10  # in seconds, skips the black frames and fade in at the start of most videos
+cdg_offset = 5  # in seconds, cdg graphics start from a blank screen and draw the title screen first
+thumbnail_timeout = 60  # in seconds
+default_max_size = 200  # in MB
+
+
+# Reads the cdg graphics out of a zipped CDG archive without extracting it to disk
+def read_zipped_cdg(file_path):
+    with zipfile.ZipFile(file_path, "r") as zip_ref:
+        for name in zip_ref.namelist():
+            if os.path.splitext(name)[1].casefold() == ".cdg":
+                return zip_ref.read(name)
+    return None
+
+
+# Extracts a small jpeg thumbnail of every video and CDG song on a small pool of background ffmpeg
+# workers. The thumbnails are kept in cache_dir, named by a hash of the song's path, size and
+# modification time, so a thumbnail never changes once written and can be cached by browsers for good.
+# The least recently shown thumbnails are removed when the cache grows past max_size. Their songs stay in
+# the index as evicted, so rescans of the library don't extract them again, while showing one of them
+# again extracts its thumbnail on demand.
+class ThumbnailGenerator:
+    def __init__(self, cache_dir, workers=1, max_size=default_max_size, supervisor=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1024 * 1024  # in bytes
+        # song path -> thumbnail key, "" for songs without any picture, or False if it was evicted
+        self.index = SongCache(os.path.join(cache_dir, "index.json"))
+        self.last_used = {}  # thumbnail key -> when get_keys last returned it
+        self.supervisor = supervisor or ProcessSupervisor()
+        self.pending = Queue()
+        self.queued = set()
+        self.lock = Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(e.stat().st_size for e in os.scandir(cache_dir) if e.name.endswith(".jpg"))
+        for i in range(workers):
+            Thread(target=self.run, daemon=True, name="thumbnails-%d" % i).start()
+
+    # Queues the song for extraction unless it has an index entry, or even then if force is set
+    def generate(self, song_path, force=False):
+        with self.lock:
+            if song_path in self.queued or (not force and self.index.has(song_path)):
+                return False
+            self.queued.add(song_path)
+        self.pending.put(song_path)
+        return True
+
+    # Queue every song that doesn't have a thumbnail yet
+    def generate_library(self, song_paths):
+        count = 0
+        for song_path in song_paths:
+            if self.generate(song_path):
+                count += 1
+        if count > 0:
+            logging.info("Queued %d songs for thumbnail extraction" % count)
+
+    # Thumbnail keys of the songs that have one, see get_path. Doesn't touch the song files, so it's cheap
+    # enough for every song on a page. Evicted thumbnails of the songs get extracted again.
+    def get_keys(self, song_paths):
+        keys = {}
+        now = time.time()
+        for song_path in song_paths:
+            entry = self.index.entries.get(song_path)
+            if entry is None:
+                continue
+            if entry["value"]:
+                keys[song_path] = entry["value"]
+                self.last_used[entry["value"]] = now
+            elif entry["value"] is False:
+                self.generate(song_path, force=True)
+        return keys
+
+    def run(self):
+        while True:
+            song_path = self.pending.get()
+            try:
+                self.index.set(song_path, self.extract(song_path))
+            except Exception as e:
+                logging.error("Thumbnail extraction failed for %s: %s" % (song_path, e))
+            finally:
+                with self.lock:
+                    self.queued.discard(song_path)
+                if self.pending.empty():
+                    self.index.save()
+
+    # Writes the song's thumbnail to the cache, returns its key or "" if the song has no picture
+    def extract(self, song_path):
+        signature = self.index.file_signature(song_path)
+        if signature is None:
+            return ""
+        ext = os.path.splitext(song_path)[1].casefold()
+        stdin = None
+        if ext == ".zip":
+            stdin = read_zipped_cdg(song_path)
+            if stdin is None:
+                return ""
+            source, input_args, offset = "pipe:", {"f": "cdg"}, cdg_offset
+        elif ext == ".mp3":
+            song_files = get_song_files(song_path)
+            if len(song_files) < 2:
+                return ""
+            source, input_args, offset = song_files[1], {}, cdg_offset
+        else:
+            source, input_args, offset = song_path, {}, video_offset
+
+        logging.debug("Extracting thumbnail: %s", song_path)
+        cdg = source != song_path
+        jpeg = self.render(source, input_args, offset, cdg, stdin)
+        if not jpeg:
+            jpeg = self.render(source, input_args, 0, cdg, stdin)  # shorter than the offset
+        if not jpeg:
+            return ""
+
+        key = hashlib.sha1(("%s:%d:%d" % (song_path, *signature)).encode("utf-8", "ignore")).hexdigest()
+        path = self.get_path(key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(jpeg)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += len(jpeg)
+        self.trim()
+        return key
+
+    def render(self, source, input_args, offset, cdg, stdin):
+        if cdg:
+            # cdg streams can't be seeked, they're decoded up to the offset instead
+            input, output_args = ffmpeg.input(source, **input_args), {"ss": offset}
+        else:
+            input, output_args = ffmpeg.input(source, ss=offset, **input_args), {}
+        stream = input.video.filter("scale", thumbnail_width, -2).output(
+            "pipe:", vframes=1, f="image2pipe", vcodec="mjpeg", **{"q:v": 5}, **output_args
+        )
+        cmd = stream.global_args("-nostats").compile()
+        result = self.supervisor.run(
+            cmd, "ffmpeg", timeout=thumbnail_timeout, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        return result.stdout if result.returncode == 0 else None
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".jpg")
+
+    # Removes the least recently written or shown thumbnails until the cache fits in max_size
+    def trim(self):
+        with self.lock:
+            if self.size <= self.max_size:
+                return
+            entries = []
+            for e in os.scandir(self.cache_dir):
+                if e.name.endswith(".jpg"):
+                    st = e.stat()
+                    key = e.name[:-4]
+                    entries.append((max(st.st_mtime, self.last_used.get(key, 0)), st.st_size, key))
+            removed = set()
+            for used, size, key in sorted(entries):
+                if self.size <= self.max_size * 0.9:
+                    break
+                os.remove(self.get_path(key))
+                self.size -= size
+                removed.add(key)
+                self.last_used.pop(key, None)
+        # marked rather than removed, so generate_library doesn't queue them again
+        with self.index.lock:
+            for entry in self.index.entries.values():
+                if entry["value"] in removed:
+                    entry["value"] = False
+                    self.index.dirty = True
+        logging.info("Removed %d thumbnails to keep the cache under %d MB" % (len(removed), self.max_size // 1024 // 1024))
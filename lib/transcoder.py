@@ -0,0 +1,296 @@
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import time
+from queue import Empty, Queue
+from threading import Thread
+
+import requests
+
+from lib.ffmpeg_pipeline import build_pipeline, get_default_vcodec, is_audio_reencoded, is_video_copied
+from lib.ffmpeg_stats import is_progress_line
+from lib.file_resolver import FileResolver
+
+health_check_interval = 10  # in seconds
+request_timeout = 5  # in seconds, for everything but uploads
+upload_timeout = 600  # in seconds
+# build_pipeline arguments a job may set, see encode_options in LocalTranscoder.start
+encode_option_names = ["default_vcodec", "preset", "vbitrate", "max_height"]
+# ffmpeg's output goes to its own logger, which setup_logging rate limits
+ffmpeg_logger = logging.getLogger("ffmpeg")
+
+
+# Support function for reading lines from ffmpeg stderr without blocking, until ffmpeg exits. Progress
+# lines end with \r rather than \n, so both are treated as line breaks. Every line is parsed into stats,
+# while progress lines are left out of the queue.
+def enqueue_output(process, queue, stats=None):
+    out = process.stderr
+    buffer = b""
+    for chunk in iter(lambda: out.read1(4096), b""):
+        buffer += chunk
+        lines = re.split(rb"[\r\n]", buffer)
+        buffer = lines.pop()
+        for line in lines:
+            text = decode_ignore(line)
+            if not text:
+                continue
+            if stats:
+                stats.parse_line(text)
+            if not is_progress_line(text):
+                queue.put(line)
+    if buffer:
+        queue.put(buffer)
+    out.close()
+    if stats:
+        stats.finish(process.wait())
+
+def decode_ignore(input):
+    return input.decode("utf-8", "ignore").strip()
+
+
+# Whether playing the resolved file (see FileResolver) only remuxes it, which any machine can do
+def is_remux_only(fr, semitones):
+    return is_video_copied(fr) and not is_audio_reencoded(fr, semitones)
+
+
+# Paths of the files that make up a song: the song itself and, for mp3s, its .cdg file
+def get_song_files(file_path):
+    files = [file_path]
+    base, ext = os.path.splitext(file_path)
+    if ext.casefold() == ".mp3":
+        directory = os.path.dirname(file_path)
+        rule = re.compile(re.escape(os.path.basename(base) + ".cdg"), re.IGNORECASE)
+        files += [os.path.join(directory, n) for n in os.listdir(directory) if rule.match(n)][:1]
+    return files
+
+
+# A song being transcoded by a local ffmpeg process, which serves the stream on stream_url
+class LocalTranscode:
+    def __init__(self, supervisor, process, stream_url, stats, audio_reencoded):
+        self.supervisor = supervisor
+        self.process = process
+        self.stream_url = stream_url
+        self.stats = stats
+        self.audio_reencoded = audio_reencoded
+        # ffmpeg outputs everything useful to stderr for some insane reason!
+        # prevent reading stderr from being a blocking action. The reader keeps collecting stats for the
+        # whole song.
+        self.output = Queue()
+        t = Thread(target=enqueue_output, args=(process, self.output, stats))
+        t.daemon = True
+        t.start()
+        supervisor.add_reader(process, t)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def is_running(self):
+        return self.process.poll() is None
+
+    # Logs the next line of ffmpeg output, waiting up to timeout secs for one. Returns the line or None.
+    def log_output(self, timeout=0):
+        try:
+            line = self.output.get(timeout=timeout) if timeout else self.output.get_nowait()
+        except Empty:
+            return None
+        text = decode_ignore(line)
+        ffmpeg_logger.debug("[FFMPEG] %s", text)
+        return text
+
+    # Blocks until the stream can be played, returns False if ffmpeg exited before that
+    def wait_until_ready(self):
+        while self.is_running():
+            line = self.log_output(0.1)
+            # Ffmpeg outputs "Stream #0" when the stream is ready to consume
+            if line and "Stream #" in line:
+                return True
+        return False
+
+    def stop(self):
+        # wait for it, so it doesn't linger as a zombie, and for its stderr reader to finish
+        self.supervisor.kill(self.process)
+
+
+# Runs the ffmpeg pipeline for a song on this machine
+class LocalTranscoder:
+    def __init__(self, supervisor, platform, stats_log, encode_profiles=None, scope=None):
+        self.supervisor = supervisor
+        self.platform = platform
+        self.stats_log = stats_log
+        self.encode_profiles = encode_profiles
+        self.scope = scope  # see FileResolver
+
+    # Starts streaming the song from offset seconds in on listen_url, which the player reaches at
+    # stream_url. encode_options are build_pipeline's encoder arguments, chosen for this machine unless given.
+    def start(self, file_path, semitones, listen_url, stream_url, gain_db=None, encode_options=None, offset=0):
+        fr = FileResolver(file_path, self.scope)
+
+        # pick encoder settings that keep up with realtime on this machine when the video gets transcoded
+        if encode_options is None:
+            if self.encode_profiles and not is_video_copied(fr):
+                encode_options = self.encode_profiles.choose(fr)
+            else:
+                encode_options = {"default_vcodec": get_default_vcodec(self.platform)}
+
+        if (fr.cdg_file_path != None):
+            logging.info("Playing CDG/MP3 file: " + file_path)
+        output = build_pipeline(fr, listen_url, semitones=semitones, gain_db=gain_db, offset=offset, **encode_options)
+
+        args = output.get_args()
+        logging.debug("COMMAND: ffmpeg %s", " ".join(args))
+
+        stats = self.stats_log.start(
+            file_path,
+            semitones,
+            vcodec="copy" if is_video_copied(fr) else encode_options["default_vcodec"],
+            acodec="aac" if is_audio_reencoded(fr, semitones) else "copy",
+        )
+        process = self.supervisor.spawn(
+            output.compile(), "ffmpeg", "playback", stdin=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        return LocalTranscode(self.supervisor, process, stream_url, stats, is_audio_reencoded(fr, semitones))
+
+
+# A song being transcoded by a transcode worker (see transcode_worker.py), which serves the stream itself
+class RemoteTranscode:
+    pid = None
+
+    def __init__(self, session, worker_url, job_id, stream_url, stats, audio_reencoded):
+        self.session = session
+        self.worker_url = worker_url
+        self.job_id = job_id
+        self.stream_url = stream_url
+        self.stats = stats
+        self.audio_reencoded = audio_reencoded
+        self.running = True
+
+    def is_running(self):
+        return self.running
+
+    # the worker keeps ffmpeg's output, this only paces the caller
+    def log_output(self, timeout=0):
+        time.sleep(timeout)
+        return None
+
+    def wait_until_ready(self):
+        while self.running:
+            try:
+                r = self.session.get(
+                    "%s/jobs/%s/ready" % (self.worker_url, self.job_id),
+                    params={"timeout": request_timeout},
+                    timeout=request_timeout * 2,
+                )
+                r.raise_for_status()
+                status = r.json()
+            except (requests.RequestException, ValueError) as e:
+                logging.error("Lost the transcode worker while waiting for the stream: " + str(e))
+                self.running = False
+                return False
+            if status["ready"]:
+                return True
+            self.running = status["running"]
+        return False
+
+    def stop(self):
+        if self.job_id is None:
+            return
+        try:
+            r = self.session.delete("%s/jobs/%s" % (self.worker_url, self.job_id), timeout=request_timeout)
+            r.raise_for_status()
+            self.stats.load(r.json())
+        except (requests.RequestException, ValueError) as e:
+            logging.warning("Could not stop transcode job %s: %s" % (self.job_id, e))
+        self.running = False
+        self.job_id = None
+
+
+# Hands transcoding to a worker on another machine. Songs that only need remuxing stay local, as does
+# everything while the worker fails its health checks or when a job can't be started on it.
+class RemoteTranscoder:
+    def __init__(self, worker_url, fallback, stats_log, token=None):
+        self.worker_url = worker_url.rstrip("/")
+        self.session = requests.Session()
+        if token:
+            # the worker's shared secret, see --token in transcode_worker.py
+            self.session.headers["Authorization"] = "Bearer " + token
+        self.fallback = fallback
+        self.stats_log = stats_log
+        self.healthy = False
+        t = Thread(target=self.run_health_checks, name="transcode-worker-health")
+        t.daemon = True
+        t.start()
+
+    def check_health(self):
+        reason = ""
+        try:
+            r = self.session.get(self.worker_url + "/health", timeout=request_timeout)
+            healthy = r.ok
+            if r.status_code == 401:
+                reason = " (wrong token)"
+        except requests.RequestException:
+            healthy = False
+        if healthy != self.healthy:
+            if healthy:
+                logging.info("Transcode worker is available: " + self.worker_url)
+            else:
+                logging.warning("Transcode worker is unavailable%s, transcoding locally: %s" % (reason, self.worker_url))
+        self.healthy = healthy
+
+    def run_health_checks(self):
+        while True:
+            self.check_health()
+            time.sleep(health_check_interval)
+
+    def start(self, file_path, semitones, listen_url, stream_url, gain_db=None, encode_options=None, offset=0):
+        # resolving a zip extracts it, which the local fallback then reuses
+        if self.healthy and not is_remux_only(FileResolver(file_path, self.fallback.scope), semitones):
+            try:
+                return self.start_remote(file_path, semitones, gain_db, encode_options, offset)
+            except requests.HTTPError as e:
+                # the worker is up, but couldn't start this song
+                logging.warning("Transcode worker refused the song, transcoding locally: " + str(e))
+            except (requests.RequestException, ValueError, KeyError, OSError) as e:
+                logging.warning("Transcode worker failed, transcoding locally: " + str(e))
+                self.healthy = False
+        return self.fallback.start(file_path, semitones, listen_url, stream_url, gain_db, encode_options, offset)
+
+    def start_remote(self, file_path, semitones, gain_db, encode_options, offset=0):
+        job = {
+            "path": file_path,
+            "semitones": semitones,
+            "gain_db": gain_db,
+            "encode_options": encode_options,
+            "offset": offset,
+        }
+        r = self.session.post(self.worker_url + "/jobs", json=job, timeout=request_timeout)
+        if r.status_code == 404:
+            # the worker can't see our song directory, so send the song over
+            job["path"] = self.upload(file_path)
+            r = self.session.post(self.worker_url + "/jobs", json=job, timeout=request_timeout)
+        r.raise_for_status()
+        d = r.json()
+        logging.info("Transcoding on %s: %s" % (self.worker_url, file_path))
+        stats = self.stats_log.start(file_path, semitones, d["vcodec"], d["acodec"])
+        return RemoteTranscode(self.session, self.worker_url, d["id"], d["stream_url"], stats, d["audio_reencoded"])
+
+    # Uploads the song's files, returns the song's path on the worker
+    def upload(self, file_path):
+        st = os.stat(file_path)
+        # the worker keeps uploads, so the same file is only sent once
+        key = hashlib.sha1(("%s:%d:%d" % (file_path, st.st_size, st.st_mtime)).encode("utf-8", "ignore")).hexdigest()
+        song_path = None
+        for path in get_song_files(file_path):
+            url = "%s/files/%s/%s" % (self.worker_url, key, requests.utils.quote(os.path.basename(path)))
+            r = self.session.get(url, timeout=request_timeout)
+            if r.status_code == 404:
+                logging.info("Uploading to the transcode worker: " + path)
+                with open(path, "rb") as f:
+                    # requests sends an empty file chunked, without the length the worker requires
+                    data = f if os.path.getsize(path) else b""
+                    r = self.session.put(url, data=data, timeout=(request_timeout, upload_timeout))
+            r.raise_for_status()
+            song_path = song_path or r.json()["path"]
+        return song_path
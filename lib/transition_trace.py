@@ -0,0 +1,118 @@
+import logging
+import time
+from collections import deque
+from threading import Lock
+
+from lib.percentile import percentile
+
+# Stages of a song transition in the order they happen. Each mark is the time since the transition began.
+#   splash_delay:   the run loop picked up the next song and starts waiting splash_delay secs
+#   play_file:      the wait is over and play_file starts resolving the song
+#   ffmpeg_spawned: the ffmpeg process was started
+#   stream_ready:   ffmpeg printed "Stream #" and the song was handed to the splash screen
+#   first_frame:    the splash screen's video element loaded its first frame
+#   playing:        the splash screen confirmed playback (/start_song)
+transition_marks = ["splash_delay", "play_file", "ffmpeg_spawned", "stream_ready", "first_frame", "playing"]
+
+
+# Timeline of one gap between songs
+class Transition:
+    def __init__(self, reason):
+        self.reason = reason
+        self.started_at = time.time()
+        self.start_time = time.perf_counter()
+        self.file_path = None
+        self.marks = {}
+        self.outcome = None
+
+    def mark(self, name):
+        # only the first occurrence counts, e.g. when the splash screen reloads the video
+        if name not in self.marks:
+            self.marks[name] = round(time.perf_counter() - self.start_time, 3)
+
+    def get_stages(self):
+        stages = {}
+        previous = ("begin", 0.0)
+        for name in transition_marks:
+            if name in self.marks:
+                stages["%s-%s" % (previous[0], name)] = round(self.marks[name] - previous[1], 3)
+                previous = (name, self.marks[name])
+        return stages
+
+    def to_dict(self):
+        return {
+            "reason": self.reason,
+            "outcome": self.outcome,
+            "file": self.file_path,
+            "started_at": self.started_at,
+            "marks": dict(self.marks),
+            "stages": self.get_stages(),
+            "total": self.marks.get("playing"),
+        }
+
+
+# Traces the dead time between the end of one song and the start of the next. end_song (or the run loop,
+# when a song gets queued while nothing plays) begins a transition, the playback path marks its stages,
+# and the splash screen's start confirmation completes it. Completed transitions go to a ring buffer.
+class TransitionTracer:
+    def __init__(self, max_transitions=100):
+        self.lock = Lock()
+        self.current = None
+        self.transitions = deque(maxlen=max_transitions)
+
+    def begin(self, reason):
+        with self.lock:
+            self.current = Transition(reason)
+
+    def is_active(self):
+        return self.current is not None
+
+    def mark(self, name, file_path=None):
+        with self.lock:
+            if self.current:
+                self.current.mark(name)
+                if file_path:
+                    self.current.file_path = file_path
+
+    def finish(self, outcome="playing"):
+        with self.lock:
+            transition = self.current
+            if transition is None:
+                return
+            transition.mark(outcome)
+            transition.outcome = outcome
+            self.transitions.append(transition)
+            self.current = None
+        logging.info(
+            "Song transition (%s) %s after %.2fs: %s"
+            % (transition.reason, outcome, transition.marks[outcome], transition.get_stages())
+        )
+
+    # nothing to play next, so the idle time until someone queues a song isn't part of a transition
+    def cancel(self):
+        with self.lock:
+            self.current = None
+
+    def get_summary(self):
+        with self.lock:
+            transitions = [t for t in self.transitions if t.outcome == "playing"]
+        summary = {"count": len(transitions)}
+        if not transitions:
+            return summary
+        series = {"total": [t.marks["playing"] for t in transitions]}
+        for t in transitions:
+            for stage, seconds in t.get_stages().items():
+                series.setdefault(stage, []).append(seconds)
+        for name, values in series.items():
+            summary[name] = {
+                "p50": round(percentile(values, 50), 3),
+                "p90": round(percentile(values, 90), 3),
+                "max": max(values),
+                "count": len(values),
+            }
+        return summary
+
+    def to_list(self):
+        with self.lock:
+            transitions = list(self.transitions)
+        return [t.to_dict() for t in reversed(transitions)]
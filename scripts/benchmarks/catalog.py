@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Micro-benchmarks for song catalog and queue operations on synthetic libraries of growing size.
+# Times each operation (median of several runs) and measures its peak python memory allocation.
+#
+# Example: python3 scripts/benchmarks/catalog.py --sizes 10000,50000,200000
+import argparse
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import quote
+
+from common import generate_library, save_results, stubs_dir
+
+import app as pikaraoke_app  # noqa: E402 (common puts the repo on sys.path)
+import karaoke  # noqa: E402
+
+
+# Times fn, counting the runs that raise as errors, so a failing operation doesn't pass for a fast one
+def measure(fn, repeat):
+    timings = []
+    errors = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            errors += 1
+            logging.warning("%s failed: %s", getattr(fn, "__name__", fn), e)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+    except Exception:
+        errors += 1
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "median_ms": round(statistics.median(timings) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+        "peak_kb": round(peak / 1024.0, 1),
+        "errors": errors,
+    }
+
+
+class HTTPError(Exception):
+    pass
+
+
+# test_client responses have no raise_for_status
+def raise_for_status(response):
+    if not 200 <= response.status_code < 300:
+        raise HTTPError("%s for %s" % (response.status, response.request.url))
+    return response
+
+
+def run_size(size, repeat, queue_length, work_dir):
+    rng = random.Random(size)
+    songs_dir = os.path.join(work_dir, "songs-%d" % size)
+    print("Generating %d songs..." % size)
+    generate_library(songs_dir, size, seed=size, subdirs=10)
+
+    k = karaoke.Karaoke(
+        download_path=songs_dir + "/",
+        youtubedl_path=os.path.join(stubs_dir, "yt-dlp"),
+        data_path=os.path.join(work_dir, "data-%d" % size),
+        log_level=logging.CRITICAL,  # lookups of missing ids log errors
+        url="http://127.0.0.1:5555",
+    )
+    k.startup_events["library"].wait()
+    pikaraoke_app.k = k
+    pikaraoke_app.app.jinja_env.globals.update(filename_from_path=pikaraoke_app.filename_from_path)
+    pikaraoke_app.app.jinja_env.globals.update(url_escape=quote)
+    client = pikaraoke_app.app.test_client()
+
+    def get(path, **kwargs):
+        return raise_for_status(client.get(path, **kwargs))
+
+    songs = list(k.available_songs)
+    youtube_ids = [os.path.splitext(s)[0].split("---")[1] for s in songs if "---" in s]
+
+    def fill_queue():
+        k.queue = []
+        for song in rng.sample(songs, queue_length):
+            k.enqueue(song, "bench")
+
+    results = {}
+    print("Benchmarking %d songs..." % len(songs))
+    results["get_available_songs"] = measure(k.get_available_songs, repeat)
+    results["autocomplete"] = measure(lambda: get("/autocomplete", query_string={"q": "love"}), repeat)
+    results["browse"] = measure(lambda: get("/browse"), repeat)
+    results["browse_letter"] = measure(lambda: get("/browse", query_string={"letter": "m"}), repeat)
+    results["browse_date_sort"] = measure(lambda: get("/browse", query_string={"sort": "date"}), repeat)
+    results["find_song_by_youtube_id"] = measure(lambda: k.find_song_by_youtube_id(rng.choice(youtube_ids)), repeat)
+    results["find_song_by_youtube_id_missing"] = measure(lambda: k.find_song_by_youtube_id("missing-id1"), repeat)
+
+    fill_queue()
+    results["enqueue"] = measure(lambda: (k.enqueue(rng.choice(songs), "bench"), k.queue.pop()), repeat)
+    results["is_song_in_queue"] = measure(lambda: k.is_song_in_queue(rng.choice(songs)), repeat)
+    last_song = k.queue[-1]["file"]
+    results["queue_edit_up"] = measure(lambda: k.queue_edit(last_song, "up"), repeat)
+    results["queue_edit_down"] = measure(lambda: k.queue_edit(last_song, "down"), repeat)
+
+    def add_random():
+        k.queue = []
+        k.queue_add_random(20)
+
+    results["queue_add_random_20"] = measure(add_random, repeat)
+    k.queue = []
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark catalog and queue operations")
+    parser.add_argument("--sizes", default="10000,50000,200000", help="Comma separated library sizes (default: 10000,50000,200000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per operation (default: 5)")
+    parser.add_argument("--queue-length", type=int, default=50, help="Queue length for queue operations (default: 50)")
+    parser.add_argument("--output", default="catalog_results.json", help="Where to save the JSON report")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pikaraoke-catalog-bench-")
+    # write the QR code into the work dir instead of the repo
+    karaoke.Karaoke.base_path = work_dir
+    results = {}
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            results[str(size)] = run_size(size, args.repeat, args.queue_length, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    operations = list(next(iter(results.values())).keys())
+    sizes = list(results.keys())
+    print("\n%-32s" % "median ms (peak KB)" + "".join("%22s" % s for s in sizes))
+    for op in operations:
+        row = "".join("%22s" % ("%.2f (%.0f)" % (results[s][op]["median_ms"], results[s][op]["peak_kb"])) for s in sizes)
+        print("%-32s" % op + row)
+    failed = ["%s at %s songs" % (op, s) for s in sizes for op in operations if results[s][op]["errors"]]
+    if failed:
+        print("\nErrors in: " + ", ".join(failed))
+    save_results(args.output, "catalog", results, vars(args))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
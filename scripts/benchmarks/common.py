@@ -0,0 +1,95 @@
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(os.path.dirname(benchmarks_dir))
+stubs_dir = os.path.join(benchmarks_dir, "stubs")
+
+# make the pikaraoke modules importable when running a benchmark script directly
+if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
+
+words = [
+    "love", "night", "heart", "baby", "dance", "dream", "fire", "rain", "summer", "girl", "time", "light",
+    "river", "blue", "forever", "home", "crazy", "wild", "sweet", "road", "star", "angel", "moon", "rock",
+]
+artists = [
+    "ABBA", "Queen", "Adele", "Oasis", "Journey", "Bon Jovi", "Toto", "Madonna", "Whitney Houston",
+    "Elton John", "Spice Girls", "Backstreet Boys", "Taylor Swift", "Bruno Mars", "The Killers",
+]
+
+
+def youtube_id(rng):
+    return "".join(rng.choice(string.ascii_letters + string.digits + "-_") for _ in range(11))
+
+
+def song_title(rng):
+    title = " ".join(rng.choice(words).capitalize() for _ in range(rng.randint(1, 4)))
+    return "%s - %s (Karaoke Version)" % (rng.choice(artists), title)
+
+
+# Generates a synthetic song library. Most songs are YouTube downloads named "Title---ytid.ext", the rest
+# are zipped or loose mp3+cdg karaoke tracks, mirroring a typical long-running pikaraoke install.
+# Files are empty (or tiny) since catalog operations only look at names and metadata.
+def generate_library(path, size, seed=1, subdirs=0):
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    dirs = [path] + [os.path.join(path, "folder%d" % i) for i in range(subdirs)]
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    songs = []
+    for i in range(size):
+        d = rng.choice(dirs)
+        kind = rng.random()
+        title = song_title(rng) + " %d" % i  # keep names unique
+        if kind < 0.8:
+            song = os.path.join(d, "%s---%s.%s" % (title, youtube_id(rng), rng.choice(["mp4", "mp4", "mp4", "mkv", "webm"])))
+            open(song, "w").close()
+        elif kind < 0.9:
+            song = os.path.join(d, title + ".zip")
+            open(song, "w").close()
+        else:
+            song = os.path.join(d, title + ".mp3")
+            open(song, "w").close()
+            open(os.path.join(d, title + ".cdg"), "w").close()
+        # spread out creation times so date sorting has some work to do
+        t = time.time() - rng.randint(0, 365 * 24 * 3600)
+        os.utime(song, (t, t))
+        songs.append(song)
+    return songs
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(output_path, benchmark, results, params):
+    report = {
+        "benchmark": benchmark,
+        "revision": git_revision(),
+        "timestamp": int(time.time()),
+        "platform": sys.platform,
+        "python": sys.version.split(" ")[0],
+        "params": params,
+        "results": results,
+    }
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to: " + output_path)
+
+
+# Puts the stub yt-dlp and ffmpeg executables first in PATH for subprocesses
+def stub_environment(extra=None):
+    env = dict(os.environ)
+    env["PATH"] = stubs_dir + os.pathsep + env.get("PATH", "")
+    if extra:
+        env.update(extra)
+    return env
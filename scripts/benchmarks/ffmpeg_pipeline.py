@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# Benchmarks the ffmpeg pipelines play_file builds, using test media generated locally with ffmpeg's lavfi
+# sources and a synthetic CDG writer. Each variant runs headless (streaming to a pipe instead of the
+# player) and reports the time until ffmpeg prints "Stream #" (what play_file waits for), encode speed
+# relative to realtime, CPU time and peak RSS. Requires ffmpeg in PATH and Linux.
+#
+# Example: python3 scripts/benchmarks/ffmpeg_pipeline.py --duration 30 --sweep
+import argparse
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import psutil
+
+from common import save_results
+
+from lib.ffmpeg_pipeline import build_pipeline, get_default_vcodec  # noqa: E402
+from lib.file_resolver import FileResolver  # noqa: E402
+from lib.get_platform import get_platform  # noqa: E402
+
+
+# A CDG packet is 24 bytes: command, instruction, 2 parity bytes, 16 data bytes and 4 parity bytes.
+# Only the low 6 bits of each data byte are used.
+def cdg_packet(instruction, data):
+    return bytes([0x09, instruction, 0, 0]) + bytes(data).ljust(16, b"\0") + bytes(4)
+
+
+# Writes a CDG file that clears the screen, loads a palette, then draws random tiles at the usual rate of
+# 300 packets per second, which keeps the decoder about as busy as real karaoke graphics.
+def write_cdg(path, seconds, seed=1):
+    rng = random.Random(seed)
+    packets = [cdg_packet(1, [0, 0])]  # memory preset: clear the screen to color 0
+    for instruction in (30, 31):  # load the low and high halves of the color table
+        data = []
+        for _ in range(8):
+            r, g, b = rng.randrange(16), rng.randrange(16), rng.randrange(16)
+            data += [(r << 2) | (g >> 2), ((g & 3) << 4) | b]
+        packets.append(cdg_packet(instruction, data))
+    while len(packets) < seconds * 300:
+        tile = [rng.randrange(16), rng.randrange(16), rng.randrange(18), rng.randrange(50)]
+        packets.append(cdg_packet(6, tile + [rng.randrange(64) for _ in range(12)]))
+    with open(path, "wb") as f:
+        f.write(b"".join(packets))
+
+
+def get_encoders():
+    output = subprocess.check_output(["ffmpeg", "-hide_banner", "-encoders"], stderr=subprocess.DEVNULL)
+    return output.decode("utf-8", "ignore")
+
+
+def has_filter(name):
+    output = subprocess.check_output(["ffmpeg", "-hide_banner", "-filters"], stderr=subprocess.DEVNULL)
+    return (" %s " % name) in output.decode("utf-8", "ignore")
+
+
+def lavfi(video_size, duration):
+    return [
+        "-f", "lavfi", "-i", "testsrc2=size=%s:rate=30:duration=%d" % (video_size, duration),
+        "-f", "lavfi", "-i", "sine=frequency=440:beep_factor=4:duration=%d" % duration,
+    ]
+
+
+def generate_media(media_dir, duration, resolution):
+    encoders = get_encoders()
+    # youtube serves vp9 in webm and mkv containers
+    vp9 = ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8"] if "libvpx-vp9" in encoders else ["-c:v", "mpeg4"]
+    opus = ["-c:a", "libopus"] if "libopus" in encoders else ["-c:a", "aac"]
+    jobs = {
+        "mp4": lavfi(resolution, duration) + ["-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac", "-pix_fmt", "yuv420p"],
+        "mkv": lavfi(resolution, duration) + vp9 + opus,
+        "webm": lavfi(resolution, duration) + vp9 + opus,
+        "mp3": ["-f", "lavfi", "-i", "sine=frequency=440:beep_factor=4:duration=%d" % duration, "-c:a", "libmp3lame"],
+    }
+    media = {}
+    for kind, args in jobs.items():
+        path = os.path.join(media_dir, "song.%s" % kind)
+        print("Generating %s test media..." % kind)
+        subprocess.check_call(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"] + args + [path])
+        media[kind] = path
+
+    cdg_dir = os.path.join(media_dir, "cdg")
+    os.makedirs(cdg_dir)
+    shutil.copy(media["mp3"], os.path.join(cdg_dir, "song.mp3"))
+    write_cdg(os.path.join(cdg_dir, "song.cdg"), duration)
+    media["cdg_mp3"] = os.path.join(cdg_dir, "song.mp3")
+    media["cdg_zip"] = os.path.join(media_dir, "song.zip")
+    with zipfile.ZipFile(media["cdg_zip"], "w") as z:
+        z.write(os.path.join(cdg_dir, "song.mp3"), "song.mp3")
+        z.write(os.path.join(cdg_dir, "song.cdg"), "song.cdg")
+    del media["mp3"]  # only playable as part of an mp3+cdg pair
+    return media
+
+
+def get_variants(sweep, rubberband):
+    semitones = [0, 3] if rubberband else [0]
+    variants = []
+    for source in ["mp4", "webm", "mkv", "cdg_mp3", "cdg_zip"]:
+        for s in semitones:
+            variants.append({"source": source, "semitones": s})
+    if sweep:
+        for source in ["mkv", "cdg_zip"]:
+            for preset in ["ultrafast", "veryfast", "medium"]:
+                for vbitrate in ["2M", "5M"]:
+                    variants.append({"source": source, "semitones": 0, "preset": preset, "vbitrate": vbitrate})
+        for fps in [10, 15, 30]:
+            variants.append({"source": "cdg_zip", "semitones": 0, "cdg_fps": fps})
+        if rubberband:
+            for pitchq in ["quality", "speed", "consistency"]:
+                variants.append({"source": "mp4", "semitones": 3, "rubberband_options": {"pitchq": pitchq}})
+    return variants
+
+
+def variant_name(v):
+    name = "%s %+d" % (v["source"], v["semitones"])
+    for key in ["preset", "vbitrate", "cdg_fps"]:
+        if key in v:
+            name += " %s=%s" % (key, v[key])
+    if "rubberband_options" in v:
+        name += " " + ",".join("%s=%s" % kv for kv in v["rubberband_options"].items())
+    return name
+
+
+def run_variant(variant, media, vcodec, duration):
+    fr = FileResolver(media[variant["source"]])
+    options = {k: variant[k] for k in ["preset", "vbitrate", "cdg_fps", "rubberband_options"] if k in variant}
+    output = build_pipeline(fr, "pipe:", semitones=variant["semitones"], default_vcodec=vcodec, listen=False, **options)
+    cmd = output.compile()
+
+    result = {"first_stream_s": None, "output_ready_s": None, "first_byte_s": None, "speed": None, "bytes": 0}
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def drain_stdout():
+        while True:
+            chunk = process.stdout.read(65536)
+            if not chunk:
+                break
+            if result["first_byte_s"] is None:
+                result["first_byte_s"] = time.perf_counter() - start
+            result["bytes"] += len(chunk)
+
+    peak_rss = [0]
+
+    def sample_rss():
+        try:
+            p = psutil.Process(process.pid)
+            while process.poll() is None:
+                peak_rss[0] = max(peak_rss[0], p.memory_info().rss)
+                time.sleep(0.05)
+        except psutil.Error:
+            pass
+
+    threads = [threading.Thread(target=drain_stdout), threading.Thread(target=sample_rss)]
+    for t in threads:
+        t.start()
+
+    # progress lines end with \r rather than \n
+    buffer = b""
+    while True:
+        chunk = process.stderr.read1(4096)
+        if not chunk:
+            break
+        buffer += chunk
+        lines = re.split(rb"[\r\n]", buffer)
+        buffer = lines.pop()
+        for line in lines:
+            line = line.decode("utf-8", "ignore")
+            if "Stream #" in line and result["first_stream_s"] is None:
+                result["first_stream_s"] = time.perf_counter() - start
+            if line.startswith("Output #") and result["output_ready_s"] is None:
+                result["output_ready_s"] = time.perf_counter() - start
+            speed = re.search(r"speed=\s*([\d.]+)x", line)
+            if speed:
+                result["speed"] = float(speed.group(1))
+    returncode = process.wait()
+    wall = time.perf_counter() - start
+    for t in threads:
+        t.join()
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    result.update(
+        {
+            "returncode": returncode,
+            "wall_s": round(wall, 3),
+            "realtime_x": round(duration / wall, 2),
+            "cpu_s": round(cpu, 3),
+            "cpu_cores": round(cpu / wall, 2),
+            "peak_rss_mb": round(peak_rss[0] / 1024.0 / 1024.0, 1),
+        }
+    )
+    for key in ["first_stream_s", "output_ready_s", "first_byte_s"]:
+        if result[key] is not None:
+            result[key] = round(result[key], 3)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pikaraoke's ffmpeg playback pipelines")
+    parser.add_argument("--duration", type=int, default=30, help="Length of the generated test media in seconds (default: 30)")
+    parser.add_argument("--resolution", default="1280x720", help="Resolution of the generated video (default: 1280x720)")
+    parser.add_argument("--vcodec", default=get_default_vcodec(get_platform()), help="Video encoder for transcoded sources (default: same as play_file)")
+    parser.add_argument("--sweep", action="store_true", help="Also compare x264 presets, bitrates, CDG frame rates and rubberband settings")
+    parser.add_argument("--output", default="ffmpeg_pipeline_results.json", help="Where to save the JSON report")
+    args = parser.parse_args()
+
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg was not found in PATH")
+        return 1
+    rubberband = has_filter("rubberband")
+    if not rubberband:
+        print("ffmpeg was built without rubberband, skipping transposed variants")
+
+    work_dir = tempfile.mkdtemp(prefix="pikaraoke-ffmpeg-bench-")
+    results = []
+    try:
+        media = generate_media(work_dir, args.duration, args.resolution)
+        for variant in get_variants(args.sweep, rubberband):
+            name = variant_name(variant)
+            print("Running: " + name)
+            result = run_variant(variant, media, args.vcodec, args.duration)
+            result.update(variant, name=name)
+            results.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("\n%-44s %9s %9s %9s %8s %8s %8s" % ("variant", "stream s", "x rt", "ffmpeg x", "cpu s", "cores", "rss MB"))
+    for r in results:
+        print("%-44s %9s %9s %9s %8s %8s %8s%s" % (
+            r["name"], r["first_stream_s"], r["realtime_x"], r["speed"], r["cpu_s"], r["cpu_cores"], r["peak_rss_mb"],
+            "" if r["returncode"] == 0 else "  (failed: exit code %d)" % r["returncode"]))
+    save_results(args.output, "ffmpeg_pipeline", results, vars(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
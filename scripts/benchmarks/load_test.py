@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# Load test which starts the real pikaraoke app (app.py) against stub yt-dlp and ffmpeg executables and
+# drives it with a room full of simulated phones plus a splash screen client, then reports latency
+# percentiles per route, throughput, and the server's CPU and memory usage.
+#
+# Example: python3 scripts/benchmarks/load_test.py --phones 50 --duration 60
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import psutil
+import requests
+
+from common import generate_library, repo_dir, save_results, stub_environment, stubs_dir
+
+from lib.percentile import percentile  # noqa: E402
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.errors[route] += 1
+
+
+class Client:
+    def __init__(self, base_url, stats, stop_event, seed):
+        self.base_url = base_url
+        self.stats = stats
+        self.stop_event = stop_event
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+
+    def request(self, route, method="GET", **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            r = self.session.request(method, self.base_url + route, timeout=60, allow_redirects=False, **kwargs)
+            ok = r.status_code < 400
+            return r
+        except requests.RequestException:
+            return None
+        finally:
+            self.stats.record(route, time.perf_counter() - start, ok)
+
+    def sleep(self, seconds):
+        return self.stop_event.wait(seconds)
+
+
+# Mirrors what the splash screen does: poll /nowplaying, start the video and report back, end songs
+class SplashClient(Client):
+    def __init__(self, base_url, stats, stop_event, song_seconds):
+        super().__init__(base_url, stats, stop_event, 0)
+        self.song_seconds = song_seconds
+        self.songs_played = 0
+
+    def run(self):
+        playing_since = None
+        while not self.sleep(1):
+            r = self.request("/nowplaying")
+            if r is None or not r.text:
+                continue
+            state = r.json()
+            if state["now_playing_url"] and playing_since is None:
+                self.sleep(1.2)  # the splash screen reports the start after a short delay
+                self.request("/start_song")
+                playing_since = time.time()
+            elif playing_since and time.time() - playing_since > self.song_seconds:
+                self.request("/end_song")
+                self.songs_played += 1
+                playing_since = None
+            if state["now_playing_command"]:
+                self.request("/clear_command")
+
+
+# A guest's phone. It spends most of its time on the home or queue page (which poll the server every
+# 1.5 secs like the real pages do), and now and then browses, types a search, or queues songs.
+class PhoneClient(Client):
+    def __init__(self, base_url, stats, stop_event, seed, songs, search_ratio):
+        super().__init__(base_url, stats, stop_event, seed)
+        self.songs = songs
+        self.search_ratio = search_ratio
+        self.user = "phone-%d" % seed
+
+    def run(self):
+        self.sleep(self.rng.uniform(0, 1.5))  # don't start all phones in lockstep
+        while not self.stop_event.is_set():
+            action = self.rng.random()
+            if action < 0.05:
+                self.browse()
+            elif action < 0.08:
+                self.type_search()
+            elif action < 0.10:
+                self.enqueue_burst()
+            elif action < 0.10 + self.search_ratio:
+                self.youtube_search()
+            else:
+                self.poll_page()
+
+    def poll_page(self):
+        route = self.rng.choice(["/nowplaying", "/get_queue"])
+        for _ in range(self.rng.randint(3, 10)):
+            self.request(route)
+            if self.sleep(1.5):
+                return
+
+    def browse(self):
+        self.request("/browse")
+        params = self.rng.choice([{"sort": "date"}, {"letter": self.rng.choice("abcdefghijklmnopqrstuvwxyz")}, {"page": 2}])
+        self.request("/browse", params=params)
+
+    def type_search(self):
+        word = self.rng.choice(self.songs).split("/")[-1].split(" ")[0].lower()
+        for i in range(1, min(len(word), 6) + 1):
+            self.request("/autocomplete", params={"q": word[:i]})
+            if self.sleep(0.2):
+                return
+
+    def enqueue_burst(self):
+        for song in self.rng.sample(self.songs, min(3, len(self.songs))):
+            self.request("/enqueue", params={"song": song, "user": self.user})
+
+    def youtube_search(self):
+        self.request("/search", params={"search_string": "stub song %d" % self.rng.randint(0, 1000)})
+        if self.rng.random() < 0.3:
+            vid = "".join(self.rng.choice("abcdefghijklmnop") for _ in range(11))
+            data = {"song-url": "https://www.youtube.com/watch?v=" + vid, "song-added-by": self.user}
+            self.request("/download", method="POST", data=data)
+
+
+def sample_server(pid, stop_event, samples):
+    try:
+        process = psutil.Process(pid)
+        process.cpu_percent()
+        while not stop_event.wait(1):
+            children = process.children(recursive=True)
+            cpu = process.cpu_percent()
+            rss = process.memory_info().rss
+            for child in children:
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            samples.append({"cpu": cpu, "rss": rss, "children": len(children)})
+    except psutil.NoSuchProcess:
+        pass
+
+
+def wait_for_server(base_url, timeout=60):
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        try:
+            r = requests.get(base_url + "/startup_status", timeout=2)
+            if r.status_code == 200 and r.json()["ready"]:
+                return True
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a room full of phones against a local pikaraoke")
+    parser.add_argument("--phones", type=int, default=30, help="Number of simulated phones (default: 30)")
+    parser.add_argument("--duration", type=int, default=60, help="Test duration in seconds (default: 60)")
+    parser.add_argument("--library-size", type=int, default=2000, help="Songs in the synthetic library (default: 2000)")
+    parser.add_argument("--song-seconds", type=float, default=20, help="Simulated song length (default: 20)")
+    parser.add_argument("--search-ratio", type=float, default=0.01, help="Share of phone actions that search YouTube (default: 0.01)")
+    parser.add_argument("--ytdlp-delay", type=float, default=1.5, help="Average stub yt-dlp delay in seconds (default: 1.5)")
+    parser.add_argument("--port", type=int, default=5655, help="Port for the app under test (default: 5655)")
+    parser.add_argument("--server-args", default="", help="Extra arguments passed to app.py, e.g. '--server async'")
+    parser.add_argument("--output", default="load_test_results.json", help="Where to save the JSON report")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pikaraoke-loadtest-")
+    songs_dir = os.path.join(work_dir, "songs")
+    songs = generate_library(songs_dir, args.library_size)
+    base_url = "http://127.0.0.1:%d" % args.port
+
+    cmd = [
+        sys.executable, os.path.join(repo_dir, "app.py"),
+        "--port", str(args.port),
+        "--ffmpeg-port", str(args.port + 1),
+        "--download-path", songs_dir,
+        "--youtubedl-path", os.path.join(stubs_dir, "yt-dlp"),
+        "--data-path", os.path.join(work_dir, "data"),
+        "--url", base_url,
+        "--splash-delay", "1",
+        "--log-level", "30",
+    ] + args.server_args.split()
+    env = stub_environment({"STUB_YTDLP_DELAY": str(args.ytdlp_delay)})
+    server = subprocess.Popen(cmd, cwd=repo_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        if not wait_for_server(base_url):
+            print("Server did not become ready in time")
+            return 1
+        print("Running %d phones for %ds against %d songs..." % (args.phones, args.duration, len(songs)))
+
+        stats = Stats()
+        stop_event = threading.Event()
+        splash = SplashClient(base_url, stats, stop_event, args.song_seconds)
+        clients = [splash] + [
+            PhoneClient(base_url, stats, stop_event, i + 1, songs, args.search_ratio) for i in range(args.phones)
+        ]
+        threads = [threading.Thread(target=c.run, daemon=True) for c in clients]
+        samples = []
+        threads.append(threading.Thread(target=sample_server, args=(server.pid, stop_event, samples), daemon=True))
+
+        start_time = time.time()
+        for t in threads:
+            t.start()
+        stop_event.wait(args.duration)
+        stop_event.set()
+        for t in threads:
+            t.join(timeout=60)
+        elapsed = time.time() - start_time
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    routes = {}
+    total_requests = 0
+    print("\n%-16s %8s %8s %10s %10s %10s" % ("route", "requests", "errors", "p50 (ms)", "p99 (ms)", "max (ms)"))
+    for route in sorted(stats.latencies):
+        values = stats.latencies[route]
+        total_requests += len(values)
+        routes[route] = {
+            "requests": len(values),
+            "errors": stats.errors[route],
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+            "max_ms": round(max(values) * 1000, 1),
+        }
+        r = routes[route]
+        print("%-16s %8d %8d %10.1f %10.1f %10.1f" % (route, r["requests"], r["errors"], r["p50_ms"], r["p99_ms"], r["max_ms"]))
+
+    cpu = [s["cpu"] for s in samples]
+    rss = [s["rss"] / 1024.0 / 1024.0 for s in samples]
+    results = {
+        "routes": routes,
+        "total_requests": total_requests,
+        "throughput_rps": round(total_requests / elapsed, 1),
+        "songs_played": splash.songs_played,
+        "server_cpu_percent": {"mean": round(sum(cpu) / len(cpu), 1) if cpu else None, "p99": round(percentile(cpu, 99), 1) if cpu else None},
+        "server_rss_mb": {"max": round(max(rss), 1) if rss else None},
+    }
+    print("\nthroughput: %.1f req/s, songs played: %d" % (results["throughput_rps"], splash.songs_played))
+    print("server cpu: mean %s%%, p99 %s%%, max rss: %s MB" % (
+        results["server_cpu_percent"]["mean"], results["server_cpu_percent"]["p99"], results["server_rss_mb"]["max"]))
+    save_results(args.output, "load_test", results, vars(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from lib.engine_ipc import EngineHost, RemoteKaraoke, state_fields  # noqa: E402
+
+
+# Just enough of Karaoke for the engine host to publish and serve
+class FakeKaraoke:
+    def __init__(self):
+        for field in state_fields:
+            setattr(self, field, None)
+        self.queue = [{"file": "song.mp4", "title": "Song", "user": "u", "semitones": 0}]
+        self.available_songs = ["song.mp4"]
+        self.running = True
+
+    def is_ready(self):
+        return True
+
+    def get_startup_status(self):
+        return {}
+
+    def queue_clear(self):
+        self.queue = []
+
+    def stop(self):
+        self.running = False
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    engine = FakeKaraoke()
+    host = EngineHost(engine, str(tmp_path))
+    host.start()
+    k = RemoteKaraoke(host.address, host.authkey, str(tmp_path))
+    monkeypatch.setattr(app, "k", k, raising=False)
+    monkeypatch.setattr(app, "rooms", {})
+    monkeypatch.setattr(app, "async_server", None)
+    monkeypatch.setattr(app, "is_web_worker", True)
+    yield engine, k
+    host.stop()
+
+
+def test_delayed_halt_stops_the_engine(remote):
+    engine, k = remote
+    with pytest.raises(SystemExit):
+        app.delayed_halt(0)
+    assert engine.queue == []
+    assert not engine.running
+
+
+def test_delayed_halt_runs_the_system_command(remote, monkeypatch):
+    engine, k = remote
+    commands = []
+    monkeypatch.setattr(app.os, "system", commands.append)
+    app.delayed_halt(1)
+    assert not engine.running
+    assert commands == ["shutdown now"]
+
+
+def test_unknown_attributes_are_not_forwarded(remote):
+    engine, k = remote
+    with pytest.raises(AttributeError):
+        k.not_a_method
+    with pytest.raises(AttributeError):
+        k.volume = 0.5
@@ -0,0 +1,326 @@
+import argparse
+import hmac
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+import cheroot.wsgi
+from flask import Flask, request
+
+from lib.encode_profiles import EncodeProfiles
+from lib.ffmpeg_stats import FfmpegStatsLog
+from lib.get_platform import get_platform
+from lib.logs import setup_logging
+from lib.process_supervisor import ProcessSupervisor
+from lib.transcoder import LocalTranscoder, encode_option_names
+
+# Standalone transcoding worker. A pikaraoke server on a slow machine (see --transcode-worker in app.py)
+# hands songs that need transcoding to this service, which runs the same ffmpeg pipeline and serves the
+# stream to the splash screen itself. Songs are read from a song directory both machines share (see
+# --path-map), or uploaded by the server and kept in a size limited cache. Every request has to carry
+# the worker's shared secret (see --token) as "Authorization: Bearer <token>".
+#
+#   GET    /health                 the server's health check
+#   POST   /jobs                   start a job: {"path", "semitones", "gain_db", "encode_options", "offset"}
+#   GET    /jobs/<id>/ready        waits up to ?timeout= secs for the stream to become playable
+#   GET    /jobs/<id>              ffmpeg stats of the job
+#   DELETE /jobs/<id>              stop the job, returns its final stats
+#   GET    /files/<key>/<name>     path of an uploaded file, 404 if it wasn't uploaded yet
+#   PUT    /files/<key>/<name>     upload a file, at most the cache size
+
+app = Flask(__name__)
+jobs = {}  # job id -> Job
+lock = threading.Lock()
+free_ports = []  # stream ports not used by a job
+transcoders = {}  # stream port -> LocalTranscoder
+path_map = []  # (server path, worker path) prefixes
+cache_dir = None
+cache_size = None  # in bytes
+advertise_host = None
+token = None  # shared secret of the server and the worker
+finished_job_ttl = 600  # in seconds, after which finished jobs are forgotten
+
+
+class Job:
+    def __init__(self, transcode, port):
+        self.id = uuid.uuid4().hex
+        self.transcode = transcode
+        self.port = port
+        self.ready = threading.Event()
+        self.finished_at = None
+        t = threading.Thread(target=self.run, name="job-" + self.id)
+        t.daemon = True
+        t.start()
+
+    # follows ffmpeg's output until it exits, then hands the port to the next job
+    def run(self):
+        if self.transcode.wait_until_ready():
+            self.ready.set()
+        while self.transcode.is_running():
+            self.transcode.log_output(1)
+        with lock:
+            free_ports.append(self.port)
+            self.finished_at = time.time()
+
+    def get_stats(self):
+        return self.transcode.stats.to_dict()
+
+
+# Path of a song on this machine, or None if it's outside the shared song directories and the upload cache
+def map_path(path):
+    candidates = [(cache_dir, cache_dir)] + path_map
+    for server_path, worker_path in candidates:
+        if path.startswith(server_path.rstrip(os.sep) + os.sep):
+            mapped = os.path.realpath(worker_path + path[len(server_path.rstrip(os.sep)) :])
+            if mapped.startswith(os.path.realpath(worker_path) + os.sep):
+                return mapped
+    return None
+
+
+def error(message, status):
+    return json.dumps({"error": message}), status
+
+
+@app.before_request
+def check_token():
+    given = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(given.encode("utf-8"), ("Bearer " + token).encode("utf-8")):
+        return error("Invalid token", 401)
+
+
+@app.route("/health")
+def health():
+    with lock:
+        running = len([j for j in jobs.values() if j.finished_at is None])
+        available = len(free_ports)
+    return json.dumps({"status": "ok", "platform": get_platform(), "jobs": running, "free_ports": available})
+
+
+@app.route("/jobs", methods=["POST"])
+def start_job():
+    d = request.get_json()
+    path = map_path(d["path"])
+    if path is None or not os.path.isfile(path):
+        return error("Song not found: " + d["path"], 404)
+    encode_options = {k: v for k, v in (d.get("encode_options") or {}).items() if k in encode_option_names}
+
+    with lock:
+        for job_id in [i for i, j in jobs.items() if j.finished_at and time.time() - j.finished_at > finished_job_ttl]:
+            del jobs[job_id]
+        if not free_ports:
+            return error("All stream ports are busy", 503)
+        port = free_ports.pop(0)
+
+    stream_uid = int(time.time() * 1000)
+    listen_url = f"http://0.0.0.0:{port}/{stream_uid}"
+    stream_url = f"http://{advertise_host}:{port}/{stream_uid}"
+    try:
+        transcode = transcoders[port].start(
+            path,
+            int(d.get("semitones", 0)),
+            listen_url,
+            stream_url,
+            d.get("gain_db"),
+            encode_options or None,
+            float(d.get("offset", 0)),
+        )
+    except Exception as e:
+        logging.error("Error starting job for %s: %s" % (path, e))
+        with lock:
+            free_ports.append(port)
+        return error(str(e), 500)
+
+    job = Job(transcode, port)
+    with lock:
+        jobs[job.id] = job
+    logging.info("Job %s streaming %s on port %d" % (job.id, path, port))
+    return json.dumps(
+        {
+            "id": job.id,
+            "stream_url": stream_url,
+            "audio_reencoded": transcode.audio_reencoded,
+            "vcodec": transcode.stats.vcodec,
+            "acodec": transcode.stats.acodec,
+        }
+    )
+
+
+def get_job(job_id):
+    with lock:
+        return jobs.get(job_id)
+
+
+@app.route("/jobs/<job_id>/ready")
+def job_ready(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return error("Unknown job", 404)
+    job.ready.wait(min(request.args.get("timeout", 5, type=float), 30))
+    return json.dumps({"ready": job.ready.is_set(), "running": job.finished_at is None})
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_stats(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return error("Unknown job", 404)
+    return json.dumps(job.get_stats())
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def stop_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return error("Unknown job", 404)
+    job.transcode.stop()
+    logging.info("Job %s stopped" % job.id)
+    return json.dumps(job.get_stats())
+
+
+def get_upload_path(key, name):
+    if not re.match(r"^[0-9a-f]{40}$", key) or name != os.path.basename(name) or name in ("", ".", ".."):
+        return None
+    return os.path.join(cache_dir, key, name)
+
+
+@app.route("/files/<key>/<name>", methods=["GET"])
+def get_file(key, name):
+    path = get_upload_path(key, name)
+    if path is None or not os.path.isfile(path):
+        return error("Not uploaded", 404)
+    os.utime(os.path.dirname(path))  # marks it as recently used
+    return json.dumps({"path": path})
+
+
+@app.route("/files/<key>/<name>", methods=["PUT"])
+def put_file(key, name):
+    path = get_upload_path(key, name)
+    if path is None:
+        return error("Invalid file name", 400)
+    if request.content_length is None:
+        return error("Content-Length required", 411)
+    if request.content_length > cache_size:
+        return error("File is larger than the upload cache", 413)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        shutil.copyfileobj(request.stream, f, 1024 * 1024)
+    os.replace(tmp_path, path)
+    logging.info("Received upload: " + path)
+    trim_cache(keep=os.path.dirname(path))
+    return json.dumps({"path": path})
+
+
+# Deletes the least recently used uploads until the cache fits in cache_size
+def trim_cache(keep):
+    entries = []
+    total = 0
+    for key in os.listdir(cache_dir):
+        directory = os.path.join(cache_dir, key)
+        size = sum(os.path.getsize(os.path.join(directory, n)) for n in os.listdir(directory))
+        entries.append((os.path.getmtime(directory), size, directory))
+        total += size
+    for mtime, size, directory in sorted(entries):
+        if total <= cache_size:
+            break
+        if directory != keep:
+            logging.info("Removing cached upload: " + directory)
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+
+
+def get_ip():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # doesn't even have to be reachable
+        s.connect(("10.255.255.255", 1))
+        ip = s.getsockname()[0]
+    except Exception:
+        ip = "127.0.0.1"
+    finally:
+        s.close()
+    return ip
+
+
+def parse_ports(value):
+    first, _, last = value.partition("-")
+    return list(range(int(first), int(last or first) + 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcodes songs for a pikaraoke server on another machine")
+    parser.add_argument("-p", "--port", type=int, default=5580, help="HTTP port of the worker (default: 5580)")
+    parser.add_argument(
+        "--stream-ports",
+        default="5590-5593",
+        help="Port or range of ports the songs are streamed from, one per song transcoding at the same time (default: 5590-5593)",
+    )
+    parser.add_argument(
+        "--token",
+        default=os.environ.get("PIKARAOKE_WORKER_TOKEN"),
+        help="Shared secret the pikaraoke server has to send with every request, see --transcode-worker-token in app.py (default: $PIKARAOKE_WORKER_TOKEN)",
+    )
+    parser.add_argument(
+        "--advertise-host",
+        default=None,
+        help="Host name or IP the splash screen reaches this machine at (default: the IP of this machine)",
+    )
+    parser.add_argument(
+        "--path-map",
+        action="append",
+        default=[],
+        help="Song directory shared with the server, as SERVER_PATH=WORKER_PATH or just PATH if it's the same on both machines. Can be given several times. Songs elsewhere get uploaded.",
+    )
+    parser.add_argument(
+        "--data-path",
+        default="~/.pikaraoke-worker",
+        help="Directory for uploaded songs and the encoder calibration (default: ~/.pikaraoke-worker)",
+    )
+    parser.add_argument("--cache-size", type=float, default=5, help="Maximum size of the uploaded songs in GB (default: 5)")
+    parser.add_argument(
+        "--adaptive-encoding",
+        action="store_true",
+        help="Measure the video encoders' speed on this machine and pick the encoder preset, resolution and bitrate of each song so it keeps up with realtime",
+    )
+    parser.add_argument(
+        "-l", "--log-level", type=int, default=logging.INFO, help="Logging level as an int, see app.py (default: %d)" % logging.INFO
+    )
+    args = parser.parse_args()
+    if not args.token:
+        # anyone on the network could otherwise upload files and run ffmpeg here
+        parser.error("a --token is required")
+    token = args.token
+
+    setup_logging(args.log_level)
+
+    data_path = os.path.expanduser(args.data_path)
+    cache_dir = os.path.realpath(os.path.join(data_path, "uploads"))
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_size = int(args.cache_size * 1024 * 1024 * 1024)
+    for mapping in args.path_map:
+        server_path, _, worker_path = mapping.partition("=")
+        path_map.append((server_path, os.path.expanduser(worker_path or server_path)))
+    advertise_host = args.advertise_host or get_ip()
+
+    platform = get_platform()
+    supervisor = ProcessSupervisor()
+    encode_profiles = None
+    if args.adaptive_encoding:
+        encode_profiles = EncodeProfiles(os.path.join(data_path, "encoders.json"), platform, supervisor=supervisor)
+        encode_profiles.calibrate_in_background()
+    for port in parse_ports(args.stream_ports):
+        # one FileResolver scope per port, so songs transcoding at the same time extract zips separately
+        transcoders[port] = LocalTranscoder(supervisor, platform, FfmpegStatsLog(), encode_profiles, scope=str(port))
+        free_ports.append(port)
+
+    server = cheroot.wsgi.Server(("0.0.0.0", args.port), app, numthreads=20)
+    logging.info(
+        "Transcode worker listening on port %d, streaming from %s:%s" % (args.port, advertise_host, args.stream_ports)
+    )
+    server.safe_start()